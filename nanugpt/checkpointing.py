@@ -0,0 +1,241 @@
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+import os
+import random
+import shutil
+import threading
+import timeit
+
+import numpy as np
+import torch
+
+from nanugpt import utils
+from nanugpt import sharded_checkpoint
+from nanugpt import delta_checkpoint
+
+"""
+Checkpoint writer that moves `torch.save` off the training loop.
+
+At `save()` we snapshot all tensors in the checkpoint dict into host buffers
+(pinned if CUDA is available) that are reused across checkpoints so we don't
+allocate GBs of memory every time. The actual `torch.save` happens in a
+background thread which writes to a temp file and then atomically renames it
+so a crash during the write never leaves a truncated checkpoint behind. The
+training loop only blocks if the previous write hasn't finished yet.
+
+After each write, retention policy is applied: we keep last `keep_last`
+checkpoints plus the one with best val loss (if `keep_best`).
+
+Name may include a sub directory, e.g., for sharded checkpoints each rank
+writes checkpoint_<step>/shard_<rank>.pt. The sub directory is removed by
+retention once no checkpoint files (finished or in progress) are left in it.
+
+How the checkpoint is laid out on disk is up to the writer, by default it's
+a single torch.save file. See delta_checkpoint.py for incremental checkpoints.
+"""
+
+class CheckpointWriter:
+    """Writes checkpoint as a single torch.save file."""
+    def save(self, checkpoint:Mapping, filepath:str)->int:
+        """Writes checkpoint at filepath, returns bytes written."""
+        torch.save(checkpoint, filepath)
+        return os.path.getsize(filepath)
+
+    def delete(self, filepath:str):
+        utils.delete_file(filepath)
+
+class AsyncCheckpointer:
+    def __init__(self, out_dir:str, keep_last:Optional[int]=None,
+                 keep_best:bool=True, enable_async:bool=True,
+                 on_saved:Optional[Callable[[str, str, float], None]]=None,
+                 writer:Optional[Any]=None):
+        """
+        Parameters:
+        out_dir: directory where checkpoints are written.
+        keep_last: number of most recent checkpoints to keep, None or 0 keeps all.
+        keep_best: if True, checkpoint with lowest val loss is never deleted by retention.
+        enable_async: if False, save() writes synchronously (useful for debugging).
+        on_saved: called as on_saved(name, filepath, write_time_s) after checkpoint is on disk.
+        writer: object with save(checkpoint, filepath)->bytes and delete(filepath), default is CheckpointWriter.
+        """
+        self.out_dir = utils.full_path(out_dir, create=True)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.enable_async = enable_async
+        self.on_saved = on_saved
+        self.writer = writer or CheckpointWriter()
+
+        self._host_buffers:Dict[str, torch.Tensor] = {}
+        self._thread:Optional[threading.Thread] = None
+        self._error:Optional[BaseException] = None
+        # (filepath, val_loss) for each checkpoint written so far in order
+        self._saved:List[Tuple[str, float]] = []
+
+        self.last_wait_time = 0.0 # time training loop was blocked on previous write
+        self.last_snapshot_time = 0.0 # time spent in copying tensors to host
+        self.last_write_time = 0.0 # time spent by background thread in writing
+        self.last_write_bytes = 0 # bytes written to disk by last write
+
+    def _snapshot(self, obj:Any, key:str)->Any:
+        # recursively copy tensors to reusable host buffers, leave everything else as is
+        if isinstance(obj, torch.Tensor):
+            t = obj.detach()
+            buf = self._host_buffers.get(key, None)
+            if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                buf = torch.empty(t.shape, dtype=t.dtype, device='cpu',
+                                  pin_memory=t.is_cuda and torch.cuda.is_available())
+                self._host_buffers[key] = buf
+            buf.copy_(t, non_blocking=t.is_cuda)
+            return buf
+        if isinstance(obj, Mapping):
+            return {k: self._snapshot(v, f'{key}/{k}') for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, f'{key}/{i}') for i, v in enumerate(obj))
+        return obj
+
+    def _write(self, name:str, checkpoint:Mapping, filepath:str, val_loss:float):
+        try:
+            start_time = timeit.default_timer()
+            tmp_filepath = filepath + '.tmp'
+            # other rank's retention may have removed the shared sub dir while it was empty
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            self.last_write_bytes = self.writer.save(checkpoint, tmp_filepath)
+            # atomic on POSIX and Windows, readers see either old or new file
+            os.replace(tmp_filepath, filepath)
+            self.last_write_time = timeit.default_timer() - start_time
+
+            self._saved = [s for s in self._saved if s[0] != filepath] + [(filepath, val_loss)]
+            self._apply_retention()
+
+            if self.on_saved is not None:
+                self.on_saved(name, filepath, self.last_write_time)
+        except BaseException as e:
+            # surfaced to training thread on next wait()
+            self._error = e
+
+    def _apply_retention(self):
+        if not self.keep_last:
+            return
+        keep = set(s[0] for s in self._saved[-self.keep_last:])
+        if self.keep_best:
+            keep.add(min(self._saved, key=lambda s: s[1])[0])
+        for filepath, _ in self._saved:
+            if filepath not in keep:
+                self._delete(filepath)
+        self._saved = [s for s in self._saved if s[0] in keep]
+
+    def _delete(self, filepath:str):
+        self.writer.delete(filepath)
+        dirpath = os.path.dirname(filepath)
+        if os.path.normpath(dirpath) != os.path.normpath(self.out_dir) and os.path.isdir(dirpath) \
+                and not any(f.endswith(('.pt', '.pt.tmp')) for f in os.listdir(dirpath)):
+            # other ranks may be removing the same dir or still writing their shard to it
+            shutil.rmtree(dirpath, ignore_errors=True)
+
+    def wait(self):
+        """Block until pending write is finished. Re-raises error from the writer thread, if any."""
+        start_time = timeit.default_timer()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.last_wait_time = timeit.default_timer() - start_time
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def is_busy(self)->bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def save(self, name:str, checkpoint:Mapping, val_loss:float=float('inf'))->str:
+        """Snapshot checkpoint dict and write it to out_dir/name.pt, returns the filepath."""
+
+        # we have only one set of host buffers so previous write must finish first
+        self.wait()
+
+        start_time = timeit.default_timer()
+        snapshot = self._snapshot(checkpoint, '')
+        if torch.cuda.is_available():
+            # non_blocking copies must land before writer thread reads buffers
+            torch.cuda.synchronize()
+        self.last_snapshot_time = timeit.default_timer() - start_time
+
+        filepath = os.path.join(self.out_dir, f'{name}.pt')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if self.enable_async:
+            self._thread = threading.Thread(target=self._write,
+                                            args=(name, snapshot, filepath, val_loss),
+                                            name='AsyncCheckpointer', daemon=False)
+            self._thread.start()
+        else:
+            self._write(name, snapshot, filepath, val_loss)
+            self.wait()
+        return filepath
+
+    def shutdown(self):
+        self.wait()
+        self._host_buffers.clear()
+
+
+def find_resume_checkpoint(resume_from:Optional[str], out_dir:str)->Optional[str]:
+    """Returns checkpoint filepath to resume from or None if we should start fresh.
+
+    resume_from can be a checkpoint filepath, sharded checkpoint dir or 'auto'.
+    For 'auto', we look for checkpoint_log.yaml in out_dir and pick the latest
+    checkpoint that is complete on disk (the last one may be missing if we died
+    while writing it).
+    """
+    if not resume_from:
+        return None
+    if resume_from != 'auto':
+        resume_from = utils.full_path(resume_from)
+        if not _is_complete_checkpoint(resume_from):
+            raise FileNotFoundError(f'Checkpoint to resume from not found: {resume_from}')
+        return resume_from
+
+    checkpoint_log_filepath = os.path.join(utils.full_path(out_dir), 'checkpoint_log.yaml')
+    if not os.path.isfile(checkpoint_log_filepath):
+        return None
+    checkpoint_log = utils.load_yaml(checkpoint_log_filepath) or []
+    for entry in reversed(checkpoint_log):
+        filepath = entry.get('checkpoint_filepath', None)
+        if filepath and _is_complete_checkpoint(filepath):
+            return filepath
+    return None
+
+def _is_complete_checkpoint(filepath:str)->bool:
+    if os.path.isdir(filepath):
+        return sharded_checkpoint.is_complete(filepath)
+    return os.path.isfile(filepath)
+
+def load_checkpoint(filepath:str)->Dict[str, Any]:
+    """Loads checkpoint file on CPU, reconstructing it if it was saved as delta checkpoint."""
+    checkpoint = torch.load(filepath, map_location='cpu', weights_only=True)
+    if delta_checkpoint.is_manifest(checkpoint):
+        checkpoint = delta_checkpoint.reconstruct(checkpoint, os.path.dirname(filepath))
+    return checkpoint
+
+def rng_state()->Dict[str, Any]:
+    """Captures all RNG states of this process in form that torch.load(weights_only=True) can load."""
+    np_state = np.random.get_state()
+    return {'python': random.getstate(),
+            # uint32 tensors can't be sent via all_gather_object so keys are kept as int64
+            'numpy': {'keys': torch.from_numpy(np_state[1].astype(np.int64)), 'pos': int(np_state[2]), # type: ignore
+                      'has_gauss': int(np_state[3]), 'cached_gaussian': float(np_state[4])}, # type: ignore
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state() if torch.cuda.is_available() else None}
+
+def set_rng_state(state:Mapping[str, Any])->None:
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state(('MT19937', np_state['keys'].numpy().astype(np.uint32), np_state['pos'],
+                         np_state['has_gauss'], np_state['cached_gaussian']))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+def load_model_state(model:torch.nn.Module, state_dict:Mapping[str, Any])->None:
+    """Loads state saved from plain or torch.compile'd model into plain or compiled model."""
+    unwanted_prefix = '_orig_mod.'
+    state_dict = {(k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k):v \
+                  for k, v in state_dict.items()}
+    # compiled model wraps the original in _orig_mod
+    getattr(model, '_orig_mod', model).load_state_dict(state_dict)
@@ -19,6 +19,16 @@ def setup_device(config:Mapping, logger:logging.Logger)->Tuple[torch.device, Abs
     enable_distributed = config['general']['enable_distributed']
     distributed_backend = config['general']['distributed_backend']
     distributed_init_method = config['general']['distributed_init_method']
+    distributed_timeout_s = config['general'].get('distributed_timeout_s', 0)
+    cpu_threads = config['general'].get('cpu_threads', 0)
+    cpu_interop_threads = config['general'].get('cpu_interop_threads', 0)
+    cpu_affinity = config['general'].get('cpu_affinity', '')
+
+    if not device_type:
+        device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # nccl only works with cuda tensors, CPU ranks use gloo
+    if not distributed_backend or (device_type == 'cpu' and distributed_backend == 'nccl'):
+        distributed_backend = 'nccl' if device_type == 'cuda' else 'gloo'
 
     if enable_distributed is None and int(os.environ.get('WORLD_SIZE', '1')) > 1:
         enable_distributed = True
@@ -28,20 +38,33 @@ def setup_device(config:Mapping, logger:logging.Logger)->Tuple[torch.device, Abs
     # if 'CUDA_MODULE_LOADING' not in os.environ:
     #     os.environ['CUDA_MODULE_LOADING'] = 'LAZY'
 
+    # threads must be set before torch does any inter-op parallel work
+    cpu_info = utils.setup_cpu_threads(num_threads=cpu_threads, interop_threads=cpu_interop_threads,
+                                       affinity=cpu_affinity,
+                                       local_rank=int(os.environ.get('LOCAL_RANK', '0')),
+                                       # only CPU training ranks share cores
+                                       local_world_size=int(os.environ.get('LOCAL_WORLD_SIZE', '1')) if device_type == 'cpu' else 1)
+
     torch_info = utils.setup_torch(seed=seed,
                 device_type=device_type, dtype=dtype,
                 enable_distributed=enable_distributed,
                 distributed_backend=distributed_backend,
-                distributed_init_method=distributed_init_method)
+                distributed_init_method=distributed_init_method,
+                distributed_timeout_s=distributed_timeout_s)
 
-    utils.setup_sys(seed + torch_info.seed_offset)
+    utils.setup_sys(seed + torch_info.seed_offset, max_threads=cpu_info['cpu/num_threads'])
 
     device = torch.device(torch_info.device_name)
-    amp_ctx = nullcontext() if torch_info.device_type == 'cpu' else torch.amp.autocast(device_type=torch_info.device_type, dtype=torch_info.pt_dtype)
+    # on CPU bfloat16 autocast uses AMX/AVX512-BF16 kernels where available
+    amp_ctx = nullcontext() if torch_info.pt_dtype == torch.float32 else torch.amp.autocast(device_type=torch_info.device_type, dtype=torch_info.pt_dtype)
+    if torch_info.device_type == 'cpu' and torch_info.pt_dtype == torch.bfloat16 and \
+            not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        logger.warn('CPU has no native bfloat16 support, bfloat16 autocast will likely be slower than float32.')
 
     d = {'torch_info/'+k:v for k,v in dataclasses.asdict(torch_info).items()}
     d['torch_info/pt_dtype'] = str(d['torch_info/pt_dtype'])  # make it JSON serializable so it can be logged
     d['torch_info/device_index'] = str(device.index)  # make it JSON serializable so it can be logged
+    d.update(cpu_info)
     logger.summary(d)
     logger.log_torch_info()
 
@@ -3,6 +3,7 @@ import torch
 
 from torch.utils.data import DataLoader
 
+from nanugpt import utils
 from nanugpt.tokenizers.grokking_tokenizer import GrokkingTokenizer, get_tokenizer_factory, DIVISION_MODULO_OPERATIONS, ALL_OPERATIONS
 
 """
@@ -53,7 +54,7 @@ def operation_mod_p_data(operation: str, p: int, tokenizer: GrokkingTokenizer):
 
 def get_data(operation: str, prime: int, training_fraction: float, val_fraction:Optional[float],
              device_batch_size: int, eval_batch_size:int, data_loader_seed:int,
-             local_rank:int, context_length:int)->Tuple[DataLoader,DataLoader, Optional[DataLoader]]:
+             context_length:int)->Tuple[DataLoader,DataLoader, Optional[DataLoader]]:
     tokenizer = get_tokenizer_factory(prime)()
 
     inputs, labels = operation_mod_p_data(operation, prime, tokenizer)
@@ -68,10 +69,14 @@ def get_data(operation: str, prime: int, training_fraction: float, val_fraction:
         val_size = len(dataset) - train_size
         test_size = 0
 
+    # global RNG is seeded differently on each rank, split must be same on all ranks
     train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(dataset,
-                                                               [train_size, val_size, test_size])
+                                                               [train_size, val_size, test_size],
+                                                               generator=torch.Generator().manual_seed(data_loader_seed))
 
-    train_loader_seed, val_loader_seed, test_loader_seed = data_loader_seed+local_rank, data_loader_seed+local_rank + 1, data_loader_seed+local_rank + 2
+    # ranks in same tensor or pipeline parallel group must get same data
+    dp_rank = utils.get_data_parallel_rank()
+    train_loader_seed, val_loader_seed, test_loader_seed = data_loader_seed+dp_rank, data_loader_seed+dp_rank + 1, data_loader_seed+dp_rank + 2
 
     train_loader_gen = torch.Generator().manual_seed(train_loader_seed)
     val_loader_gen = torch.Generator().manual_seed(val_loader_seed)
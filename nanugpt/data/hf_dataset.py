@@ -180,7 +180,7 @@ def get_data(hf_name_path:str, hf_dataset_name:Optional[str], hf_data_dir:Option
              train_split:Optional[str], val_split:Optional[str], test_split:Optional[str], hf_cache_dir:Optional[str],
              train_fraction:Optional[float], val_fraction:Optional[float], test_fraction:Optional[float],
              device_batch_size: int, eval_batch_size:int, data_loader_seed:int, text_column:str,
-             local_rank:int, context_length:int, tokenizer_factory:Callable[[], TokenizerBase])->Tuple[DataLoader,DataLoader, Optional[DataLoader]]:
+             context_length:int, tokenizer_factory:Callable[[], TokenizerBase])->Tuple[DataLoader,DataLoader, Optional[DataLoader]]:
 
     dataset = get_datasets(hf_name_path=hf_name_path, hf_dataset_name=hf_dataset_name, hf_data_dir=hf_data_dir, hf_data_files=hf_data_files, hf_revision=hf_revision,
                            train_split=train_split, val_split=val_split, test_split=test_split, hf_cache_dir=hf_cache_dir,
@@ -197,7 +197,8 @@ def get_data(hf_name_path:str, hf_dataset_name:Optional[str], hf_data_dir:Option
     if train_dataset is not None:
         train_tokenizer = tokenizer_factory()
         train_dataset.set_transform(lambda x: train_tokenizer.batch_encode(x[text_column]))
-        train_loader_gen = torch.Generator().manual_seed(data_loader_seed)
+        # each data parallel rank shuffles differently, ranks in same tensor or pipeline parallel group must get same data
+        train_loader_gen = torch.Generator().manual_seed(data_loader_seed + utils.get_data_parallel_rank())
         train_loader = DataLoader(train_dataset,
                                   batch_size=min(device_batch_size, len(train_dataset)),
                                   shuffle=True,
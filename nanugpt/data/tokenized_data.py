@@ -76,7 +76,7 @@ class MemmapDataloader:
             Getting random sequences is expensive. So, we should get continuous sequences.
     """
     def __init__(self, memmap_dataset:MemmapDataset, batch_size:int,
-                 seed:int, shuffle:bool, start_seq_index:int=0):
+                 seed:int, shuffle:bool, start_seq_index:int=0, num_shards:int=1):
         self.dataset = memmap_dataset
 
         # random generator for shuffling
@@ -85,13 +85,17 @@ class MemmapDataloader:
         self.n_seqs = len(self.dataset)
 
         self.batch_size = batch_size
+        self.num_shards = num_shards
         # how many batches will we return in one epochs (last batch may get wrapped around)
-        self.batch_count = math.ceil(float(self.n_seqs)/self.batch_size/self.dataset.context_length)
+        # with num_shards data parallel ranks each reading its own shard, epoch is one shard
+        self.batch_count = math.ceil(float(self.n_seqs)/num_shards/self.batch_size/self.dataset.context_length)
         self.batch_index = 0
 
         assert start_seq_index < self.n_seqs-1, "start_seq_index must be 1 less than number of sequences"
         assert start_seq_index == 0 or not shuffle, "start_seq_index must be 0 if shuffle is on"
+        self.start_seq_index = start_seq_index
         self.idx = start_seq_index # index of sequence to start with
+        self.tokens_read = 0 # since start_seq_index, used to re-shard when world size changes
 
         # add 1 for shifted y sequence
         self.dataset.set_seq_len(batch_size * self.dataset.context_length + 1)
@@ -123,12 +127,57 @@ class MemmapDataloader:
 
         self.idx = (self.idx + x.numel()) % self.dataset.token_count()
         self.batch_index += 1
+        self.tokens_read += x.numel()
 
         return x, y
 
     def __len__(self):
         return self.batch_count
 
+    def state_dict(self)->dict:
+        # enough to continue returning exactly the same batches after restart
+        return {'idx': self.idx, 'batch_index': self.batch_index,
+                'rand_gen': self.rand_gen.get_state(), 'tokens_read': self.tokens_read}
+
+    def load_state_dict(self, state_dict:dict):
+        self.idx = state_dict['idx']
+        self.batch_index = state_dict['batch_index']
+        self.rand_gen.set_state(state_dict['rand_gen'])
+        self.tokens_read = state_dict.get('tokens_read', 0)
+
+    def seek(self, tokens_read:int)->int:
+        """Moves to position as if tokens_read tokens were read from start, returns epoch at that position.
+
+        Used when data is re-sharded for different world size. With shuffle on, only epoch
+        position is restored as generator state can't be split across ranks.
+        """
+        batches_read = tokens_read // (self.batch_size * self.dataset.context_length)
+        self.idx = (self.start_seq_index + tokens_read) % self.dataset.token_count()
+        self.batch_index = batches_read % self.batch_count
+        self.tokens_read = tokens_read
+        return batches_read // self.batch_count
+
+    def reread_after_reshard(self, old_num_shards:int, old_tokens_read:int)->int:
+        """Tokens of current epoch that ranks read before re-sharding from old_num_shards and this
+        rank will read again before the epoch ends, call after seek().
+
+        seek() keeps the fraction of epoch read but one sequential reader per rank can't skip
+        ranges other ranks already read, so re-sharded position is only approximate.
+        """
+        token_count = self.dataset.token_count()
+        def shard_ranges(num_shards:int, tokens_read:int):
+            # (start, end of read part, end) of each shard in current epoch
+            offsets = [token_count * r // num_shards for r in range(num_shards+1)]
+            return [(start, start + tokens_read % (end - start), end) for start, end in zip(offsets[:-1], offsets[1:])]
+        _, pos, end = next(s for s in shard_ranges(self.num_shards, self.tokens_read) \
+                           if s[0] <= self.start_seq_index < s[2])
+        return sum(max(0, min(end, old_pos) - max(pos, old_start)) \
+                   for old_start, old_pos, _ in shard_ranges(old_num_shards, old_tokens_read))
+
+def shard_offset(dataset:MemmapDataset, rank:int, world_size:int)->int:
+    # loader wraps around token count, so shards must split tokens, not sequences
+    return min(dataset.token_count() * rank // world_size, len(dataset)-2)
+
 def get_data(context_length:int, dtype,
              device_batch_size:int, eval_batch_size:int,
              data_loader_seed:int,
@@ -136,10 +185,11 @@ def get_data(context_length:int, dtype,
              tokenized_test_path=None,
              shuffle=False,):
 
-    world_size = utils.get_world_size()
-    global_rank = utils.get_global_rank()
+    # ranks in same tensor parallel group must get same data
+    dp_world_size = utils.get_data_parallel_world_size()
+    dp_rank = utils.get_data_parallel_rank()
     local_world_size = utils.get_local_world_size()
-    assert world_size > 0 and global_rank >= 0 and global_rank < world_size and local_world_size >= 1, f"Invalid values: Word size={world_size}, global rank={global_rank}, local world size={local_world_size}"
+    assert dp_world_size > 0 and dp_rank >= 0 and dp_rank < dp_world_size and local_world_size >= 1, f"Invalid values: data parallel world size={dp_world_size}, data parallel rank={dp_rank}, local world size={local_world_size}"
 
     train_file_size = val_file_size = test_file_size = 0
     if tokenized_train_path:
@@ -180,21 +230,23 @@ def get_data(context_length:int, dtype,
                                     context_length) if tokenized_test_path else None
 
 
-    train_offset = int((len(train_dataset)-1) * float(global_rank) / world_size) \
-                if not shuffle else 0
-    val_offset = int((len(val_dataset)-1) * float(global_rank) / world_size) \
-                if not shuffle else 0
-    test_offset = int((len(test_dataset)-1) * float(global_rank) / world_size) \
+    # each data parallel rank starts at beginning of its shard, shards are token ranges of
+    # equal size so ranks stay in disjoint ranges as they read at same rate and wrap around
+    train_offset = shard_offset(train_dataset, dp_rank, dp_world_size) if not shuffle else 0
+    val_offset = shard_offset(val_dataset, dp_rank, dp_world_size) if not shuffle else 0
+    test_offset = shard_offset(test_dataset, dp_rank, dp_world_size) \
                 if test_dataset and not shuffle else 0
 
 
+    # train epoch is one pass over data by all ranks together, eval already splits its
+    # iterations between ranks
     return MemmapDataloader(train_dataset, device_batch_size,
-                            start_seq_index=train_offset,
-                            seed=data_loader_seed+global_rank, shuffle=shuffle), \
+                            start_seq_index=train_offset, num_shards=dp_world_size,
+                            seed=data_loader_seed+dp_rank, shuffle=shuffle), \
             MemmapDataloader(val_dataset, eval_batch_size,
                             start_seq_index=val_offset,
-                            seed=data_loader_seed+global_rank, shuffle=shuffle), \
+                            seed=data_loader_seed+dp_rank, shuffle=shuffle), \
             MemmapDataloader(test_dataset, eval_batch_size,
                             start_seq_index=test_offset,
-                            seed=data_loader_seed+global_rank, shuffle=shuffle) if test_dataset else None
+                            seed=data_loader_seed+dp_rank, shuffle=shuffle) if test_dataset else None
 
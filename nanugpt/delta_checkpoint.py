@@ -0,0 +1,208 @@
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+import hashlib
+import os
+import zlib
+
+import numpy as np
+import torch
+
+from nanugpt import utils
+
+"""
+Incremental checkpoints where most checkpoints are stored as compressed deltas
+against the last full snapshot.
+
+Each tensor in the checkpoint is split into fixed size chunks of raw bytes. In a full
+snapshot the chunk bytes are stored as is, in a delta checkpoint we store XOR of the
+chunk with the same chunk of the last full snapshot. Weights and optimizer state
+change slowly between checkpoints so sign, exponent and high mantissa bits mostly
+cancel out and XOR compresses better than raw floats. Before compressing, bytes are
+shuffled so the same byte of each element is together (as in blosc) which makes
+these runs of zeros contiguous. Deltas are lossless so resume is exact.
+
+Chunks are stored zlib-compressed in content addressed objects dir keyed by hash of
+the chunk payload, so identical chunks (unchanged tensors, all-zero deltas etc.) are
+stored only once:
+    out_dir/
+        objects/ab/ab12...     # compressed chunk payloads
+        checkpoint_100.pt      # manifest: checkpoint dict with tensors replaced by chunk lists
+
+Every chunk record in a manifest has the hash of base chunk and of the delta (if any)
+so any checkpoint can be reconstructed on its own without the manifest of its base,
+and retention can delete manifests freely. Objects not referenced by any manifest
+are garbage collected when a manifest is deleted.
+
+The writer keeps raw bytes of the last full snapshot in host memory to compute
+deltas. After a restart the first checkpoint is always a full snapshot.
+"""
+
+OBJECTS_DIRNAME = 'objects'
+MANIFEST_FORMAT = 'delta'
+
+def _tensor_bytes(t:torch.Tensor)->np.ndarray:
+    return t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+
+def _to_skeleton(obj:Any, key:str, tensors:Dict[str, torch.Tensor])->Any:
+    # replace tensors with placeholders, collect them in tensors dict
+    if isinstance(obj, torch.Tensor):
+        tensors[key] = obj
+        return {'__tensor__': key}
+    if isinstance(obj, Mapping):
+        return {k: _to_skeleton(v, f'{key}/{k}', tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_skeleton(v, f'{key}/{i}', tensors) for i, v in enumerate(obj))
+    return obj
+
+def _from_skeleton(obj:Any, tensors:Mapping[str, torch.Tensor])->Any:
+    if isinstance(obj, Mapping):
+        if set(obj.keys()) == {'__tensor__'}:
+            return tensors[obj['__tensor__']]
+        return {k: _from_skeleton(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_from_skeleton(v, tensors) for v in obj)
+    return obj
+
+def _shuffle(payload:np.ndarray, itemsize:int)->np.ndarray:
+    # group byte i of all elements together
+    return payload.reshape(-1, itemsize).T.copy() if itemsize > 1 else payload
+
+def _unshuffle(data:np.ndarray, itemsize:int)->np.ndarray:
+    return data.reshape(itemsize, -1).T.reshape(-1) if itemsize > 1 else data
+
+def _object_path(objects_dir:str, h:str)->str:
+    return os.path.join(objects_dir, h[:2], h)
+
+def is_manifest(checkpoint:Any)->bool:
+    return isinstance(checkpoint, Mapping) and checkpoint.get('format', None) == MANIFEST_FORMAT
+
+def manifest_hashes(manifest:Mapping)->Set[str]:
+    hashes = set()
+    for tensor_info in manifest['tensors'].values():
+        for base_hash, delta_hash in tensor_info['chunks']:
+            hashes.add(base_hash)
+            if delta_hash is not None:
+                hashes.add(delta_hash)
+    return hashes
+
+
+class DeltaCheckpointWriter:
+    """Writer for AsyncCheckpointer that stores full snapshot every `full_every` checkpoints and deltas in between."""
+    def __init__(self, full_every:int=10, chunk_size:int=2**20, compress_level:int=1):
+        self.full_every = full_every
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+
+        # raw bytes and chunk hashes of tensors in last full snapshot
+        self._base:Dict[str, np.ndarray] = {}
+        self._base_hashes:Dict[str, List[str]] = {}
+        self._since_full = 0
+
+        self.last_is_full = False
+
+    def _put(self, objects_dir:str, payload:np.ndarray, itemsize:int)->Tuple[str, int]:
+        # stored bytes depend on itemsize due to shuffle so it's part of the key
+        hasher = hashlib.blake2b(payload, digest_size=20)
+        hasher.update(bytes([itemsize]))
+        h = hasher.hexdigest()
+        filepath = _object_path(objects_dir, h)
+        if os.path.isfile(filepath):
+            return h, 0 # dedup
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        data = zlib.compress(_shuffle(payload, itemsize), self.compress_level)
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+        return h, len(data)
+
+    def save(self, checkpoint:Mapping, filepath:str)->int:
+        """Writes objects and manifest at filepath, returns bytes written."""
+        objects_dir = os.path.join(os.path.dirname(filepath), OBJECTS_DIRNAME)
+        is_full = not self._base or self._since_full + 1 >= self.full_every
+
+        tensors:Dict[str, torch.Tensor] = {}
+        skeleton = _to_skeleton(checkpoint, '', tensors)
+
+        bytes_written = 0
+        tensor_infos, base, base_hashes = {}, {}, {}
+        for key, t in tensors.items():
+            raw = _tensor_bytes(t)
+            base_raw = self._base.get(key, None)
+            # new or resized tensors are stored as is even in delta checkpoints
+            use_base = not is_full and base_raw is not None and base_raw.shape == raw.shape
+            chunks:List[Tuple[str, Optional[str]]] = []
+            for i, start in enumerate(range(0, len(raw), self.chunk_size)):
+                chunk = raw[start:start+self.chunk_size]
+                if use_base:
+                    delta = np.bitwise_xor(chunk, base_raw[start:start+self.chunk_size]) # type: ignore
+                    h, n = self._put(objects_dir, delta, t.element_size())
+                    chunks.append((self._base_hashes[key][i], h))
+                else:
+                    h, n = self._put(objects_dir, chunk, t.element_size())
+                    chunks.append((h, None))
+                bytes_written += n
+            tensor_infos[key] = {'dtype': str(t.dtype).split('.')[-1],
+                                 'shape': list(t.shape), 'chunks': chunks}
+            if is_full:
+                # raw is a view of reused host buffer so we need a copy
+                base[key] = raw.copy()
+                base_hashes[key] = [c[0] for c in chunks]
+
+        torch.save({'format': MANIFEST_FORMAT, 'is_full': is_full,
+                    'chunk_size': self.chunk_size,
+                    'skeleton': skeleton, 'tensors': tensor_infos}, filepath)
+        bytes_written += os.path.getsize(filepath)
+
+        if is_full:
+            self._base, self._base_hashes, self._since_full = base, base_hashes, 0
+        else:
+            self._since_full += 1
+        self.last_is_full = is_full
+        return bytes_written
+
+    def delete(self, filepath:str):
+        utils.delete_file(filepath)
+        self.collect_garbage(os.path.dirname(filepath))
+
+    def collect_garbage(self, out_dir:str):
+        """Deletes objects not referenced by any manifest in out_dir or by current base snapshot."""
+        objects_dir = os.path.join(out_dir, OBJECTS_DIRNAME)
+        if not os.path.isdir(objects_dir):
+            return
+        referenced = set(h for hashes in self._base_hashes.values() for h in hashes)
+        for filename in os.listdir(out_dir):
+            if filename.endswith('.pt'):
+                # mmap avoids reading regular checkpoints that may be in the same dir
+                manifest = torch.load(os.path.join(out_dir, filename), map_location='cpu',
+                                      weights_only=True, mmap=True)
+                if is_manifest(manifest):
+                    referenced.update(manifest_hashes(manifest))
+        for dirpath, _, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if filename not in referenced and not filename.endswith('.tmp'):
+                    os.remove(os.path.join(dirpath, filename))
+
+
+def _read_object(objects_dir:str, h:str, itemsize:int)->np.ndarray:
+    with open(_object_path(objects_dir, h), 'rb') as f:
+        return _unshuffle(np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8), itemsize)
+
+def reconstruct(manifest:Mapping, out_dir:str)->Dict[str, Any]:
+    """Rebuilds checkpoint dict from manifest and objects stored in out_dir."""
+    objects_dir = os.path.join(out_dir, OBJECTS_DIRNAME)
+    tensors = {}
+    for key, tensor_info in manifest['tensors'].items():
+        dtype = getattr(torch, tensor_info['dtype'])
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        parts = []
+        for base_hash, delta_hash in tensor_info['chunks']:
+            chunk = _read_object(objects_dir, base_hash, itemsize)
+            if delta_hash is not None:
+                chunk = np.bitwise_xor(chunk, _read_object(objects_dir, delta_hash, itemsize))
+            parts.append(chunk)
+        if parts:
+            raw = np.concatenate(parts)
+            tensors[key] = torch.from_numpy(raw).view(dtype).reshape(tensor_info['shape'])
+        else:
+            tensors[key] = torch.empty(tensor_info['shape'], dtype=dtype)
+    return _from_skeleton(manifest['skeleton'], tensors)
@@ -0,0 +1,198 @@
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+from collections import defaultdict
+from contextlib import AbstractContextManager
+import re
+import timeit
+import warnings
+
+import psutil
+import torch
+from torch import nn
+
+"""
+Per-module FLOPs, time and MFU report for one fwd+bwd pass, so we know whether attention,
+MLP, lm_head or loss is where the time goes and how far each is from hardware peak.
+
+FLOPs are counted with torch.utils.flop_counter (matmuls, convs and attention only, so
+elementwise ops are ~0 FLOPs). Loss is ~0 FLOPs too unless model uses fused_lm_head_loss,
+in which case lm_head matmuls run inside the loss and are reported under it. Time is measured with forward and backward hooks
+on report units: modules directly under model or under repeated blocks (items of
+ModuleList), e.g. transformer.h.*.attn. Units of all repeated blocks are summed under one
+name. Loss is timed separately and 'other' is whatever step time is not covered by units,
+e.g. residual adds.
+
+Hooks synchronize the device so this is for an occasional report, not every step.
+Compiled models are reported for their eager version.
+"""
+
+# dense (no sparsity) peak FLOPs/s per device, first matching substring of device name wins
+PEAK_FLOPS:List[Tuple[str, Dict[str, float]]] = [
+    ('GH200', {'bfloat16': 989e12, 'float16': 989e12, 'tf32': 495e12, 'float32': 67e12}),
+    ('H200', {'bfloat16': 989e12, 'float16': 989e12, 'tf32': 495e12, 'float32': 67e12}),
+    ('H100 PCIe', {'bfloat16': 756e12, 'float16': 756e12, 'tf32': 378e12, 'float32': 51e12}),
+    ('H100', {'bfloat16': 989e12, 'float16': 989e12, 'tf32': 495e12, 'float32': 67e12}),
+    ('A100', {'bfloat16': 312e12, 'float16': 312e12, 'tf32': 156e12, 'float32': 19.5e12}),
+    ('L4', {'bfloat16': 121e12, 'float16': 121e12, 'tf32': 60e12, 'float32': 30.3e12}),
+    ('V100', {'float16': 125e12, 'float32': 15.7e12}),
+    ('RTX 4090', {'bfloat16': 165e12, 'float16': 165e12, 'tf32': 82.6e12, 'float32': 82.6e12}),
+    ('RTX 3090', {'bfloat16': 71e12, 'float16': 71e12, 'tf32': 35.6e12, 'float32': 35.6e12}),
+    ('MI300X', {'bfloat16': 1307e12, 'float16': 1307e12, 'tf32': 654e12, 'float32': 163e12}),
+]
+
+# fp32 FLOPs per cycle per core: 2 FMA units x SIMD lanes x 2 FLOPs per FMA
+CPU_FLOPS_PER_CYCLE = {'AVX512': 64, 'AVX2': 32}
+
+def cpu_peak_flops()->float:
+    """Theoretical fp32 peak of cores used by torch, this is optimistic as clocks drop under AVX load."""
+    freq = psutil.cpu_freq()
+    mhz = (freq.max or freq.current) if freq is not None else 2000.0
+    flops_per_cycle = CPU_FLOPS_PER_CYCLE.get(torch.backends.cpu.get_cpu_capability(), 16)
+    return torch.get_num_threads() * mhz * 1e6 * flops_per_cycle
+
+def get_peak_flops(device:torch.device, dtype:torch.dtype)->Optional[float]:
+    """Peak FLOPs/s of one device for dtype, None if device is not known."""
+    if device.type == 'cpu':
+        return cpu_peak_flops()
+    if device.type != 'cuda':
+        return None
+    dtype_name = str(dtype).replace('torch.', '')
+    if dtype == torch.float32 and torch.backends.cuda.matmul.allow_tf32:
+        dtype_name = 'tf32'
+    device_name = torch.cuda.get_device_name(device)
+    for name, peaks in PEAK_FLOPS:
+        if name in device_name:
+            return peaks.get(dtype_name, None)
+    return None
+
+def report_units(model:nn.Module)->List[Tuple[str, nn.Module]]:
+    """Modules to report, with index of repeated blocks replaced by *."""
+    units = []
+    def visit(prefix:str, module:nn.Module, is_block:bool):
+        for name, child in module.named_children():
+            full_name = prefix + name
+            if isinstance(child, (nn.ModuleList, nn.ModuleDict, nn.Sequential)):
+                visit(full_name + '.', child, isinstance(child, nn.ModuleList))
+            elif is_block:
+                visit(full_name + '.', child, False)
+            else:
+                units.append((re.sub(r'\.\d+\.', '.*.', full_name), child))
+    visit('', model, False)
+    return units
+
+class _UnitHooks:
+    def __init__(self, units:List[Tuple[str, nn.Module]], sync:Callable[[], None]):
+        self.sync = sync
+        self.times:Dict[Tuple[str, str], float] = defaultdict(float) # (name, 'fwd'|'bwd') -> seconds
+        self.flops:Dict[str, int] = defaultdict(int)
+        self.counter = None # FlopCounterMode while counting
+        self._starts:Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self.handles = []
+        for name, module in units:
+            self.handles += [
+                module.register_forward_pre_hook(lambda *args, name=name: self.begin(name, 'fwd')),
+                module.register_forward_hook(lambda *args, name=name: self.end(name, 'fwd')),
+                module.register_full_backward_pre_hook(lambda *args, name=name: self.begin(name, 'bwd')),
+                module.register_full_backward_hook(lambda *args, name=name: self.end(name, 'bwd')),
+            ]
+
+    def total_flops(self)->int:
+        return self.counter.get_total_flops() if self.counter is not None else 0
+
+    def begin(self, name:str, phase:str):
+        self.sync()
+        self._starts[(name, phase)] = (timeit.default_timer(), self.total_flops())
+
+    def end(self, name:str, phase:str):
+        self.sync()
+        start_time, start_flops = self._starts.pop((name, phase))
+        self.times[(name, phase)] += timeit.default_timer() - start_time
+        self.flops[name] += self.total_flops() - start_flops
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+def module_report(model:nn.Module, get_loss:Callable, x:torch.Tensor, y:torch.Tensor,
+                  amp_ctx:AbstractContextManager, peak_flops:Optional[float],
+                  iters:int=3)->Tuple[Dict[str, float], str]:
+    """Runs fwd+bwd on x, y and returns metrics and a table of per-unit FLOPs, time and efficiency.
+    Grads of model are set to None afterwards."""
+    from torch.utils.flop_counter import FlopCounterMode # pulls in triton, so imported only when used
+
+    model = getattr(model, '_orig_mod', model) # unwrap torch.compile
+    sync = torch.cuda.synchronize if x.is_cuda else (lambda: None)
+    hooks = _UnitHooks(report_units(model), sync)
+    loss_times = {'fwd': 0.0, 'bwd': 0.0}
+    loss_flops = {'fwd': 0, 'bwd': 0}
+    step_times = {'fwd': 0.0, 'bwd': 0.0}
+
+    def fwd_bwd():
+        sync()
+        start_time = timeit.default_timer()
+        with amp_ctx:
+            output = model(x)
+            sync()
+            loss_start_time, loss_start_flops = timeit.default_timer(), hooks.total_flops()
+            loss, *_ = get_loss(output, y)
+            sync()
+        fwd_end_time, fwd_end_flops = timeit.default_timer(), hooks.total_flops()
+        loss_times['fwd'] += fwd_end_time - loss_start_time
+        loss_flops['fwd'] += fwd_end_flops - loss_start_flops
+        step_times['fwd'] += fwd_end_time - start_time
+
+        # loss backward ends when grad of logits (or hidden states with fused lm_head loss) is ready
+        logits = output.get('logits', output.get('hidden')) if isinstance(output, Mapping) else output
+        loss_bwd_end = []
+        def on_logits_grad(grad):
+            sync()
+            loss_bwd_end.append(timeit.default_timer())
+            loss_flops['bwd'] += hooks.total_flops() - fwd_end_flops
+        logits.register_hook(on_logits_grad)
+        with warnings.catch_warnings():
+            # embeddings have no inputs requiring grad so their backward hooks fire on output grads, which is fine here
+            warnings.filterwarnings('ignore', message='Full backward hook is firing')
+            loss.backward()
+        sync()
+        loss_times['bwd'] += loss_bwd_end[0] - fwd_end_time
+        step_times['bwd'] += timeit.default_timer() - fwd_end_time
+        model.zero_grad(set_to_none=True)
+
+    try:
+        # count FLOPs in warmup pass as counting slows things down
+        with FlopCounterMode(display=False) as counter:
+            hooks.counter = counter
+            fwd_bwd()
+        hooks.counter = None
+        total_flops = counter.get_total_flops()
+
+        hooks.times.clear()
+        for k in loss_times:
+            loss_times[k] = step_times[k] = 0.0
+        for _ in range(iters):
+            fwd_bwd()
+    finally:
+        hooks.remove()
+
+    rows = [(name, hooks.flops[name], hooks.times[(name, 'fwd')] / iters, hooks.times[(name, 'bwd')] / iters)
+            for name in hooks.flops]
+    rows.append(('loss', loss_flops['fwd'] + loss_flops['bwd'], loss_times['fwd'] / iters, loss_times['bwd'] / iters))
+    rows.append(('other', total_flops - sum(r[1] for r in rows),
+                 step_times['fwd'] / iters - sum(r[2] for r in rows),
+                 step_times['bwd'] / iters - sum(r[3] for r in rows)))
+    step_time = (step_times['fwd'] + step_times['bwd']) / iters
+
+    metrics:Dict[str, float] = {'flops/step_flops': float(total_flops), 'flops/step_time': step_time}
+    lines = [f'{"module":<32} {"GFLOPs":>10} {"flops%":>7} {"fwd ms":>9} {"bwd ms":>9} {"time%":>7} {"TFLOP/s":>9} {"eff%":>6}']
+    for name, flops, fwd_time, bwd_time in rows + [('total', total_flops, step_times['fwd'] / iters, step_times['bwd'] / iters)]:
+        time = fwd_time + bwd_time
+        flops_per_sec = flops / time if time > 0 else 0.0
+        efficiency = flops_per_sec / peak_flops if peak_flops else float('nan')
+        metrics.update({f'flops/{name}/flops_frac': flops / max(total_flops, 1),
+                        f'flops/{name}/time_frac': time / step_time,
+                        f'flops/{name}/efficiency': efficiency})
+        lines.append(f'{name:<32} {flops/1e9:>10.3f} {flops/max(total_flops, 1):>7.1%} {fwd_time*1e3:>9.2f} '
+                     f'{bwd_time*1e3:>9.2f} {time/step_time:>7.1%} {flops_per_sec/1e12:>9.3f} {efficiency:>6.1%}')
+    metrics['flops/mfu'] = metrics['flops/total/efficiency']
+    lines.append(f'peak FLOPs/s: {peak_flops or "unknown"}')
+
+    return metrics, '\n'.join(lines)
@@ -0,0 +1,125 @@
+from typing import Any, Dict, Mapping, Tuple
+
+import torch
+from torch import distributed as dist
+from torch.distributed.device_mesh import init_device_mesh
+try:
+    from torch.distributed.fsdp import fully_shard, MixedPrecisionPolicy, CPUOffloadPolicy, OffloadPolicy
+except ImportError: # torch < 2.6
+    from torch.distributed._composable.fsdp import fully_shard, MixedPrecisionPolicy, CPUOffloadPolicy, OffloadPolicy # type: ignore
+from torch.distributed.checkpoint.state_dict import get_model_state_dict, get_optimizer_state_dict, \
+    set_model_state_dict, set_optimizer_state_dict, StateDictOptions
+
+from nanugpt import utils
+
+"""
+Fully sharded data parallel training using FSDP2 (`fully_shard`).
+
+Unlike DDP, where each rank has full replica of params, grads and optimizer state,
+FSDP shards all three across ranks. Each transformer block is its own FSDP unit: its
+params are all-gathered just before its forward/backward and grads are reduce-scattered
+right after its backward so only one block is unsharded at a time (plus prefetch).
+Remaining params (embeddings, final norm, lm_head) are in the root unit.
+
+Params become DTensors so optimizer must be created after apply_fsdp().
+
+Checkpoints use the same full (unsharded) state dict format as DDP/single device
+runs so they are interchangeable: model state is keyed by param name and optimizer
+state is keyed by param index in param_groups as torch.optim.Optimizer.state_dict()
+does. Gathering full state is collective and result is only on rank 0.
+"""
+
+def _blocks(model:torch.nn.Module)->torch.nn.ModuleList:
+    # all our GPT style models keep blocks in transformer.h
+    transformer = getattr(model, 'transformer', None)
+    blocks = getattr(transformer, 'h', None) if transformer is not None else None
+    if blocks is None:
+        raise ValueError(f'FSDP requires model with transformer blocks in model.transformer.h but {type(model)} has none')
+    return blocks
+
+def apply_fsdp(model:torch.nn.Module, torch_info:utils.TorchInfo,
+               param_dtype:str, reduce_dtype:str,
+               reshard_after_forward:bool, cpu_offload:bool)->torch.nn.Module:
+    """Shards model in-place across all ranks and returns it.
+
+    param_dtype: dtype params are cast to for forward/backward compute, '' keeps param dtype.
+    reduce_dtype: dtype for gradient reduce-scatter, '' uses param_dtype.
+    reshard_after_forward: if True, free unsharded block params after forward and
+        all-gather again in backward (less memory, more communication, ZeRO-3 like).
+        If False, keep them until backward (ZeRO-2 like).
+    cpu_offload: keep sharded params, grads and optimizer state in CPU memory.
+    """
+    # compiled model wraps the original in _orig_mod, we shard the original in-place
+    compiled_model, model = model, getattr(model, '_orig_mod', model)
+
+    # like DDP, start all ranks from rank 0's weights as init may not be seeded same on all ranks
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(t, src=0)
+
+    mesh = init_device_mesh(torch_info.device_type, (torch_info.world_size,))
+    mp_policy = MixedPrecisionPolicy(
+        param_dtype=getattr(torch, param_dtype) if param_dtype else None,
+        reduce_dtype=getattr(torch, reduce_dtype) if reduce_dtype else None)
+    offload_policy = CPUOffloadPolicy() if cpu_offload else OffloadPolicy()
+
+    for block in _blocks(model):
+        fully_shard(block, mesh=mesh, mp_policy=mp_policy,
+                    reshard_after_forward=reshard_after_forward,
+                    offload_policy=offload_policy)
+    # root params are needed right away in backward so don't reshard them
+    fully_shard(model, mesh=mesh, mp_policy=mp_policy,
+                reshard_after_forward=False, offload_policy=offload_policy)
+    return compiled_model
+
+def _param_names(model:torch.nn.Module)->Dict[torch.nn.Parameter, str]:
+    return {p: n for n, p in model.named_parameters()}
+
+def full_state_dicts(model:torch.nn.Module, optimizer)->Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Gathers full model and optimizer state dicts on rank 0, other ranks get empty dicts.
+
+    Must be called on all ranks.
+    """
+    model = getattr(model, '_orig_mod', model)
+    options = StateDictOptions(full_state_dict=True, cpu_offload=True)
+    model_state = get_model_state_dict(model, options=options)
+    # keyed by param name, convert to the usual param index keys
+    optim_state = get_optimizer_state_dict(model, optimizer, options=options)
+    if not optim_state:
+        return model_state, optim_state
+
+    state, param_groups, index = {}, [], 0
+    for group in optim_state['param_groups']:
+        indices = []
+        for name in group['params']:
+            if name in optim_state['state']:
+                state[index] = optim_state['state'][name]
+            indices.append(index)
+            index += 1
+        param_groups.append({**group, 'params': indices})
+    return model_state, {'state': state, 'param_groups': param_groups}
+
+def load_full_state_dicts(model:torch.nn.Module, optimizer,
+                          model_state:Mapping[str, Any], optim_state:Mapping[str, Any])->None:
+    """Loads full state dicts (as saved by DDP or full_state_dicts()) into sharded model and optimizer.
+
+    Must be called on all ranks with the same state dicts.
+    """
+    model = getattr(model, '_orig_mod', model)
+    options = StateDictOptions(full_state_dict=True)
+    unwanted_prefix = '_orig_mod.'
+    model_state = {(k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k):v \
+                   for k, v in model_state.items()}
+    set_model_state_dict(model, model_state, options=options)
+
+    # map param index keys back to names using current param groups which are built in same order
+    names = _param_names(model)
+    state, param_groups = {}, []
+    for group, saved_group in zip(optimizer.param_groups, optim_state['param_groups']):
+        group_names = [names[p] for p in group['params']]
+        for name, index in zip(group_names, saved_group['params']):
+            if index in optim_state['state']:
+                state[name] = optim_state['state'][index]
+        param_groups.append({**saved_group, 'params': group_names})
+    set_optimizer_state_dict(model, optimizer, {'state': state, 'param_groups': param_groups},
+                             options=options)
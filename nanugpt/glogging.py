@@ -8,12 +8,16 @@ import os
 import timeit
 import json
 import atexit
+import queue
+import threading
+import traceback
+import platform
+from functools import lru_cache
 
-from rich.logging import RichHandler
-import wandb
 import torch
 
 from nanugpt import utils
+from nanugpt.metrics_store import MetricsStore, STEP_COLUMN
 
 INFO=py_logging.INFO
 WARN=py_logging.WARN
@@ -43,6 +47,95 @@ def _fmt(val:Any)->str:
 def _dict2msg(d:Mapping[str,Any])->str:
     return ', '.join(f'{k}={_fmt(v)}' for k, v in d.items())
 
+@lru_cache(maxsize=None)
+def _cpu_name()->str:
+    # read once instead of shelling out to lscpu on every log_sys_info call
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    return platform.processor()
+
+def _materialize(d:Union[str, Mapping[str,Any]])->Union[str, Mapping[str,Any]]:
+    # copy with scalar tensors converted so queued records don't change or hold on to device memory
+    if isinstance(d, Mapping):
+        return {k: (v.item() if isinstance(v, torch.Tensor) and v.numel() == 1 else v) for k, v in d.items()}
+    return d
+
+class AsyncWriter:
+    """Runs logging calls on a background thread so training thread doesn't wait on console
+    rendering, file writes or wandb. Records are processed in order in batches of whatever
+    is queued. When queue is full, full_policy 'block' waits for space and 'drop' discards
+    droppable records (metrics) and counts them, other records always wait."""
+
+    def __init__(self, queue_size:int, full_policy:str='block',
+                 on_dropped:Optional[Callable[[int], None]]=None):
+        if full_policy not in ('block', 'drop'):
+            raise ValueError(f'Unknown full_policy {full_policy}, must be block or drop')
+        self.queue:queue.Queue = queue.Queue(maxsize=queue_size)
+        self.full_policy = full_policy
+        self.on_dropped = on_dropped
+        self.dropped, self.reported_dropped = 0, 0
+        self.thread = threading.Thread(target=self._run, name='glogging_writer', daemon=True)
+        self.thread.start()
+
+    def enqueue(self, fn:Callable, *args, droppable:bool=False)->bool:
+        """Queues call fn(*args), returns False if caller should run it directly."""
+        if threading.current_thread() is self.thread or not self.thread.is_alive():
+            return False
+        if droppable and self.full_policy == 'drop':
+            try:
+                self.queue.put_nowait((fn, args))
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put((fn, args))
+        return True
+
+    def _run(self):
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in records:
+                if record is None:
+                    stop = True
+                    continue
+                fn, args = record
+                try:
+                    fn(*args)
+                except Exception:
+                    # writer must survive bad records
+                    traceback.print_exc()
+            if self.dropped > self.reported_dropped and self.on_dropped is not None:
+                self.reported_dropped = self.dropped
+                try:
+                    self.on_dropped(self.dropped)
+                except Exception:
+                    # if writer dies, producers waiting for space in queue would deadlock
+                    traceback.print_exc()
+
+    def flush(self, timeout:Optional[float]=None)->bool:
+        """Waits until records queued so far are processed, returns False on timeout."""
+        if threading.current_thread() is self.thread or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self.queue.put((done.set, ()), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
 def create_py_logger(filepath:Optional[str]=None,
                     allow_overwrite_log:bool=False,
                     project_name:Optional[str]=None,
@@ -66,6 +159,8 @@ def create_py_logger(filepath:Optional[str]=None,
     logger.setLevel(min_level)
 
     if enable_stdout:
+        # rich is slow to import and not needed by processes that only write log file
+        from rich.logging import RichHandler
         ch = RichHandler(
             level = stdout_level,
             show_time = True,
@@ -104,6 +199,7 @@ std_metrics['default'] = [
                             {"name": "run/elapsed_hr", "step_metric":"train/step", "summary":"last"},
                             {"name": "run/eta_hr", "step_metric":"train/step", "summary":"last"},
                             {"name": "run/flops", "step_metric":"train/step", "summary":"last"},
+                            {"name": "run/mfu", "step_metric":"train/step", "summary":"last"},
                             {"name": "run/checkpoint_since_hr", "step_metric":"train/step", "summary":"last"},
                             {"name": "run/total_time_hr", "step_metric":"train/step", "summary":"last"},
                             {"name": "train/step", "step_metric":"run/elapsed_hr", "summary":"last"},
@@ -140,6 +236,7 @@ std_metrics['default'] = [
                             {"name": "val/iter_count", "step_metric":"train/step", "summary":"last"},
                             {"name": "val/time_s", "step_metric":"train/step", "summary":"last", "goal":"min"},
                             {"name": "run/checkpoint_time_s", "step_metric":"train/step", "summary":"last", "goal":"min"},
+                            {"name": "run/checkpoint_wait_s", "step_metric":"train/step", "summary":"last", "goal":"min"},
 
                             {"name": "test/loss", "step_metric":"train/step", "summary":"last", "goal":"min"},
                             {"name": "test/ppl", "step_metric":"train/step", "summary":"last", "goal":"min"},
@@ -164,6 +261,8 @@ def create_wandb_logger(project_name, run_name,
                         metrics:List[Dict[str, Any]],
                         description:Optional[str]=None):
 
+    import wandb # takes >1s so imported only when enabled
+
     wandb_host = os.environ.get('WANDB_HOST', None)
     wandb.login(host=wandb_host) # use API key from WANDB_API_KEY env variable
 
@@ -219,6 +318,10 @@ class Logger:
                  allow_overwrite_log=False,
                  summaries_stdout=True,
                  save_on_exit:bool=True,
+                 async_queue_size:int=0, # >0 logs from background thread, 0 logs on caller thread
+                 async_full_policy:str='block', # block or drop metrics when async queue is full
+                 metrics_dirname:Optional[str]=None, # dir in log_dir for columnar store of metrics
+                 metrics_flush_every:int=100,
                  ) -> None:
 
         global _logger, _except_handler_installed, \
@@ -241,6 +344,7 @@ class Logger:
         else:
             raise RuntimeError('Logger already initialized. Cannot create more than one logger.')
 
+        psutil.cpu_percent(interval=None) # start measuring so log_sys_info doesn't need to block
         self.global_rank = global_rank
         self.has_shutdown = False
         self.start_time = timeit.default_timer()
@@ -253,6 +357,8 @@ class Logger:
         self.summaries_filepath = None
         self.quite_keys:Optional[Set[str]] = None
         self.summaries = {}
+        self._writer:Optional[AsyncWriter] = None
+        self._metrics_store:Optional[MetricsStore] = None
 
         if log_dir:
             log_dir = utils.full_path(str(log_dir), create=True)
@@ -281,6 +387,12 @@ class Logger:
                                                     run_description)
             # else leave things to None
 
+            if log_dir and metrics_dirname:
+                self._metrics_store = MetricsStore(os.path.join(log_dir, metrics_dirname), metrics_flush_every)
+
+        if async_queue_size > 0:
+            self._writer = AsyncWriter(async_queue_size, async_full_policy, on_dropped=self._report_dropped)
+
         if save_on_exit and _logger == self:
             install_atexit()
 
@@ -294,13 +406,36 @@ class Logger:
             sys.excepthook = partial(handle_execpt, sys.excepthook, self)
             _except_handler_installed = True
 
+    def _report_dropped(self, n:int):
+        if self._py_logger is not None:
+            self._py_logger.warning(f'Dropped {n} log records as async log queue was full')
+
+    def resume_metrics(self, step:int):
+        """Keep metrics store of previous run up to step instead of replacing it."""
+        if self._writer is not None:
+            self._writer.flush() # store is written by writer thread
+        if self._metrics_store is not None:
+            self._metrics_store.resume(step)
+
     def log_config(self, config):
+        if self._writer is not None:
+            self._writer.flush() # config may change later so log it here, after earlier records
         if  self.summaries_stdout and self._py_logger is not None:
             self._py_logger.info(_dict2msg({'project_config': config}))
         if self.enable_wandb and self._wandb_logger is not None:
             self._wandb_logger.config.update(config)
 
     def info(self, d:Union[str, Mapping[str,Any]], py_logger_only:bool=False):
+        if self._writer is not None and \
+                self._writer.enqueue(self.info, _materialize(d), py_logger_only,
+                                     droppable=isinstance(d, Mapping)): # messages are never dropped
+            return
+
+        # only step metrics go to store, other mappings such as checkpoint info are in log
+        if not py_logger_only and self._metrics_store is not None and isinstance(d, Mapping) \
+                and STEP_COLUMN in d:
+            self._metrics_store.append(d)
+
         # if quite key is set and set is empoty then quite everything
         # if there are keys in quite then only allow messages with those keys
         if self.quite_keys is not None:
@@ -318,11 +453,18 @@ class Logger:
             if isinstance(d, str):
                 self._wandb_logger.log({'info': d})
             else:
-                wandb.log(d) # type: ignore
+                self._wandb_logger.log(d) # type: ignore
 
     def warn(self, d:Union[str, Mapping[str,Any]], py_logger_only:bool=False,
              exception_instance:Optional[Exception]=None, stack_info:bool=False):
 
+        if self._writer is not None:
+            if exception_instance is None and not stack_info:
+                if self._writer.enqueue(self.warn, _materialize(d), py_logger_only):
+                    return
+            else:
+                self._writer.flush() # stack must be of caller, so log here after earlier records
+
         if isinstance(d, Mapping):
             d = _dict2msg(d)
 
@@ -339,6 +481,11 @@ class Logger:
     def error(self, d:Union[str, Mapping[str,Any]], py_logger_only:bool=False,
               exception_instance:Optional[Exception]=None, stack_info:bool=True):
 
+        if self._writer is not None:
+            # log errors right away as process may be about to die, but after earlier records
+            # unless writer is stuck, e.g., on wandb
+            self._writer.flush(timeout=10.0)
+
         if isinstance(d, Mapping):
             d = _dict2msg(d)
 
@@ -354,6 +501,12 @@ class Logger:
     def summary(self, d:Mapping[str,Any], py_logger_only:bool=False):
         self.summaries.update(d)
 
+        if self._writer is not None and \
+                self._writer.enqueue(self._summary_write, _materialize(d), py_logger_only):
+            return
+        self._summary_write(d, py_logger_only)
+
+    def _summary_write(self, d:Mapping[str,Any], py_logger_only:bool):
         if self.summaries_stdout and self._py_logger is not None:
             self.info(d, py_logger_only=True)
 
@@ -363,10 +516,15 @@ class Logger:
         # else do nothing
 
     def log_artifact(self, name:str, type:str, file_or_dir:Optional[str], desc_markdown:Optional[str]=None, py_logger_only:bool=False):
+        if self._writer is not None and \
+                self._writer.enqueue(self.log_artifact, name, type, file_or_dir, desc_markdown, py_logger_only):
+            return
+
         if self._py_logger is not None:
             self._py_logger.info(f'Artifact {type} {name}: path={file_or_dir}, desc={desc_markdown}')
 
         if not py_logger_only and self.enable_wandb and self._wandb_logger is not None:
+            import wandb
             artifact = wandb.Artifact(name=name, type=type, description=desc_markdown)
             if file_or_dir:
                 if os.path.isdir(file_or_dir):
@@ -403,11 +561,11 @@ class Logger:
                         'sys/memory_gb': psutil.virtual_memory().available / (1024.0 ** 3),
                         'sys/cpu_count': psutil.cpu_count(),
                         'sys/cpu_freq': psutil.cpu_freq()._asdict(),
-                        'sys/cpu_percent': psutil.cpu_percent(interval=1),
+                        'sys/cpu_percent': psutil.cpu_percent(interval=None), # since last call, first call is in Logger()
                         'sys/cpu_stats': psutil.cpu_stats()._asdict(),
                         'sys/cpu_count_logical': psutil.cpu_count(logical=True),
                         'sys/cpu_count_physical': psutil.cpu_count(logical=False),
-                        'sys/cpu_name': os.popen('wmic cpu get name').read().strip().split('\n')[1] if os.name == 'nt' else os.popen('lscpu | grep "Model name"').read().strip().split(':')[1].strip(),
+                        'sys/cpu_name': _cpu_name(),
                         'sys/utils.free_disk_space': utils.free_disk_space(),
 
                         'env/RANK': os.environ.get('RANK', None),
@@ -437,6 +595,11 @@ class Logger:
         if self.has_shutdown:
             return
 
+        # write out queued records, everything below is logged synchronously
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
         # log current exception
         try:
             if sys.exc_info()[0] is not None:
@@ -471,6 +634,8 @@ class Logger:
             self.log_artifact(name='log_file', type='file', file_or_dir=self.log_filepath)
 
         # close loggers
+        if self._metrics_store is not None:
+            self._metrics_store.close()
         if self._wandb_logger is not None:
             self._wandb_logger.finish()
         if self._py_logger is not None:
@@ -479,6 +644,8 @@ class Logger:
         self.has_shutdown = True
 
     def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
         if self._py_logger is not None:
             for handler in self._py_logger.handlers:
                 handler.flush()
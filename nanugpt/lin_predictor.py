@@ -1,29 +1,36 @@
 from typing import Tuple, Iterator, List, Dict, Callable, Union, Any, Optional
 import numpy as np
-import pandas as pd
-import scipy
-from scipy.optimize import curve_fit
-from scipy.stats import linregress
-from sklearn.linear_model import LinearRegression
 
-def fit(x, y)->LinearRegression:
-    xa = np.array(x).reshape(-1, 1)
-    ya = np.array(y)
+# Least squares line fit in numpy. This used to be sklearn's LinearRegression, which made
+# importing train pull in sklearn, scipy and pandas. LinearModel has the same coef_,
+# intercept_ and predict() so callers don't change.
 
-    model = LinearRegression().fit(xa, ya)
+class LinearModel:
+    def __init__(self, coef:float, intercept:float):
+        self.coef_ = np.array([coef])
+        self.intercept_ = intercept
 
-    # Coefficients (slope) and intercept
-    # slope = model.coef_[0]
-    # intercept = model.intercept_
+    def predict(self, xa): # xa->(n_samples, 1)
+        return np.asarray(xa, dtype=np.float64).reshape(-1) * self.coef_[0] + self.intercept_
+
+def fit(x, y)->LinearModel:
+    xa = np.array(x, dtype=np.float64).reshape(-1)
+    ya = np.array(y, dtype=np.float64).reshape(-1)
 
-    return model
+    x_mean, y_mean = xa.mean(), ya.mean()
+    x_var = np.sum((xa - x_mean) ** 2)
+    # with single point or all same x, line is flat like sklearn
+    slope = float(np.sum((xa - x_mean) * (ya - y_mean)) / x_var) if x_var > 0 else 0.0
+
+    # Coefficients (slope) and intercept
+    return LinearModel(slope, float(y_mean - slope * x_mean))
 
-def predict(model:LinearRegression, x): # x->(n_samples, n_features)
+def predict(model:LinearModel, x): # x->(n_samples, n_features)
     xa = np.array(x).reshape(-1, 1)
     return model.predict(xa)    # -> (n_samples,)
 
-def evaluate(model:LinearRegression, x, y):
+def evaluate(model:LinearModel, x, y):
     xa = np.array(x).reshape(-1, 1)
     y_pred = model.predict(xa)
     mae = np.mean(np.abs(y - y_pred))
-    return mae
\ No newline at end of file
+    return mae
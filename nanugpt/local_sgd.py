@@ -0,0 +1,98 @@
+from typing import Any, Dict, Mapping
+import timeit
+
+import torch
+from torch import distributed as dist
+from torch.distributed.device_mesh import init_device_mesh, DeviceMesh
+
+from nanugpt import utils
+
+"""
+Local SGD / DiLoCo style training: instead of syncing grads every step, each replica takes
+sync_every steps with its own (inner) optimizer and then replicas average how far their
+params moved. This cuts communication by sync_every times at the cost of replicas drifting
+apart between syncs.
+
+Replicas are groups of group_size contiguous ranks (e.g. a node) that stay in sync every
+step with DDP over the fast intra-group link. Only the outer sync goes over the slow link
+between groups, each rank averages with ranks at the same position in other groups:
+
+    mesh = (outer, inner)  # inner: DDP within group, outer: local SGD across groups
+
+At sync, the average of (global - local) params over replicas is treated as a grad
+(pseudo-gradient) for global params and applied with outer SGD optimizer, then all replicas
+start again from the new global params. With outer_lr=1 and outer_momentum=0 this is plain
+parameter averaging. DiLoCo uses Nesterov momentum, e.g., outer_lr=0.7 and outer_momentum=0.9.
+
+Checkpoints save global params as the model so they can be used as any other checkpoint,
+plus the outer optimizer state. On resume all replicas start from global params, i.e.,
+local progress since the last sync is dropped. Inner optimizer state is rank 0's.
+"""
+
+def init_mesh(torch_info:utils.TorchInfo, group_size:int)->DeviceMesh:
+    """Creates 2D (outer, inner) mesh, ranks of a group are contiguous."""
+    if group_size < 1 or torch_info.world_size % group_size != 0:
+        raise ValueError(f'local_sgd_group_size {group_size} must divide world size {torch_info.world_size}')
+    return init_device_mesh(torch_info.device_type, (torch_info.world_size // group_size, group_size),
+                            mesh_dim_names=('outer', 'inner'))
+
+class LocalSGD:
+    """Averages params of replicas every sync_every steps with outer optimizer.
+
+    model must not be wrapped in DDP over outer group, it can be wrapped over inner group.
+    """
+    def __init__(self, model:torch.nn.Module, outer_mesh:DeviceMesh, sync_every:int,
+                 outer_lr:float=1.0, outer_momentum:float=0.0):
+        if sync_every < 1:
+            raise ValueError(f'local_sgd_every {sync_every} must be at least 1')
+        self.group = outer_mesh.get_group()
+        self.sync_every = sync_every
+        self.params = [p for p in model.parameters() if p.requires_grad]
+
+        # like DDP, start all ranks from rank 0's weights as init may not be seeded same on all ranks
+        with torch.no_grad():
+            for t in list(model.parameters()) + list(model.buffers()):
+                dist.broadcast(t, src=0)
+
+        self.global_params = [p.detach().clone() for p in self.params]
+        self.outer_optimizer = torch.optim.SGD(self.global_params, lr=outer_lr,
+                                               momentum=outer_momentum, nesterov=outer_momentum > 0)
+        self.sync_time, self.sync_bytes = 0.0, 0
+
+    def step(self, step:int)->bool:
+        """Called after inner optimizer step, syncs if it's time and returns True if synced."""
+        if (step + 1) % self.sync_every != 0:
+            return False
+
+        start_time = timeit.default_timer()
+        with torch.no_grad():
+            # pseudo-gradient is how much replicas moved away from global params on average
+            deltas = torch._foreach_sub(self.global_params, self.params)
+            utils.all_reduce_mean_(deltas, self.group)
+            for g, delta in zip(self.global_params, deltas):
+                g.grad = delta
+            self.outer_optimizer.step()
+            self.outer_optimizer.zero_grad(set_to_none=True)
+            torch._foreach_copy_(self.params, self.global_params)
+        self.sync_time = timeit.default_timer() - start_time
+        self.sync_bytes = sum(d.numel() * d.element_size() for d in deltas)
+        return True
+
+    def model_state_dict(self, model:torch.nn.Module)->Dict[str, Any]:
+        """State dict of model with global params instead of local ones."""
+        global_params = {id(p): g for p, g in zip(self.params, self.global_params)}
+        # tied params have more than one name
+        names = {name: id(p) for name, p in model.named_parameters(remove_duplicate=False)}
+        return {k: global_params[names[k]].clone() if names.get(k) in global_params else v
+                for k, v in model.state_dict().items()}
+
+    def state_dict(self)->Dict[str, Any]:
+        return {'outer_optimizer': self.outer_optimizer.state_dict()}
+
+    def load_state_dict(self, state:Mapping[str, Any])->None:
+        """Loads outer optimizer state, model must already have global params loaded."""
+        with torch.no_grad():
+            torch._foreach_copy_(self.global_params, self.params)
+        # checkpoint of regular run has no outer optimizer state
+        if 'outer_optimizer' in state:
+            self.outer_optimizer.load_state_dict(state['outer_optimizer'])
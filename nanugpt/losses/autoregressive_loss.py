@@ -2,21 +2,91 @@ from typing import Tuple, Mapping
 
 import torch
 
-def get_loss(model_output, labels)->Tuple[torch.Tensor, torch.Tensor, int]:
+"""
+Cross entropy over next token predictions. Model output is either logits or, for models
+with fused_lm_head_loss, a mapping with final hidden states and lm_head weight. In the
+latter case logits are computed chunk_size tokens at a time and their gradients are
+computed right away in forward, so [batch*seq_len, vocab_size] logits and their grads are
+never resident at once. For GPT-2 vocab these are the largest activations of the model.
+"""
+
+class LinearCrossEntropy(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, hidden:torch.Tensor, weight:torch.Tensor, targets:torch.Tensor,
+                chunk_size:int, ignore_index:int, compute_accuracy:bool, compute_grads:bool):
+        # hidden: [n, n_embd], weight: [vocab_size, n_embd], targets: [n]
+        valid = targets != ignore_index
+        n_valid = valid.sum().clamp(min=1) # stays on device, no sync
+        loss_sum = torch.zeros((), dtype=torch.float32, device=hidden.device)
+        correct = torch.zeros((), dtype=torch.long, device=hidden.device)
+        grad_hidden = torch.empty_like(hidden) if compute_grads else None
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if compute_grads else None
+
+        for start in range(0, len(hidden), chunk_size):
+            h, t, v = hidden[start:start+chunk_size], targets[start:start+chunk_size], valid[start:start+chunk_size]
+            # matmul runs in autocast dtype if enabled, softmax in fp32 as cross_entropy does
+            logits = (h @ weight.t()).float() # [chunk, vocab_size]
+            lse = torch.logsumexp(logits, dim=-1)
+            t_safe = t.clamp(min=0)
+            target_logits = logits.gather(1, t_safe.unsqueeze(1)).squeeze(1)
+            loss_sum += ((lse - target_logits) * v).sum()
+            if compute_accuracy:
+                correct += ((torch.argmax(logits, dim=-1) == t) & v).sum()
+            if compute_grads:
+                # d(mean loss)/d(logits) = (softmax - one_hot(target)) / n_valid for valid rows
+                grad_logits = logits.sub_(lse.unsqueeze(1)).exp_()
+                grad_logits[torch.arange(len(t), device=t.device), t_safe] -= 1.0
+                grad_logits *= (v / n_valid).unsqueeze(1)
+                grad_hidden[start:start+chunk_size] = grad_logits.to(weight.dtype) @ weight # type: ignore
+                grad_weight += grad_logits.t().to(h.dtype) @ h # type: ignore
+
+        ctx.save_for_backward(grad_hidden, grad_weight)
+        ctx.weight_dtype = weight.dtype
+        ctx.mark_non_differentiable(correct)
+        return loss_sum / n_valid, correct
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_correct):
+        grad_hidden, grad_weight = ctx.saved_tensors
+        # grads were computed in forward for loss scale 1
+        return grad_hidden * grad_loss.to(grad_hidden.dtype), (grad_weight * grad_loss).to(ctx.weight_dtype), \
+               None, None, None, None, None
+
+def linear_cross_entropy(hidden:torch.Tensor, weight:torch.Tensor, targets:torch.Tensor,
+                         chunk_size:int, ignore_index:int=-1,
+                         compute_accuracy:bool=True)->Tuple[torch.Tensor, torch.Tensor]:
+    """Same as cross_entropy(hidden @ weight.t(), targets) with mean reduction, plus number of
+    correct argmax predictions (0 if compute_accuracy is False)."""
+    compute_grads = torch.is_grad_enabled() and (hidden.requires_grad or weight.requires_grad)
+    return LinearCrossEntropy.apply(hidden, weight, targets, chunk_size, ignore_index,
+                                    compute_accuracy, compute_grads) # type: ignore
+
+def get_loss(model_output, labels, chunk_size:int=1024,
+             compute_accuracy:bool=True)->Tuple[torch.Tensor, torch.Tensor, int]:
     # model_output: [batch_size, seq_len, vocab_size]
     # cross entropy loss expects a tensor of shape [batch_size, num_classes] and [batch_size]
 
+    targets = labels.view(-1) # [batch_size*seq_len]
+
+    if isinstance(model_output, Mapping) and 'hidden' in model_output:
+        # model left lm_head to us, chunk_size tokens of logits at a time
+        hidden = model_output['hidden']
+        loss, correct = linear_cross_entropy(hidden.view(-1, hidden.size(-1)), model_output['lm_head_weight'],
+                                             targets, chunk_size, ignore_index=-1,
+                                             compute_accuracy=compute_accuracy)
+        return loss, correct, len(targets)
+
     if isinstance(model_output, Mapping):
         model_output = model_output['logits']
 
     preds = model_output.view(-1, model_output.size(-1)) # [batch_size*seq_len, vocab_size]
-    targets = labels.view(-1) # [batch_size*seq_len]
 
     # ignore_index=-1 is actually not needed because we never output -ve index for tokens.
     # PyTorch default is -100. The negative index is used to ignore the loss for padding tokens.
     loss = torch.nn.functional.cross_entropy(preds, targets, ignore_index=-1)
     # dim=-1 means we take the max along the last dimension, which is the vocab_size, so max is taken over the vocab
-    correct = (torch.argmax(preds, dim=-1) == targets).sum()
+    # accuracy is another full pass over logits, so it can be turned off
+    correct = (torch.argmax(preds, dim=-1) == targets).sum() if compute_accuracy \
+        else torch.zeros((), dtype=torch.long, device=preds.device)
 
     return loss, correct, len(targets) # total num of predictions
-
@@ -0,0 +1,184 @@
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import json
+import math
+import os
+import time
+
+import numpy as np
+import torch
+
+"""
+Append-only columnar store of step metrics so analysis of many runs doesn't need to parse
+log.txt. Rows are buffered and every flush_every rows written as a new chunk:
+
+    <store_dir>/schema.json         columns seen so far in order, all float64
+    <store_dir>/chunk_000000.npz    one array per column present in chunk, NaN where a row
+                                    doesn't have that column
+
+Chunks and schema are written to temp file and renamed so a crash loses at most the rows
+not yet flushed and never leaves a partial chunk. Only numeric values are stored, strings
+and other values are skipped.
+
+A store left in store_dir by previous run is replaced on first flush, unless resume(step)
+was called before it: then rows of previous run from that step on are removed (they will be
+logged again) and new chunks are appended after remaining ones.
+
+    df = metrics_store.load_run('~/out_dir/my_run/metrics')
+    df = metrics_store.load_runs(glob.glob('~/out_dir/sweep_*/metrics'))
+"""
+
+SCHEMA_FILENAME = 'schema.json'
+STEP_COLUMN = 'train/step'
+TIME_COLUMN = '_time' # wall clock time row was appended
+
+def _to_float(val:Any)->Optional[float]:
+    if isinstance(val, np.generic) or (isinstance(val, torch.Tensor) and val.numel() == 1):
+        val = val.item()
+    if isinstance(val, (bool, int, float)):
+        return float(val)
+    return None
+
+def _chunk_paths(store_dir:str)->List[str]:
+    return sorted(glob.glob(os.path.join(store_dir, 'chunk_*.npz')))
+
+def _chunk_index(chunk_path:str)->int:
+    return int(os.path.basename(chunk_path)[len('chunk_'):-len('.npz')])
+
+def _atomic_write(filepath:str, write_fn)->None:
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
+
+class MetricsStore:
+    def __init__(self, store_dir:str, flush_every:int=100):
+        self.store_dir = store_dir
+        self.flush_every = flush_every
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.columns:List[str] = []
+        self._column_set = set(self.columns)
+        self._schema_changed = False
+        self.chunk_index = 0
+        self.rows:List[Dict[str, float]] = []
+        self.resume_step:Optional[int] = None
+        self._opened = False # existing store is replaced or truncated on first flush
+
+    def resume(self, step:int)->None:
+        """Continue store of previous run from step instead of replacing it. Call before first flush."""
+        assert not self._opened, 'resume must be called before rows are flushed'
+        self.resume_step = step
+
+    def _open(self)->None:
+        schema_filepath = os.path.join(self.store_dir, SCHEMA_FILENAME)
+        chunk_paths = _chunk_paths(self.store_dir)
+        old_columns = []
+        if self.resume_step is None:
+            for filepath in chunk_paths + [schema_filepath]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            chunk_paths = []
+        else:
+            if os.path.exists(schema_filepath):
+                with open(schema_filepath, 'r', encoding='utf-8') as f:
+                    old_columns = list(json.load(f)['columns'])
+            chunk_paths = [p for p in chunk_paths if self._truncate_chunk(p, self.resume_step)]
+        # columns of previous run come first so its chunks stay consistent with schema
+        self.columns = old_columns + [c for c in self.columns if c not in set(old_columns)]
+        self._column_set = set(self.columns)
+        self._schema_changed = True
+        self.chunk_index = _chunk_index(chunk_paths[-1]) + 1 if chunk_paths else 0
+        self._opened = True
+
+    @staticmethod
+    def _truncate_chunk(chunk_path:str, step:int)->bool:
+        """Removes rows at step or later from chunk, returns False if chunk was deleted."""
+        with np.load(chunk_path) as chunk:
+            arrays = {c: chunk[c] for c in chunk.files}
+        if STEP_COLUMN not in arrays:
+            return True
+        keep = ~(arrays[STEP_COLUMN] >= step) # NaN steps are kept
+        if keep.all():
+            return True
+        if not keep.any():
+            os.remove(chunk_path)
+            return False
+        _atomic_write(chunk_path, lambda f: np.savez(f, **{c: a[keep] for c, a in arrays.items()}))
+        return True
+
+    def append(self, d:Mapping[str, Any])->None:
+        row = {TIME_COLUMN: time.time()}
+        for k, v in d.items():
+            val = _to_float(v)
+            if val is not None:
+                row[k] = val
+        for k in row:
+            if k not in self._column_set:
+                self.columns.append(k)
+                self._column_set.add(k)
+                self._schema_changed = True
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self)->None:
+        if not self.rows:
+            return
+        if not self._opened:
+            self._open()
+        # schema first so chunk columns are always in it
+        if self._schema_changed:
+            _atomic_write(os.path.join(self.store_dir, SCHEMA_FILENAME),
+                          lambda f: f.write(json.dumps({'columns': self.columns, 'dtype': 'float64'}).encode('utf-8')))
+            self._schema_changed = False
+
+        present = [c for c in self.columns if any(c in row for row in self.rows)]
+        arrays = {c: np.array([row.get(c, math.nan) for row in self.rows], dtype=np.float64) for c in present}
+        _atomic_write(os.path.join(self.store_dir, f'chunk_{self.chunk_index:06d}.npz'),
+                      lambda f: np.savez(f, **arrays))
+        self.chunk_index += 1
+        self.rows.clear()
+
+    def close(self)->None:
+        self.flush()
+
+def load_run(store_dir:str, columns:Optional[Iterable[str]]=None,
+             dedupe_column:Optional[str]=STEP_COLUMN):
+    """Returns pandas DataFrame of all rows in store. If dedupe_column is present, for rows
+    with same value only last is kept, e.g., steps repeated after restart from checkpoint."""
+    import pandas as pd
+
+    store_dir = os.path.expanduser(store_dir)
+    with open(os.path.join(store_dir, SCHEMA_FILENAME), 'r', encoding='utf-8') as f:
+        all_columns = json.load(f)['columns']
+    columns = list(columns) if columns is not None else all_columns
+
+    frames = []
+    for chunk_path in _chunk_paths(store_dir):
+        with np.load(chunk_path) as chunk:
+            n_rows = len(chunk[chunk.files[0]]) if chunk.files else 0
+            frames.append(pd.DataFrame({c: chunk[c] if c in chunk.files else np.full(n_rows, np.nan)
+                                        for c in columns}))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns, dtype=np.float64)
+
+    if dedupe_column is not None and dedupe_column in df.columns:
+        keep = df[dedupe_column].isna() | ~df.duplicated(subset=[dedupe_column], keep='last')
+        df = df[keep].reset_index(drop=True)
+    return df
+
+def load_runs(store_dirs:Iterable[str], columns:Optional[Iterable[str]]=None,
+              dedupe_column:Optional[str]=STEP_COLUMN, max_workers:int=16):
+    """Loads many runs in parallel into one DataFrame with run column set to store's parent dir name."""
+    import pandas as pd
+
+    store_dirs = list(store_dirs)
+    columns = list(columns) if columns is not None else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(executor.map(lambda d: load_run(d, columns, dedupe_column), store_dirs))
+    for store_dir, df in zip(store_dirs, dfs):
+        df.insert(0, 'run', os.path.basename(os.path.dirname(os.path.abspath(os.path.expanduser(store_dir)))))
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
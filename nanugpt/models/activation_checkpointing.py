@@ -0,0 +1,51 @@
+from typing import Callable, NamedTuple
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+"""
+Activation checkpointing (a.k.a. gradient checkpointing) for transformer blocks.
+
+Instead of keeping activations of checkpointed modules alive until backward, we only keep
+their inputs and recompute the forward pass during backward. This trades ~1 extra forward
+of the recomputed part for memory which allows larger device_batch_size and fewer
+gradient accumulation steps.
+
+Policies:
+    'none':  keep all activations (default).
+    'block': recompute whole block, saves most memory, costs about one extra forward.
+    'attn':  recompute only attention sub-block.
+    'mlp':   recompute only MLP sub-block, MLP activations are 4x wider than hidden
+             size so this saves a lot for less recompute than 'block'.
+
+nanogpt models recompute the norm of the sub-block too. tinyllama keeps the norm
+outside since with shared_attention_norm attention and MLP take same norm output.
+
+`every` applies the policy to every k-th block only (blocks 0, k, 2k, ...), so
+memory/compute trade-off can be tuned in between.
+"""
+
+POLICIES = ('none', 'block', 'attn', 'mlp')
+
+class BlockCheckpointing(NamedTuple):
+    block: bool
+    attn: bool
+    mlp: bool
+
+def block_checkpointing(policy:str, every:int, layer_idx:int)->BlockCheckpointing:
+    """Returns which parts of block at layer_idx should be recomputed."""
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown activation_checkpointing policy "{policy}", must be one of {POLICIES}')
+    if every < 1:
+        raise ValueError(f'activation_checkpointing_every must be >= 1 but got {every}')
+    enabled = policy != 'none' and layer_idx % every == 0
+    return BlockCheckpointing(block=enabled and policy == 'block',
+                              attn=enabled and policy == 'attn',
+                              mlp=enabled and policy == 'mlp')
+
+def maybe_checkpoint(enabled:bool, fn:Callable, *args, **kwargs):
+    """Calls fn(*args, **kwargs), recomputing it in backward if enabled and we are building graph."""
+    if enabled and torch.is_grad_enabled():
+        # non-reentrant version works with torch.compile, DDP and inputs that don't require grad
+        return checkpoint(fn, *args, use_reentrant=False, **kwargs)
+    return fn(*args, **kwargs)
@@ -18,6 +18,8 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+from nanugpt.models.activation_checkpointing import block_checkpointing, maybe_checkpoint
+
 class NewGELU(nn.Module):
     """Careful there are a few versions of GeLU, this one is the exact one used by OpenAI"""
     def forward(self, input):
@@ -39,6 +41,9 @@ class GPTConfig:
     resid_dropout: float = 0.0
     embed_dropout: float = 0.0
     initializer_range: float = 0.02
+    activation_checkpointing: str = 'none' # none, block, attn or mlp, see activation_checkpointing.py
+    activation_checkpointing_every: int = 1 # apply above policy to every k-th block
+    fused_lm_head_loss: bool = False # return final hidden states and lm_head weight, loss computes logits in chunks
 
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
@@ -84,15 +89,17 @@ class CausalSelfAttention(nn.Module):
                                         .view(1, 1, config.block_size, config.block_size))
 
     def forward(self, x):
-        batch_size, seq_len, n_embd = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
+        batch_size, seq_len, _ = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
+        # with tensor parallel, self.n_head and self.n_embd are only for the heads on this rank
+        n_embd, head_size = self.n_embd, self.n_embd // self.n_head
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
         # self.c_attn(x): (batch_size, seq_len, n_embd) -> (batch_size, seq_len, 3 * n_embd)
         # .split(self.n_embd, dim=2): (batch_size, seq_len, 3 * n_embd) -> (batch_size, seq_len, n_embd), (batch_size, seq_len, n_embd), (batch_size, seq_len, n_embd)
         q, k, v  = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(batch_size, seq_len, self.n_head, n_embd // self.n_head).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
-        q = q.view(batch_size, seq_len, self.n_head, n_embd // self.n_head).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
-        v = v.view(batch_size, seq_len, self.n_head, n_embd // self.n_head).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
+        k = k.view(batch_size, seq_len, self.n_head, head_size).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
+        q = q.view(batch_size, seq_len, self.n_head, head_size).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
+        v = v.view(batch_size, seq_len, self.n_head, head_size).transpose(1, 2) # (batch_size, n_heads, seq_len, head_size)
 
         # causal self-attention; Self-attend: (batch_size, n_heads, seq_len, head_size) x (batch_size, n_heads, head_size, seq_len) -> (batch_size, n_heads, seq_len, seq_len)
         if self.flash:
@@ -157,7 +164,7 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config:GPTConfig):
+    def __init__(self, config:GPTConfig, layer_idx:int=0):
         super().__init__()
         # Original transformer had two layer norms, one after self-attention and one after MLP.
         # It also had two residual connections, one after self-attention and one after MLP.
@@ -169,10 +176,18 @@ class Block(nn.Module):
         self.attn = CausalSelfAttention(config)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.layer_norm_bias)
         self.mlp = MLP(config)
+        self.checkpointing = block_checkpointing(config.activation_checkpointing,
+                                                 config.activation_checkpointing_every, layer_idx)
+
+    def _attn(self, x):
+        return self.attn(self.ln_1(x))
+
+    def _mlp(self, x):
+        return self.mlp(self.ln_2(x))
 
     def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlp(self.ln_2(x))
+        x = x + maybe_checkpoint(self.checkpointing.attn, self._attn, x)
+        x = x + maybe_checkpoint(self.checkpointing.mlp, self._mlp, x)
         return x
 
 class GPT(nn.Module):
@@ -186,7 +201,7 @@ class GPT(nn.Module):
         modules:dict = dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd), # n_embd === hidden_size === d_model
             wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.layer_norm_bias),
         )
         if config.embed_dropout:
@@ -251,12 +266,15 @@ class GPT(nn.Module):
         else:
             x = tok_emb + pos_emb
         for block in self.transformer.h:
-            x = block(x)
+            x = maybe_checkpoint(block.checkpointing.block, block, x)
 
         # apply layer norm. Typically layer norm is applied before and after attention but not after MLP.
         x = self.transformer.ln_f(x) # [batch, seq_len, emb_dim]
 
         if not only_last:
+            if self.config.fused_lm_head_loss:
+                # full [batch, seq_len, vocab_size] logits are never materialized, see autoregressive_loss.py
+                return {'hidden': x, 'lm_head_weight': self.lm_head.weight}
             logits = self.lm_head(x) # [batch, seq_len, vocab_size]
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
@@ -348,6 +366,10 @@ def get_model(
                 mlp_dropout=0.0, # dropout for feedforward layer
 
                 initializer_range=0.02, # defaults to 0.02, The standard deviation of the truncated_normal_initializer for initializing all weight matrices
+
+                activation_checkpointing='none', # none, block, attn or mlp: recompute activations in backward to save memory
+                activation_checkpointing_every=1, # apply activation_checkpointing to every k-th block
+                fused_lm_head_loss=False, # loss computes logits from hidden states in chunks to save memory
               ):
 
     gpt_config = GPTConfig(
@@ -364,7 +386,10 @@ def get_model(
                             attn_dropout=attn_dropout,
                             mlp_dropout=mlp_dropout,
                             resid_dropout=resid_dropout,
-                            embed_dropout=embed_dropout
+                            embed_dropout=embed_dropout,
+                            activation_checkpointing=activation_checkpointing,
+                            activation_checkpointing_every=activation_checkpointing_every,
+                            fused_lm_head_loss=fused_lm_head_loss,
                             )
 
     return GPT(gpt_config)
\ No newline at end of file
@@ -13,6 +13,8 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+from nanugpt.models.activation_checkpointing import block_checkpointing, maybe_checkpoint
+
 
 @dataclass
 class GPTConfig:
@@ -21,6 +23,9 @@ class GPTConfig:
     n_layer: int = 12
     n_head: int = 12
     n_embd: int = 768
+    activation_checkpointing: str = 'none' # none, block, attn or mlp, see activation_checkpointing.py
+    activation_checkpointing_every: int = 1 # apply above policy to every k-th block
+    fused_lm_head_loss: bool = False # return final hidden states and lm_head weight, loss computes logits in chunks
 
 class Rotary(torch.nn.Module):
     def __init__(self, dim, base=10000):
@@ -102,16 +107,24 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config:GPTConfig):
+    def __init__(self, config:GPTConfig, layer_idx:int=0):
         super().__init__()
         self.attn = CausalSelfAttention(config)
         self.mlp = MLP(config)
         # Use register_buffer to avoid torch Dynamo error 'float' does not have the attribute 'meta'
         self.register_buffer('attn_scale', torch.tensor(1 / math.sqrt(2 * config.n_layer)))
+        self.checkpointing = block_checkpointing(config.activation_checkpointing,
+                                                 config.activation_checkpointing_every, layer_idx)
+
+    def _attn(self, x):
+        return self.attn(rmsnorm(x))
+
+    def _mlp(self, x):
+        return self.mlp(rmsnorm(x))
 
     def forward(self, x):
-        x = x + self.attn_scale * self.attn(rmsnorm(x))
-        x = x + self.mlp(rmsnorm(x))
+        x = x + self.attn_scale * maybe_checkpoint(self.checkpointing.attn, self._attn, x)
+        x = x + maybe_checkpoint(self.checkpointing.mlp, self._mlp, x)
         return x
 
 class GPT(nn.Module):
@@ -121,7 +134,7 @@ class GPT(nn.Module):
 
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
         self.transformer.wte.weight = self.lm_head.weight # https://paperswithcode.com/method/weight-tying
@@ -135,10 +148,13 @@ class GPT(nn.Module):
         x = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
 
         for block in self.transformer.h:
-            x = block(x)
+            x = maybe_checkpoint(block.checkpointing.block, block, x)
         x = rmsnorm(x)
 
         if not only_last:
+            if self.config.fused_lm_head_loss:
+                # full [batch, seq_len, vocab_size] logits are never materialized, see autoregressive_loss.py
+                return {'hidden': x, 'lm_head_weight': self.lm_head.weight}
             logits = self.lm_head(x) # [batch, seq_len, vocab_size]
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
@@ -151,6 +167,9 @@ class GPT(nn.Module):
 def get_model(
                 n_layer: int, n_embd: int, n_head: int,
                 vocab_size: int, context_length: int,
+                activation_checkpointing='none', # none, block, attn or mlp: recompute activations in backward to save memory
+                activation_checkpointing_every=1, # apply activation_checkpointing to every k-th block
+                fused_lm_head_loss=False, # loss computes logits from hidden states in chunks to save memory
               ):
 
     gpt_config = GPTConfig(
@@ -159,6 +178,9 @@ def get_model(
                             n_layer=n_layer,
                             n_head=n_head,
                             n_embd=n_embd,
+                            activation_checkpointing=activation_checkpointing,
+                            activation_checkpointing_every=activation_checkpointing_every,
+                            fused_lm_head_loss=fused_lm_head_loss,
                         )
 
-    return GPT(gpt_config)
\ No newline at end of file
+    return GPT(gpt_config)
\ No newline at end of file
@@ -13,6 +13,7 @@ from flash_attn import flash_attn_func # type: ignore
 
 from nanugpt.models.fused_rotary_embedding import apply_rotary_emb_func
 from nanugpt.models.rmsnorm import RMSNorm
+from nanugpt.models.activation_checkpointing import block_checkpointing, maybe_checkpoint
 from nanugpt import utils
 
 
@@ -79,6 +80,8 @@ class LlamaConfig:
     _mlp_class: Literal["GptNeoxMLP", "LLaMAMLP"] = "GptNeoxMLP"
     intermediate_size: Optional[int] = None
     condense_ratio: int = 1
+    activation_checkpointing: str = 'none' # none, block, attn or mlp, see activation_checkpointing.py
+    activation_checkpointing_every: int = 1 # apply above policy to every k-th block
 
     def __post_init__(self):
         # error checking
@@ -130,7 +133,7 @@ class Llama(nn.Module):
         self.transformer = nn.ModuleDict(
             dict(
                 wte=nn.Embedding(config.padded_vocab_size, config.n_embd),
-                h=nn.ModuleList(Block(config) for _ in range(config.n_layer)),
+                h=nn.ModuleList(Block(config, i) for i in range(config.n_layer)),
                 ln_f=config.norm_class(config.n_embd, eps=config.norm_eps),
             )
         )
@@ -205,7 +208,7 @@ class Llama(nn.Module):
 
         if not use_kv_cache:
             for block in self.transformer.h: # type: ignore
-                x, *_ = block(x, (cos, sin), max_seq_length)
+                x, *_ = maybe_checkpoint(block.checkpointing.block, block, x, (cos, sin), max_seq_length)
         else:
             self.kv_caches = self.kv_caches or self.build_kv_caches(x, max_seq_length, cos.size(-1) * 2)
             for i, block in enumerate(self.transformer.h): # type: ignore
@@ -247,7 +250,7 @@ class Llama(nn.Module):
 
 
 class Block(nn.Module):
-    def __init__(self, config: LlamaConfig) -> None:
+    def __init__(self, config: LlamaConfig, layer_idx: int = 0) -> None:
         super().__init__()
         self.norm_1 = RMSNorm(config.n_embd, eps=config.norm_eps)
         self.attn = CausalSelfAttention(config)
@@ -255,6 +258,8 @@ class Block(nn.Module):
             self.norm_2 = RMSNorm(config.n_embd, eps=config.norm_eps)
         self.mlp = config.mlp_class(config)
         self.config = config
+        self.checkpointing = block_checkpointing(config.activation_checkpointing,
+                                                 config.activation_checkpointing_every, layer_idx)
     def forward(
         self,
         x: torch.Tensor,
@@ -266,10 +271,12 @@ class Block(nn.Module):
     ) -> Tuple[torch.Tensor, Optional[KVCache]]:
 
         n_1 = self.norm_1(x)
-        h, new_kv_cache = self.attn(n_1, rope, max_seq_length, mask, input_pos, kv_cache)
+        # no recompute when kv cache is used, i.e., during inference
+        h, new_kv_cache = maybe_checkpoint(self.checkpointing.attn and kv_cache is None,
+                                           self.attn, n_1, rope, max_seq_length, mask, input_pos, kv_cache)
         if self.config.parallel_residual:
             n_2 = n_1 if self.config.shared_attention_norm else self.norm_2(x)
-            x = x + h + self.mlp(n_2)
+            x = x + h + maybe_checkpoint(self.checkpointing.mlp, self.mlp, n_2)
         else:
             if self.config.shared_attention_norm:
                 raise NotImplementedError(
@@ -278,7 +285,7 @@ class Block(nn.Module):
                 )
 
             x = x + h
-            x = x + self.mlp(self.norm_2(x))
+            x = x + maybe_checkpoint(self.checkpointing.mlp, self.mlp, self.norm_2(x))
         return x, new_kv_cache
 
 
@@ -470,6 +477,8 @@ def get_model(
                 _mlp_class:Literal["GptNeoxMLP", "LLaMAMLP"] ="LLaMAMLP",
                 intermediate_size=2048,
                 condense_ratio: int = 1,
+                activation_checkpointing='none', # none, block, attn or mlp: recompute activations in backward to save memory
+                activation_checkpointing_every=1, # apply activation_checkpointing to every k-th block
               ):
 
     gpt_config = LlamaConfig(
@@ -489,6 +498,8 @@ def get_model(
         _mlp_class =_mlp_class,
         intermediate_size=intermediate_size,
         condense_ratio=condense_ratio,
+        activation_checkpointing=activation_checkpointing,
+        activation_checkpointing_every=activation_checkpointing_every,
     )
 
     return Llama(gpt_config)
\ No newline at end of file
@@ -0,0 +1,90 @@
+from typing import Dict, List
+
+import torch
+from torch import distributed as dist
+
+"""
+Runs optimizer update for each parameter during backward of the last micro-step, as soon
+as its gradient is final, and frees the gradient right after. Normally all grads are
+resident at once between backward and optimizer.step(), so this saves about one model
+sized buffer of memory.
+
+Each parameter gets its own instance of the optimizer's class with a single param group
+that mirrors the group of the parameter in the regular optimizer. The regular optimizer
+isn't stepped but stays the source of truth: scheduler sets lr on its groups, which are
+copied before each update, and its state dict is shared so checkpointing works as usual.
+
+Global norm clipping needs all grads before any update, so clipping is deferred: grads of
+this step are scaled by clip coefficient from previous step's norm (first step is not
+clipped) while this step's norm is accumulated for logging and next step. A two-pass
+policy would need a second backward.
+
+With DDP, grads are only final after their bucket is all-reduced, so updates run from the
+DDP comm hook per bucket instead (see comm_hooks.register_comm_hook). DDP keeps grads in
+its buckets so there memory is not saved but updates overlap with rest of backward.
+"""
+
+class OptimizerInBackward:
+    def __init__(self, model:torch.nn.Module, optimizer:torch.optim.Optimizer, grad_clip:float,
+                 use_ddp:bool):
+        self.optimizer = optimizer
+        self.grad_clip = grad_clip
+        self.last_micro_step = True # set by train loop, updates only run on last micro-step
+
+        # index because load_state_dict replaces group dicts of optimizer
+        self.group_indices:Dict[torch.nn.Parameter, int] = {}
+        self.param_optims:Dict[torch.nn.Parameter, torch.optim.Optimizer] = {}
+        for i, group in enumerate(optimizer.param_groups):
+            for p in group['params']:
+                self.group_indices[p] = i
+                self.param_optims[p] = type(optimizer)([self._group_options(group, [p])])
+
+        device = next(iter(self.group_indices)).device
+        self.sq_norm = torch.zeros((), dtype=torch.float32, device=device)
+        self.clip_coef = torch.ones((), dtype=torch.float32, device=device)
+
+        self.handles = []
+        if not use_ddp:
+            self.handles = [p.register_post_accumulate_grad_hook(self._on_grad_ready)
+                            for p in model.parameters() if p in self.param_optims]
+
+    @staticmethod
+    def _group_options(group:dict, params:List[torch.nn.Parameter])->dict:
+        return {**{k: v for k, v in group.items() if k != 'params'}, 'params': params}
+
+    def _step_param(self, p:torch.nn.Parameter, grad:torch.Tensor):
+        self.sq_norm += torch.linalg.vector_norm(grad, dtype=torch.float32).square()
+        if self.grad_clip != 0.0:
+            grad.mul_(self.clip_coef.to(grad.dtype))
+        param_optim = self.param_optims[p]
+        # lr and other options may have been changed by scheduler, state may have been reloaded
+        group = self.optimizer.param_groups[self.group_indices[p]]
+        param_optim.param_groups[0].update(self._group_options(group, param_optim.param_groups[0]['params']))
+        param_optim.state = self.optimizer.state
+        param_optim.step()
+
+    def _on_grad_ready(self, p:torch.nn.Parameter):
+        if self.last_micro_step and p.grad is not None:
+            self._step_param(p, p.grad)
+            p.grad = None
+
+    def on_bucket_reduced(self, bucket:dist.GradBucket):
+        """Call from DDP comm hook after bucket's all-reduce is done."""
+        for p, grad in zip(bucket.parameters(), bucket.gradients()):
+            if p in self.param_optims:
+                if p.grad is not grad:
+                    p.grad = grad
+                self._step_param(p, grad)
+
+    def finish(self)->torch.Tensor:
+        """Call after backward of last micro-step, returns pre-clip norm of this step as device tensor."""
+        pre_clip_norm = self.sq_norm.sqrt()
+        if self.grad_clip != 0.0:
+            self.clip_coef = torch.clamp(self.grad_clip / (pre_clip_norm + 1e-6), max=1.0)
+        self.sq_norm = torch.zeros_like(self.sq_norm)
+        return pre_clip_norm
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -29,7 +29,8 @@ def get_optim(model, learning_rate, weight_decay,
     # Create AdamW optimizer and use the fused version if it is available
     use_fused = enable_fused and \
         'fused' in inspect.signature(torch.optim.AdamW).parameters
-    extra_args = dict(fused=True) if use_fused else dict()
+    # otherwise use multi-tensor foreach kernels which torch only defaults to on cuda
+    extra_args = dict(fused=True) if use_fused else dict(foreach=True)
 
     # TODO: move this out of function call
     logging.summary({'model/use_fused_adamw': use_fused})
@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional, Tuple
+from contextlib import contextmanager
+import timeit
+
+import torch
+from torch import distributed as dist
+
+from nanugpt.stopwatch import StopWatch
+
+"""
+Hierarchical phase timers for the training loop so every run tells where its time goes.
+
+    timer.start('step')
+    with timer.scope('forward'):   # timed as 'step/forward'
+        ...
+    timer.stop()                   # closes 'step'
+
+Times are recorded with CUDA events on GPU, so there are no syncs in the step. Events are
+resolved when report is popped at log steps, by then they have long completed. On CPU
+clocks are used. Phases of a top level scope (step) are only counted once it closes,
+so a report always covers whole steps.
+
+Note that CUDA event times are device timeline, e.g., 'data' is the gap on GPU while host
+was fetching batch, and host time spent ahead of GPU is not counted.
+"""
+
+class PhaseTimer:
+    def __init__(self, use_cuda_events:bool=False):
+        self.use_cuda_events = use_cuda_events
+        self.sw = StopWatch() # totals of completed top level scopes
+        self._stack:List[Tuple[str, object]] = [] # open scopes as (tag, start)
+        self._current:List[Tuple[str, object, object]] = [] # closed scopes of current top level scope
+        self._pending:List[Tuple[str, object, object]] = [] # closed scopes of completed top level scopes
+        self.count = 0 # completed top level scopes since last pop
+
+    def _now(self):
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return timeit.default_timer()
+
+    def start(self, name:str)->None:
+        tag = self._stack[-1][0] + '/' + name if self._stack else name
+        self._stack.append((tag, self._now()))
+
+    def stop(self)->None:
+        """Stops innermost open scope."""
+        tag, start = self._stack.pop()
+        self._current.append((tag, start, self._now()))
+        if not self._stack:
+            self._pending.extend(self._current)
+            self._current.clear()
+            self.count += 1
+
+    @contextmanager
+    def scope(self, name:str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def pop_report(self)->Tuple[Dict[str, float], int]:
+        """Returns total seconds per phase and number of top level scopes since last call, and resets."""
+        for tag, start, end in self._pending:
+            if self.use_cuda_events:
+                end.synchronize() # type: ignore
+                self.sw.add(start.elapsed_time(end) / 1000.0, tag) # type: ignore
+            else:
+                self.sw.add(end - start, tag) # type: ignore
+        totals = {tag: self.sw.elapsed_total(tag) for tag in self.sw.keys()}
+        count = self.count
+        self.sw.clear_all()
+        self._pending.clear()
+        self.count = 0
+        return totals, count
+
+def reduce_report(totals:Dict[str, float], count:int, is_distributed:bool,
+                  prefix:str='phase/')->Dict[str, float]:
+    """Seconds per step for each phase averaged over ranks, all ranks must call this."""
+    all_totals:List[Optional[Dict[str, float]]] = [totals]
+    if is_distributed:
+        all_totals = [None] * dist.get_world_size()
+        # phases can differ across ranks with rank specific code paths so we gather dicts instead of reducing tensors
+        dist.all_gather_object(all_totals, totals)
+    tags = sorted(set(tag for t in all_totals for tag in t)) # type: ignore
+    count = max(count, 1)
+    return {prefix + tag: sum(t.get(tag, 0.0) for t in all_totals) / (len(all_totals) * count) # type: ignore
+            for tag in tags}
@@ -0,0 +1,317 @@
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+import timeit
+
+import torch
+import torch.nn as nn
+from torch import distributed as dist
+from torch.distributed.device_mesh import init_device_mesh, DeviceMesh
+from torch.distributed.pipelining import PipelineStage, Schedule1F1B, ScheduleGPipe
+
+from nanugpt import utils
+from nanugpt.models import nanogpt
+from nanugpt.models.activation_checkpointing import maybe_checkpoint
+
+"""
+Pipeline parallelism (PP) for nanogpt: transformer blocks are partitioned into contiguous
+stages, one stage per rank, and micro-batches flow through stages using 1F1B schedule
+from torch.distributed.pipelining. First stage also has embeddings and last stage has
+final norm and lm_head. Only activations at stage boundaries are sent between ranks
+(point-to-point), so PP needs much less interconnect bandwidth than DDP/FSDP/TP for
+deep models.
+
+Micro-batches are the usual grad_acc_steps micro-batches so global batch size
+semantics don't change. With p stages and m micro-batches, each rank is idle for
+(p-1)/(m+p-1) of the step (pipeline bubble), so grad_acc_steps should be a few
+times the number of stages. 1F1B runs backward of a micro-batch as soon as possible
+so at most p micro-batches of activations are alive on a stage.
+
+Stages compose with data parallel on 2D (dp, pp) mesh: grads are averaged between ranks
+that hold the same stage after all micro-batches are done. lm_head weight is tied to the token embedding, first and last
+stage each keep a copy and their grads are summed after backward so the copies stay
+same.
+
+Checkpoints use the same full (unsharded) state dict format as DDP/single device runs so
+they are interchangeable. Stage states are gathered on rank 0 for saving and each stage
+picks up its params on load.
+"""
+
+def init_mesh(torch_info:utils.TorchInfo, pp_size:int)->DeviceMesh:
+    """Creates 2D (dp, pp) mesh, ranks of a pipeline are contiguous."""
+    if pp_size < 1 or torch_info.world_size % pp_size != 0:
+        raise ValueError(f'pipeline_parallel_size {pp_size} must divide world size {torch_info.world_size}')
+    return init_device_mesh(torch_info.device_type, (torch_info.world_size // pp_size, pp_size),
+                            mesh_dim_names=('dp', 'pp'))
+
+def stage_layers(n_layer:int, n_stages:int, stage_idx:int)->range:
+    """Block indices of stage, earlier stages get the extra blocks if n_layer doesn't divide."""
+    if n_layer < n_stages:
+        raise ValueError(f'n_layer {n_layer} must be at least pipeline_parallel_size {n_stages}')
+    size, extra = divmod(n_layer, n_stages)
+    start = stage_idx * size + min(stage_idx, extra)
+    return range(start, start + size + (1 if stage_idx < extra else 0))
+
+def _strip_prefix(name:str)->str:
+    # compiled models have _orig_mod. prefix
+    return name[len('_orig_mod.'):] if name.startswith('_orig_mod.') else name
+
+class GPTStage(nn.Module):
+    """Part of nanogpt GPT model for one pipeline stage, keeps module names of GPT so state dict keys don't change."""
+    def __init__(self, model:nanogpt.GPT, stage_idx:int, n_stages:int):
+        super().__init__()
+        self.config = model.config
+        self.is_first, self.is_last = stage_idx == 0, stage_idx == n_stages - 1
+
+        # names of all params in full model in the order optimizer would see them
+        self.full_param_names = [n for n, _ in model.named_parameters()]
+        # lm_head weight is tied to wte weight and named_parameters() only lists the first name
+        self.tied_names = {'lm_head.weight': 'transformer.wte.weight'} \
+            if model.lm_head.weight is model.transformer.wte.weight else {}
+
+        modules = {}
+        if self.is_first:
+            modules['wte'], modules['wpe'] = model.transformer.wte, model.transformer.wpe
+            if 'embed_dropout' in model.transformer:
+                modules['embed_dropout'] = model.transformer.embed_dropout
+        # keyed by block index so names are same as in ModuleList of full model
+        modules['h'] = nn.ModuleDict({str(i): model.transformer.h[i] \
+                                      for i in stage_layers(len(model.transformer.h), n_stages, stage_idx)})
+        if self.is_last:
+            modules['ln_f'] = model.transformer.ln_f
+        self.transformer = nn.ModuleDict(modules)
+        self.lm_head = model.lm_head if self.is_last else None
+
+    def forward(self, x):
+        if self.is_first:
+            # same as GPT.forward
+            pos = torch.arange(0, x.size(1), dtype=torch.long, device=x.device)
+            x = self.transformer.wte(x) + self.transformer.wpe(pos)
+            if self.config.embed_dropout:
+                x = self.transformer.embed_dropout(x)
+        for block in self.transformer.h.values():
+            x = maybe_checkpoint(block.checkpointing.block, block, x)
+        if self.is_last:
+            x = self.lm_head(self.transformer.ln_f(x)) # type: ignore
+        return x
+
+def split_model(model:torch.nn.Module, pp_mesh:DeviceMesh)->torch.nn.Module:
+    """Returns the stage of model for this rank, must be called before optimizer is created."""
+    compiled_model, model = model, getattr(model, '_orig_mod', model)
+    if not isinstance(model, nanogpt.GPT):
+        raise ValueError(f'Pipeline parallel is only supported for nanogpt GPT model but got {type(model)}')
+
+    # like DDP, start all ranks from rank 0's weights as init may not be seeded same on all ranks
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(t, src=0)
+
+    stage = GPTStage(model, pp_mesh.get_local_rank(), pp_mesh.size())
+    for p in stage.parameters():
+        p.pp_group = pp_mesh.get_group() # type: ignore
+    if stage.tied_names and pp_mesh.size() > 1:
+        # first and last stage each have a copy of tied wte/lm_head weight and their grads are summed
+        if stage.is_first:
+            stage.transformer.wte.weight.pp_tied = True # type: ignore
+        if stage.is_last:
+            stage.lm_head.weight.pp_tied = True # type: ignore
+            # counted only once in norms
+            stage.lm_head.weight.pp_tied_copy = True # type: ignore
+    return torch.compile(stage) if compiled_model is not model else stage # type: ignore
+
+
+class TimedPipelineStage(PipelineStage):
+    """PipelineStage that measures time spent in forward and backward of micro-batches."""
+    def __init__(self, *args, sync_cuda:bool=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sync_cuda = sync_cuda
+        self.compute_time = 0.0
+
+    def _timed(self, fn, *args, **kwargs):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start_time = timeit.default_timer()
+        result = fn(*args, **kwargs)
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        self.compute_time += timeit.default_timer() - start_time
+        return result
+
+    def forward_one_chunk(self, *args, **kwargs):
+        return self._timed(super().forward_one_chunk, *args, **kwargs)
+
+    def backward_one_chunk(self, *args, **kwargs):
+        return self._timed(super().backward_one_chunk, *args, **kwargs)
+
+class Pipeline:
+    """Runs train and eval steps of a stage with 1F1B schedule.
+
+    model is the stage from split_model(), get_loss is same as used for regular training.
+    """
+    def __init__(self, model:torch.nn.Module, mesh:DeviceMesh, device:torch.device,
+                 n_microbatches:int, get_loss:Callable):
+        pp_mesh = mesh['pp']
+        n_stages, stage_idx = pp_mesh.size(), pp_mesh.get_local_rank()
+        if n_microbatches < n_stages:
+            raise ValueError(f'grad_acc_steps {n_microbatches} must be at least pipeline_parallel_size {n_stages}, increase global_batch_size or decrease device_batch_size')
+        self.n_stages, self.n_microbatches = n_stages, n_microbatches
+        self.is_first, self.is_last = stage_idx == 0, stage_idx == n_stages - 1
+        self.get_loss = get_loss
+        self._metrics:List[Tuple[torch.Tensor, torch.Tensor, int]] = []
+
+        group = pp_mesh.get_group()
+        self.dp_group, self.dp_size = mesh['dp'].get_group(), mesh['dp'].size()
+        self.params = list(model.parameters())
+        self.stage = TimedPipelineStage(model, stage_idx, n_stages, device, group=group,
+                                        sync_cuda=device.type == 'cuda')
+        self.schedule = Schedule1F1B(self.stage, n_microbatches, loss_fn=self._loss_fn)
+        # eval batch size is different so it gets its own stage with its own buffers
+        self.eval_stage = PipelineStage(model, stage_idx, n_stages, device, group=group)
+        self.eval_schedule = ScheduleGPipe(self.eval_stage, 1, loss_fn=self._loss_fn)
+
+        # first and last stages of each pipeline sum grads of tied lm_head/wte weights,
+        # new_group must be called on all ranks for all groups
+        self.tied_params = [p for p in model.parameters() if getattr(p, 'pp_tied', False)]
+        self.tied_group = None
+        for pipeline_ranks in mesh.mesh.tolist(): # one row per data parallel replica
+            g = dist.new_group([pipeline_ranks[0], pipeline_ranks[-1]])
+            if dist.get_rank() in (pipeline_ranks[0], pipeline_ranks[-1]):
+                self.tied_group = g
+
+        self.step_time, self.bubble = 0.0, 0.0
+
+    def _loss_fn(self, output, target):
+        loss, correct, n_preds = self.get_loss(output, target)
+        self._metrics.append((loss.detach(), correct, n_preds))
+        return loss
+
+    def step(self, x:torch.Tensor, y:torch.Tensor)->Tuple[float, int, int]:
+        """Forward and backward of all micro-batches in x, y.
+
+        Returns sum of loss over samples, correct predictions and prediction count,
+        these are only available on last stage and are 0 on others.
+        """
+        self.stage.compute_time = 0.0
+        start_time = timeit.default_timer()
+        self._metrics.clear()
+        micro_batch_size = len(x) // self.n_microbatches
+        self.schedule.step(*((x,) if self.is_first else ()), target=y if self.is_last else None)
+        self.sync_dp_grads()
+        self.sync_tied_grads()
+        self.step_time = timeit.default_timer() - start_time
+        # part of step this rank wasn't computing: waiting for other stages and communication
+        self.bubble = 1.0 - self.stage.compute_time / self.step_time
+        return self._metrics_sum(micro_batch_size, self.n_microbatches)
+
+    def eval(self, x:torch.Tensor, y:torch.Tensor)->Tuple[float, int, int]:
+        """Forward only, returns same as step()."""
+        self._metrics.clear()
+        self.eval_schedule.eval(*((x,) if self.is_first else ()), target=y if self.is_last else None)
+        return self._metrics_sum(len(x), 1)
+
+    def _metrics_sum(self, batch_size:int, n_microbatches:int)->Tuple[float, int, int]:
+        # on first step schedule also calls loss_fn on placeholder outputs to infer grad shapes,
+        # so only the last n_microbatches calls are for real micro-batches
+        metrics = self._metrics[-n_microbatches:] if self.is_last else []
+        loss_sum = sum(loss.item() * batch_size for loss, _, _ in metrics)
+        correct_sum = sum(int(correct.item()) for _, correct, _ in metrics)
+        preds_count = sum(n_preds for _, _, n_preds in metrics)
+        return loss_sum, correct_sum, preds_count
+
+    def sync_dp_grads(self):
+        # DDP doesn't reliably work with micro-batches being scheduled by pipeline so we all-reduce
+        # grads ourselves after all micro-batches are done, flattened so it's one collective per dtype
+        if self.dp_size == 1:
+            return
+        utils.all_reduce_mean_([p.grad for p in self.params if p.grad is not None], self.dp_group)
+
+    def sync_tied_grads(self):
+        for p in self.tied_params:
+            if p.grad is not None:
+                dist.all_reduce(p.grad, group=self.tied_group)
+
+    def theoretical_bubble(self)->float:
+        """Idle fraction of 1F1B schedule with equal stage times and no communication cost."""
+        return (self.n_stages - 1) / (self.n_microbatches + self.n_stages - 1)
+
+
+def _full_param_groups(stage_groups:List[List[List[str]]], full_param_names:List[str],
+                       tied_names:Mapping[str, str])->List[List[str]]:
+    # optimizer param groups of full model are built by going over params in order so
+    # merging groups of all stages in that order gives the same groups
+    order = {n: i for i, n in enumerate(full_param_names)}
+    return [sorted({tied_names.get(n, n) for groups in stage_groups for n in groups[i]}, key=order.__getitem__)
+            for i in range(len(stage_groups[0]))]
+
+def _stage_param_groups(stage:GPTStage, optimizer)->List[List[str]]:
+    names = {p: _strip_prefix(n) for n, p in stage.named_parameters()}
+    return [[names[p] for p in group['params']] for group in optimizer.param_groups]
+
+def full_state_dicts(model:torch.nn.Module, optimizer, mesh:DeviceMesh)->Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Gathers full model and optimizer state dicts on rank 0, other ranks get empty dicts.
+
+    Must be called on all ranks.
+    """
+    stage:GPTStage = getattr(model, '_orig_mod', model)
+    if mesh['dp'].get_local_rank() != 0:
+        # other data parallel replicas have same state
+        return {}, {}
+    pp_mesh = mesh['pp']
+    names = {p: _strip_prefix(n) for n, p in stage.named_parameters()}
+    to_cpu = lambda v: v.cpu() if isinstance(v, torch.Tensor) else v
+    local = {'model': {_strip_prefix(k): v.cpu() for k, v in stage.state_dict().items()},
+             'groups': _stage_param_groups(stage, optimizer),
+             'state': {names[p]: {k: to_cpu(v) for k, v in s.items()} for p, s in optimizer.state.items()}}
+    is_dst = pp_mesh.get_local_rank() == 0
+    gathered = [None] * pp_mesh.size() if is_dst else None
+    dist.gather_object(local, gathered, dst=dist.get_global_rank(pp_mesh.get_group(), 0), group=pp_mesh.get_group())
+    if not is_dst:
+        return {}, {}
+
+    model_state, name_state = {}, {}
+    for stage_state in gathered: # type: ignore
+        model_state.update(stage_state['model'])
+        for name, param_state in stage_state['state'].items():
+            # tied copy on last stage is same as first stage's
+            name_state.setdefault(stage.tied_names.get(name, name), param_state)
+    full_groups = _full_param_groups([g['groups'] for g in gathered], # type: ignore
+                                     stage.full_param_names, stage.tied_names)
+
+    state, param_groups, index = {}, [], 0
+    for group, names_ in zip(optimizer.param_groups, full_groups):
+        indices = []
+        for name in names_:
+            if name in name_state:
+                state[index] = name_state[name]
+            indices.append(index)
+            index += 1
+        param_groups.append({**{k: v for k, v in group.items() if k != 'params'}, 'params': indices})
+    return model_state, {'state': state, 'param_groups': param_groups}
+
+def load_full_state_dicts(model:torch.nn.Module, optimizer, model_state:Mapping[str, Any],
+                          optim_state:Mapping[str, Any], mesh:DeviceMesh)->None:
+    """Loads params and optimizer state of this stage from full state dicts (as saved by DDP or full_state_dicts()).
+
+    Must be called on all ranks with the same state dicts.
+    """
+    stage:GPTStage = getattr(model, '_orig_mod', model)
+    model_state = {_strip_prefix(k): v for k, v in model_state.items()}
+    stage.load_state_dict({k: model_state[k] for k in stage.state_dict().keys()})
+
+    # index of param in full optimizer state depends on params of all stages
+    pp_mesh = mesh['pp']
+    stage_groups = _stage_param_groups(stage, optimizer)
+    all_stage_groups = [None] * pp_mesh.size()
+    dist.all_gather_object(all_stage_groups, stage_groups, group=pp_mesh.get_group())
+    full_groups = _full_param_groups(all_stage_groups, stage.full_param_names, stage.tied_names) # type: ignore
+    full_index = {n: i for i, n in enumerate(n for names in full_groups for n in names)}
+
+    state, param_groups, index = {}, [], 0
+    for names, saved_group in zip(stage_groups, optim_state['param_groups']):
+        indices = []
+        for name in names:
+            saved_index = full_index[stage.tied_names.get(name, name)]
+            if saved_index in optim_state['state']:
+                state[index] = optim_state['state'][saved_index]
+            indices.append(index)
+            index += 1
+        param_groups.append({**saved_group, 'params': indices})
+    optimizer.load_state_dict({'state': state, 'param_groups': param_groups})
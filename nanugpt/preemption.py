@@ -0,0 +1,85 @@
+from typing import Optional, Sequence
+import os
+import time
+import signal
+import threading
+
+import psutil
+
+"""
+Preemption-aware exit: when the job is about to be killed, training saves a checkpoint at
+the next step boundary and exits with REQUEUE_EXIT_CODE so the job can be requeued and
+resume from it instead of losing everything since the last periodic checkpoint.
+
+Two things tell us the job is about to be killed:
+    signals : SLURM sends SIGTERM on preemption and can send SIGUSR1 before walltime with
+              sbatch --signal=USR1@<seconds>. Handler only sets a flag, the training loop
+              acts on it at the next step boundary.
+    walltime: if deadline is known (SLURM_JOB_END_TIME or walltime_hr), we stop margin_s
+              before it. margin_s must cover a step plus writing the checkpoint.
+
+Ranks get signals at slightly different times, so the training loop all-reduces the flag
+with MAX on every step and all ranks stop at the same step.
+
+torchrun sees REQUEUE_EXIT_CODE as a failure and restarts workers (up to --max-restarts),
+then exits with its own code. So walltime_hr is measured from start of torchrun, not of
+the restarted worker, training exits right away if deadline has already passed, and
+workers touch NANUGPT_REQUEUE_FILE, if set, so launcher can tell preemption from failure
+(see train_dist.sh).
+"""
+
+REQUEUE_EXIT_CODE = 75 # EX_TEMPFAIL, i.e., try again later
+
+class Preemption:
+    def __init__(self, signals:Sequence[str], deadline:Optional[float], margin_s:float):
+        self.deadline = deadline
+        self.margin_s = margin_s
+        self.reason:Optional[str] = None
+        self._prev_handlers = {}
+        # Python only allows handlers to be set from main thread
+        if threading.current_thread() is threading.main_thread():
+            for name in signals:
+                signum = signal.Signals[name]
+                self._prev_handlers[signum] = signal.signal(signum, self._handler)
+
+    def _handler(self, signum, frame):
+        self.reason = signal.Signals(signum).name
+
+    def requested(self)->bool:
+        """True if this rank got a signal or is close to deadline."""
+        if self.reason is None and self.deadline is not None and \
+                time.time() > self.deadline - self.margin_s:
+            self.reason = 'walltime'
+        return self.reason is not None
+
+    def close(self)->None:
+        for signum, handler in self._prev_handlers.items():
+            signal.signal(signum, handler)
+        self._prev_handlers.clear()
+
+def _start_time()->float:
+    # restarted workers are new processes but torchrun agent, our parent, lives for the whole job
+    if 'TORCHELASTIC_RESTART_COUNT' in os.environ:
+        return psutil.Process(os.getppid()).create_time()
+    return time.time()
+
+def get_deadline(walltime_hr:float)->Optional[float]:
+    """Unix time when job will be killed, SLURM's end time takes precedence over walltime_hr from start."""
+    slurm_end_time = os.environ.get('SLURM_JOB_END_TIME', None)
+    if slurm_end_time:
+        return float(slurm_end_time)
+    return _start_time() + walltime_hr * 3600 if walltime_hr > 0 else None
+
+def mark_requeue()->None:
+    """Tells launcher that we exited for requeue, exit code alone is lost when torchrun is used."""
+    requeue_filepath = os.environ.get('NANUGPT_REQUEUE_FILE', '')
+    if requeue_filepath:
+        open(requeue_filepath, 'w').close()
+
+def create_preemption(signals:str, walltime_hr:float, margin_s:float)->Optional[Preemption]:
+    """signals is comma separated names such as 'SIGTERM,SIGUSR1'."""
+    signal_names = [s.strip() for s in signals.split(',') if s.strip()]
+    deadline = get_deadline(walltime_hr)
+    if not signal_names and deadline is None:
+        return None
+    return Preemption(signal_names, deadline, margin_s)
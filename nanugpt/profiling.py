@@ -0,0 +1,116 @@
+from typing import Mapping, Optional
+import os
+import signal
+import threading
+
+from torch import profiler
+
+from nanugpt import utils
+from nanugpt import glogging as logging
+
+"""
+torch.profiler capture driven by training.profile config so we can get traces from any
+run without code changes:
+
+    training.profile.enabled=true: profile wait/warmup/active steps, repeated repeat times,
+        from start of training.
+    signal (e.g. kill -USR2 <pid>) or touching trigger_file in out_dir: profile one
+        warmup/active window starting at next step, so a long run that slows down can be
+        profiled when it happens. File trigger fires each time file's modification time
+        changes so all ranks see it without anyone deleting it.
+
+Each active window writes a Chrome trace (also readable by TensorBoard) and a table of
+top_k ops by self time per rank to out_dir (default <general.out_dir>/profile).
+"""
+
+class Profiler:
+    def __init__(self, profile_config:Mapping, out_dir:str, global_rank:int, is_cuda:bool):
+        self.config = profile_config
+        # config values may have ~ and $vars, e.g. ~/out_dir/$run_name
+        out_dir = utils.full_path(out_dir)
+        self.out_dir = utils.full_path(profile_config.get('out_dir', '') or os.path.join(out_dir, 'profile'))
+        self.global_rank = global_rank
+        self.activities = [{'cpu': profiler.ProfilerActivity.CPU, 'cuda': profiler.ProfilerActivity.CUDA}[a.strip()]
+                           for a in profile_config.get('activities', 'cpu,cuda').split(',')
+                           if a.strip() and (a.strip() != 'cuda' or is_cuda)]
+        self.sort_by = 'self_device_time_total' if profiler.ProfilerActivity.CUDA in self.activities \
+                       else 'self_cpu_time_total'
+        self.top_k = profile_config.get('top_k', 30)
+        self.prof:Optional[profiler.profile] = None
+        self.steps_left = 0
+        self.train_step = 0
+
+        trigger_file = profile_config.get('trigger_file', '')
+        self.trigger_filepath = os.path.join(out_dir, trigger_file) if trigger_file else None
+        self.trigger_mtime = self._trigger_mtime()
+        self.signal_triggered = False
+        self.prev_handler = None
+        trigger_signal = profile_config.get('trigger_signal', '')
+        # handlers can only be installed from main thread
+        self.trigger_signal = signal.Signals[trigger_signal] if trigger_signal and \
+            threading.current_thread() is threading.main_thread() else None
+        if self.trigger_signal is not None:
+            self.prev_handler = signal.signal(self.trigger_signal, self._on_signal)
+
+        if profile_config.get('enabled', False):
+            self._start(profile_config.get('wait', 10), profile_config.get('repeat', 1))
+
+    def _on_signal(self, signum, frame):
+        self.signal_triggered = True
+
+    def _trigger_mtime(self)->Optional[float]:
+        if self.trigger_filepath is None or not os.path.exists(self.trigger_filepath):
+            return None
+        return os.path.getmtime(self.trigger_filepath)
+
+    def _start(self, wait:int, repeat:int):
+        warmup, active = self.config.get('warmup', 2), self.config.get('active', 3)
+        # repeat=0 keeps profiling until training ends
+        self.steps_left = (wait + warmup + active) * repeat if repeat > 0 else -1
+        self.prof = profiler.profile(
+            activities=self.activities,
+            schedule=profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=self.config.get('record_shapes', False),
+            profile_memory=self.config.get('profile_memory', False),
+            with_stack=self.config.get('with_stack', False))
+        self.prof.start()
+
+    def _on_trace_ready(self, prof:profiler.profile):
+        # name by training step at which active window ended so traces from multiple windows don't collide
+        name = f'rank{self.global_rank}_step{self.train_step}'
+        profiler.tensorboard_trace_handler(self.out_dir, worker_name=name)(prof)
+        table = prof.key_averages(group_by_input_shape=self.config.get('record_shapes', False)) \
+                    .table(sort_by=self.sort_by, row_limit=self.top_k)
+        table_filepath = os.path.join(self.out_dir, f'{name}_top{self.top_k}.txt')
+        with open(table_filepath, 'w') as f:
+            f.write(table)
+        logging.info({'profile/trace_dir': self.out_dir, 'profile/table': table_filepath})
+
+    def step(self, train_step:int)->None:
+        """Call at end of each training step."""
+        self.train_step = train_step
+        if self.prof is not None:
+            self.prof.step()
+            self.steps_left -= 1
+            if self.steps_left == 0:
+                self._stop()
+            return
+
+        mtime = self._trigger_mtime()
+        file_triggered = mtime is not None and mtime != self.trigger_mtime
+        if self.signal_triggered or file_triggered:
+            logging.info(f'Profiling triggered by {"signal" if self.signal_triggered else "file"}')
+            self.signal_triggered, self.trigger_mtime = False, mtime
+            self._start(wait=0, repeat=1)
+
+    def _stop(self)->None:
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
+
+    def close(self)->None:
+        self._stop()
+        if self.trigger_signal is not None:
+            signal.signal(self.trigger_signal, self.prev_handler)
+            self.trigger_signal = None
@@ -1,27 +1,33 @@
-from typing import Any, Dict
+from typing import Any, Dict, Union
 
 import torch
 
 from nanugpt.scalers.scaler_base import ScalerBase
+from nanugpt import utils
 from nanugpt.utils import TorchInfo
 
 class AmpGradScaler(ScalerBase):
     def __init__(self, torch_info: TorchInfo):
         # initialize a GradScaler. If enabled=False scaler is a no-op
         # we need loss scaling only for fp16 due to reduced precision, not bf16 or fp32
-        self.scaler = torch.amp.GradScaler("cuda", enabled=(torch_info.pt_dtype == torch.float16)) # type: ignore
+        self.scaler = torch.amp.GradScaler(torch_info.device_type, enabled=(torch_info.pt_dtype == torch.float16)) # type: ignore
 
     def backward(self, loss):
         # backward pass, with gradient scaling if training in fp16
         self.scaler.scale(loss).backward()
 
     # clip the gradients and returns the pre-clip norm
-    def clip(self, model, optimizer, grad_clip:float)->float:
+    def clip(self, model, optimizer, grad_clip:float)->Union[float, torch.Tensor]:
         pre_clip_norm = -1.0 # pre-clip norm not available
         if grad_clip != 0.0:
             # unscale the gradients and then clip
             self.scaler.unscale_(optimizer)
-            pre_clip_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip).item()
+            if utils.is_model_parallel(model.parameters()):
+                # norm must include grads of params on other ranks
+                pre_clip_norm = utils.clip_grad_norm_(model.parameters(), grad_clip)
+            else:
+                # torch uses foreach kernels by default only on cuda
+                pre_clip_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip, foreach=True)
         return pre_clip_norm
 
     def step(self, optimizer):
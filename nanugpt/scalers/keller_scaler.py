@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Union
 
 import torch
 
@@ -14,11 +14,16 @@ class KellerScaler(ScalerBase):
         loss.backward()
 
     # clip the gradients and returns the pre-clip norm
-    def clip(self, model, optimizer, grad_clip:float)->float:
+    def clip(self, model, optimizer, grad_clip:float)->Union[float, torch.Tensor]:
         pre_clip_norm = -1.0 # pre-clip norm not available
         if grad_clip != 0.0:
-            for p in model.parameters():
-                p.grad = grad_clip*p.grad / (p.grad.norm() + 1e-6)
+            # each grad is scaled to norm grad_clip, in place with multi-tensor kernels
+            grads = [p.grad for p in model.parameters() if p.grad is not None]
+            coefs = torch._foreach_norm(grads)
+            torch._foreach_add_(coefs, 1e-6)
+            torch._foreach_reciprocal_(coefs)
+            torch._foreach_mul_(coefs, grad_clip)
+            torch._foreach_mul_(grads, coefs)
         return pre_clip_norm
 
     def step(self, optimizer):
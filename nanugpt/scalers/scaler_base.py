@@ -1,7 +1,10 @@
 
 
-from typing import Any, Dict
+from typing import Any, Dict, Union
 from abc import ABC, abstractmethod
+
+import torch
+
 from nanugpt.utils import TorchInfo
 
 class ScalerBase(ABC):
@@ -10,8 +13,8 @@ class ScalerBase(ABC):
         pass
     @abstractmethod
     # clip the gradients and returns the pre-clip norm
-    def clip(self, model, optimizer, grad_clip:float)->float:
-        # pre-clip norm not available if -1.0
+    def clip(self, model, optimizer, grad_clip:float)->Union[float, torch.Tensor]:
+        # pre-clip norm not available if -1.0, can be device tensor so clip doesn't sync
         pass
     @abstractmethod
     def step(self, optimizer):
@@ -0,0 +1,173 @@
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+import os
+
+import torch
+
+from nanugpt import utils
+
+"""
+Distributed checkpoint layout where each rank writes its own shard in parallel.
+
+A sharded checkpoint is a directory:
+    checkpoint_<step>/
+        metadata.yaml       # written by rank 0, lists shards and where each tensor lives
+        shard_00000.pt      # model tensors and optimizer state owned by rank 0 + common state
+        shard_00001.pt      # ... owned by rank 1
+        ...
+
+Model tensors are replicated across ranks so they are simply split between ranks
+by size. Optimizer state is saved by the rank that owns it: for ZeroRedundancyOptimizer
+this is the rank holding that partition (so no consolidate_state_dict() is needed),
+for regular optimizers it's the same split as model tensors. Everything is keyed by
+parameter name, not by position, so on load each rank picks the tensors it needs
+from whichever shard has them. This allows loading with different world size.
+
+A checkpoint is complete only when all shards listed in metadata.yaml exist (each
+shard is written atomically) and are of the step in metadata.yaml. Same directory may
+be rewritten at later step (e.g. 'best'), so a crash midway leaves shards of
+different steps which must not be loaded together.
+"""
+
+METADATA_FILENAME = 'metadata.yaml'
+
+def shard_filename(rank:int)->str:
+    return f'shard_{rank:05d}'
+
+def _strip_prefix(name:str)->str:
+    # compiled models have _orig_mod. prefix
+    return name[len('_orig_mod.'):] if name.startswith('_orig_mod.') else name
+
+def assign_shards(sizes:Mapping[str, int], world_size:int)->Dict[str, int]:
+    """Greedy balance of keys across ranks by size, same result on all ranks."""
+    loads = [0] * world_size
+    assignment = {}
+    for key in sorted(sizes.keys(), key=lambda k: (-sizes[k], k)):
+        rank = loads.index(min(loads))
+        assignment[key] = rank
+        loads[rank] += sizes[key]
+    return assignment
+
+def _inner_optimizer(optimizer)->torch.optim.Optimizer:
+    # ZeroRedundancyOptimizer keeps local partition in .optim
+    return getattr(optimizer, 'optim', optimizer)
+
+def _is_zero(optimizer)->bool:
+    return hasattr(optimizer, 'consolidate_state_dict') and hasattr(optimizer, 'optim')
+
+def _param_names(model:torch.nn.Module)->Dict[torch.nn.Parameter, str]:
+    return {p: _strip_prefix(n) for n, p in model.named_parameters()}
+
+def _owned_optim_params(model:torch.nn.Module, optimizer, global_rank:int,
+                        world_size:int)->List[torch.nn.Parameter]:
+    """Parameters whose optimizer state is saved by this rank."""
+    inner = _inner_optimizer(optimizer)
+    params = [p for group in inner.param_groups for p in group['params']]
+    if _is_zero(optimizer):
+        return params # local partition
+    names = _param_names(model)
+    assignment = assign_shards({names[p]: p.numel() for p in params}, world_size)
+    return [p for p in params if assignment[names[p]] == global_rank]
+
+def save_sharded(checkpointer, name:str, model:torch.nn.Module, optimizer,
+                 global_rank:int, world_size:int,
+                 common:Mapping[str, Any], rank_state:Mapping[str, Any],
+                 val_loss:float=float('inf'))->str:
+    """Writes this rank's shard using `checkpointer` (AsyncCheckpointer), returns checkpoint dir.
+
+    Must be called on all ranks. `common` is state that is same on all ranks
+    (scheduler, trainer counters etc.) and is only stored in rank 0 shard.
+    `rank_state` is per rank state such as RNG and data position.
+    """
+    checkpoint_dir = os.path.join(checkpointer.out_dir, name)
+
+    model_state = {_strip_prefix(k): v for k, v in model.state_dict().items()}
+    model_assignment = assign_shards({k: v.numel() for k, v in model_state.items()}, world_size)
+
+    inner = _inner_optimizer(optimizer)
+    names = _param_names(model)
+    optim_state = {names[p]: inner.state[p] for p in _owned_optim_params(model, optimizer, global_rank, world_size) \
+                   if p in inner.state}
+    shard = {'model': {k: v for k, v in model_state.items() if model_assignment[k] == global_rank},
+             'optimizer': optim_state,
+             'rank_state': rank_state,
+             'train/step': common.get('train/step', None)}
+
+    if global_rank == 0:
+        # hyperparams such as lr for each param group, params are restored by name
+        shard['common'] = {**common,
+            'optimizer_param_groups': [{k: v for k, v in g.items() if k != 'params'} \
+                                       for g in optimizer.param_groups]}
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        utils.save_yaml({'world_size': world_size,
+                         'shards': [shard_filename(r) + '.pt' for r in range(world_size)],
+                         'model_keys': model_assignment,
+                         'zero_optimizer': _is_zero(optimizer),
+                         'train/step': common.get('train/step', None),
+                        }, os.path.join(checkpoint_dir, METADATA_FILENAME))
+
+    checkpointer.save(os.path.join(name, shard_filename(global_rank)), shard, val_loss=val_loss)
+    return checkpoint_dir
+
+def is_sharded_checkpoint(path:str)->bool:
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, METADATA_FILENAME))
+
+def _load_shard(checkpoint_dir:str, shard:str)->Dict[str, Any]:
+    # mmap so we only page in the tensors we actually need
+    return torch.load(os.path.join(checkpoint_dir, shard), map_location='cpu', weights_only=True, mmap=True)
+
+def is_complete(checkpoint_dir:str)->bool:
+    if not is_sharded_checkpoint(checkpoint_dir):
+        return False
+    metadata = utils.load_yaml(os.path.join(checkpoint_dir, METADATA_FILENAME))
+    if not all(os.path.isfile(os.path.join(checkpoint_dir, s)) for s in metadata['shards']):
+        return False
+    # shards left from previous save into same dir
+    return all(_load_shard(checkpoint_dir, s).get('train/step', None) == metadata['train/step'] \
+               for s in metadata['shards'])
+
+def load_sharded(checkpoint_dir:str, model:torch.nn.Module, optimizer,
+                 global_rank:int, world_size:int)->Tuple[Dict[str, Any], Optional[Mapping[str, Any]]]:
+    """Loads model and this rank's optimizer state from sharded checkpoint.
+
+    World size can be different from the one checkpoint was saved with.
+    Returns (common state, rank state) where rank state is None if world size changed.
+    """
+    metadata = utils.load_yaml(os.path.join(checkpoint_dir, METADATA_FILENAME))
+    shards = [_load_shard(checkpoint_dir, s) for s in metadata['shards']]
+    steps = [shard.get('train/step', None) for shard in shards]
+    if any(s != metadata['train/step'] for s in steps):
+        raise ValueError(f"Shards in {checkpoint_dir} are from steps {steps} but metadata is for step {metadata['train/step']}")
+
+    # model is replicated so gather all tensors
+    model_state = {}
+    for shard in shards:
+        model_state.update(shard['model'])
+    getattr(model, '_orig_mod', model).load_state_dict(model_state)
+
+    # find optimizer state for the params this rank needs
+    saved_optim_state = {}
+    for shard in shards:
+        saved_optim_state.update(shard['optimizer'])
+    common = shards[0]['common']
+    saved_groups = common.pop('optimizer_param_groups')
+
+    inner = _inner_optimizer(optimizer)
+    names = _param_names(model)
+    # build regular optimizer state_dict so torch takes care of device and dtype casting
+    param_index, state, groups = 0, {}, []
+    for group, saved_group in zip(inner.param_groups, saved_groups):
+        indices = []
+        for p in group['params']:
+            if names[p] in saved_optim_state:
+                state[param_index] = saved_optim_state[names[p]]
+            indices.append(param_index)
+            param_index += 1
+        groups.append({**saved_group, 'params': indices})
+    inner.load_state_dict({'state': state, 'param_groups': groups})
+    if inner is not optimizer:
+        # ZeRO syncs local hyperparams from its global param groups at step
+        for group, saved_group in zip(optimizer.param_groups, saved_groups):
+            group.update({k: v for k, v in saved_group.items() if k != 'params'})
+
+    rank_state = shards[global_rank]['rank_state'] if metadata['world_size'] == world_size else None
+    return common, rank_state
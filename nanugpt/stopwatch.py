@@ -27,6 +27,9 @@
     sw.elapsed_stddev('section1')
     sw.elapsed_len('section1')
 
+    # add time measured elsewhere
+    sw.add(0.5, 'section1')
+
     # report
     sw.report('section1') # returns a dict
     sw.report_all() # returns a dict of dicts
@@ -80,6 +83,12 @@ class _Clock:
         self._times.append(delta)
         self.state = _ClockState.STOPPED
 
+    def add(self, delta:float):
+        """Adds time measured elsewhere, e.g., by CUDA events."""
+        if not self.enabled:
+            return
+        self._times.append(delta)
+
     def elapsed_total(self):
         return sum(self._times)
 
@@ -127,6 +136,12 @@ class StopWatch:
     def stop(self, tag=None):
         self.pause(tag)
 
+    def add(self, delta:float, tag=None):
+        if tag is None:
+            tag = _Clock.tag_default
+        with _Clock.th_lock:
+            self.clocks[tag].add(delta)
+
     def clear(self, tag=None):
         if tag is None:
             tag = _Clock.tag_default
@@ -0,0 +1,75 @@
+from typing import Dict, List, Sequence
+import socket
+
+import torch
+from torch import distributed as dist
+
+from nanugpt import utils
+
+"""
+Per-rank timing telemetry to find slow GPUs or nodes. Metrics reduced with SUM hide a
+single slow rank, so at log steps each rank's timings are gathered and we log min, max and
+the rank with max for each of them, e.g. train/fwd_interval_max_rank.
+
+Step and fwd/bwd times are nearly same on all ranks because fast ranks wait for the slow
+one in grad all-reduce. Forward has no collectives with DDP so its time shows which rank is
+actually slow and is used to spot stragglers: ranks whose forward time is more than
+slow_factor x median are counted and every report_every log steps we report ranks (and their
+hosts) that were slow in more than half of them.
+"""
+
+class RankTimes:
+    def __init__(self, names:Sequence[str], slow_name:str, torch_info:utils.TorchInfo, device,
+                 report_every:int, slow_factor:float=1.1):
+        self.names = list(names)
+        self.slow_index = self.names.index(slow_name)
+        self.device = device
+        self.world_size = torch_info.world_size
+        self.report_every = report_every
+        self.slow_factor = slow_factor
+
+        self.hosts = [socket.gethostname()] * self.world_size
+        if torch_info.is_distributed:
+            dist.all_gather_object(self.hosts, socket.gethostname())
+        self._reset()
+
+    def _reset(self):
+        self.slow_counts = torch.zeros(self.world_size, dtype=torch.int64)
+        self.slow_ratios = torch.zeros(self.world_size, dtype=torch.float64)
+        self.n_gathers = 0
+
+    def gather(self, values:Sequence[float])->Dict[str, float]:
+        """Gathers values of names from all ranks, all ranks must call this."""
+        local = torch.tensor(values, dtype=torch.float32, device=self.device)
+        if self.world_size > 1:
+            gathered = torch.empty(self.world_size * len(self.names), dtype=torch.float32, device=self.device)
+            dist.all_gather_into_tensor(gathered, local)
+            times = gathered.view(self.world_size, -1).cpu()
+        else:
+            times = local.cpu().unsqueeze(0)
+
+        metrics = {}
+        for i, name in enumerate(self.names):
+            metrics[name + '_min'] = times[:, i].min().item()
+            metrics[name + '_max'] = times[:, i].max().item()
+            metrics[name + '_max_rank'] = int(times[:, i].argmax().item())
+
+        ratios = times[:, self.slow_index].double() / max(times[:, self.slow_index].median().item(), 1e-12)
+        self.slow_counts += (ratios > self.slow_factor).long()
+        self.slow_ratios += ratios
+        self.n_gathers += 1
+        return metrics
+
+    def report(self)->List[str]:
+        """Returns description of consistently slow ranks every report_every gathers, else empty list."""
+        if self.report_every <= 0 or self.n_gathers < self.report_every:
+            return []
+        slow_ranks = (self.slow_counts * 2 > self.n_gathers).nonzero().flatten().tolist()
+        lines = [f'rank {r} on {self.hosts[r]} was slow in {self.slow_counts[r]}/{self.n_gathers} log steps, '
+                 f'{self.slow_ratios[r] / self.n_gathers:.2f}x median {self.names[self.slow_index]}'
+                 for r in slow_ranks]
+        slow_hosts = sorted(set(self.hosts[r] for r in slow_ranks))
+        if slow_hosts:
+            lines.append(f'slow hosts: {", ".join(slow_hosts)}')
+        self._reset()
+        return lines
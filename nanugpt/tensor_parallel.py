@@ -0,0 +1,216 @@
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch import distributed as dist
+from torch.distributed.device_mesh import init_device_mesh, DeviceMesh
+
+from nanugpt import utils
+from nanugpt.models import nanogpt
+
+"""
+Megatron style tensor parallelism (TP) for nanogpt blocks, composed with data parallelism
+on 2D (dp, tp) device mesh.
+
+Within a block, the first linear of attention (c_attn) and of MLP (c_fc) are split by output
+features (column parallel) and the second one (c_proj) is split by input features (row
+parallel). So each TP rank computes its own attention heads and its own slice of MLP hidden
+units without any communication in between, and only the output of c_proj needs to be
+summed across TP ranks:
+
+    x -> copy_to_tp -> c_attn (column) -> local heads -> c_proj (row) -> reduce_from_tp -> + bias
+
+copy_to_tp is identity in forward and all-reduces grads in backward, reduce_from_tp is the
+opposite. That is two all-reduces per block in forward and two in backward. Everything else
+(embeddings, layer norms, lm_head, biases of row parallel layers) is replicated on TP ranks
+and gets identical grads so it stays in sync without extra communication. TP ranks share
+RNG so dropout on replicated activations is same on all of them, this also means attention
+dropout masks of heads on different TP ranks are correlated.
+
+c_attn fuses q, k and v so its output is split as 3 parts, each rank gets the rows of its
+heads from each of q, k and v.
+
+Ranks in the same TP group must see the same batch so data is sharded by data parallel rank
+(see utils.get_data_parallel_rank()). TP groups are contiguous ranks which usually
+puts them on the same node. DDP syncs grads within each dp group, i.e. between ranks that
+hold the same shards.
+
+Checkpoints use the same full (unsharded) state dict format as DDP/single device runs so
+they are interchangeable. Sharded params are all-gathered across TP ranks for saving and
+sliced back on load.
+"""
+
+class ShardSpec(NamedTuple):
+    dim: int   # dimension that is split across TP ranks
+    parts: int # number of independent parts in dim (3 for fused qkv), each part is split separately
+
+def shard_tensor(t:torch.Tensor, spec:ShardSpec, rank:int, size:int)->torch.Tensor:
+    """Returns slice of full tensor t that TP rank holds."""
+    return torch.cat([part.chunk(size, dim=spec.dim)[rank] for part in t.chunk(spec.parts, dim=spec.dim)],
+                     dim=spec.dim)
+
+def unshard_tensor(shards:List[torch.Tensor], spec:ShardSpec)->torch.Tensor:
+    """Inverse of shard_tensor, shards are in TP rank order."""
+    rank_parts = [s.chunk(spec.parts, dim=spec.dim) for s in shards]
+    return torch.cat([torch.cat([p[i] for p in rank_parts], dim=spec.dim) for i in range(spec.parts)],
+                     dim=spec.dim)
+
+
+class _CopyToTP(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, group):
+        ctx.group = group
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        # each TP rank has grad from its own shard, input grad is the sum
+        grad = grad.contiguous()
+        dist.all_reduce(grad, group=ctx.group)
+        return grad, None
+
+class _ReduceFromTP(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, group):
+        x = x.contiguous()
+        dist.all_reduce(x, group=group)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad, None
+
+def copy_to_tp(x:torch.Tensor, group)->torch.Tensor:
+    return _CopyToTP.apply(x, group) # type: ignore
+
+def reduce_from_tp(x:torch.Tensor, group)->torch.Tensor:
+    return _ReduceFromTP.apply(x, group) # type: ignore
+
+
+class _ParallelLinear(nn.Module):
+    # keeps weight and bias names of nn.Linear so state dict keys don't change
+    def __init__(self, linear:nn.Linear, group, weight_spec:ShardSpec, bias_spec:Optional[ShardSpec]):
+        super().__init__()
+        self.group = group
+        rank, size = dist.get_rank(group), dist.get_world_size(group)
+        self.weight = self._param(linear.weight, weight_spec, rank, size)
+        if linear.bias is None:
+            self.register_parameter('bias', None)
+        else:
+            self.bias = self._param(linear.bias, bias_spec, rank, size)
+
+    def _param(self, full:torch.Tensor, spec:Optional[ShardSpec], rank:int, size:int)->nn.Parameter:
+        if spec is None:
+            return nn.Parameter(full.detach().clone())
+        p = nn.Parameter(shard_tensor(full.detach(), spec, rank, size).clone())
+        # used to gather full state and to compute norms of sharded params
+        p.tp_spec = spec # type: ignore
+        p.tp_group = self.group # type: ignore
+        return p
+
+class ColumnParallelLinear(_ParallelLinear):
+    """Linear with output features split across TP ranks, input is replicated."""
+    def __init__(self, linear:nn.Linear, group, parts:int=1):
+        super().__init__(linear, group, ShardSpec(0, parts), ShardSpec(0, parts))
+
+    def forward(self, x):
+        return F.linear(copy_to_tp(x, self.group), self.weight, self.bias)
+
+class RowParallelLinear(_ParallelLinear):
+    """Linear with input features split across TP ranks, output is summed over TP ranks."""
+    def __init__(self, linear:nn.Linear, group):
+        # bias is replicated and added after the sum
+        super().__init__(linear, group, ShardSpec(1, 1), None)
+
+    def forward(self, x):
+        y = reduce_from_tp(F.linear(x, self.weight), self.group)
+        return y + self.bias if self.bias is not None else y
+
+
+def init_mesh(torch_info:utils.TorchInfo, tp_size:int)->DeviceMesh:
+    """Creates 2D (dp, tp) mesh, TP groups are contiguous ranks."""
+    if tp_size < 1 or torch_info.world_size % tp_size != 0:
+        raise ValueError(f'tensor_parallel_size {tp_size} must divide world size {torch_info.world_size}')
+    return init_device_mesh(torch_info.device_type, (torch_info.world_size // tp_size, tp_size),
+                            mesh_dim_names=('dp', 'tp'))
+
+def apply_tensor_parallel(model:torch.nn.Module, tp_mesh:DeviceMesh)->torch.nn.Module:
+    """Shards attention heads and MLP hidden units of each block across tp_mesh in-place and returns model."""
+    # compiled model wraps the original in _orig_mod, we change the original in-place
+    compiled_model, model = model, getattr(model, '_orig_mod', model)
+    group, size = tp_mesh.get_group(), tp_mesh.size()
+
+    # dropout on replicated activations must drop same elements on all TP ranks so we share RNG
+    # within TP group (ranks are seeded differently by default)
+    seed = [torch.randint(0, 2**31, (1,)).item()]
+    dist.broadcast_object_list(seed, src=dist.get_global_rank(group, 0), group=group)
+    torch.manual_seed(seed[0])
+
+    # like DDP, start all ranks from rank 0's weights as init may not be seeded same on all ranks
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(t, src=0)
+
+    blocks = getattr(getattr(model, 'transformer', None), 'h', None)
+    if blocks is None:
+        raise ValueError(f'Tensor parallel requires model with transformer blocks in model.transformer.h but {type(model)} has none')
+    for block in blocks:
+        attn, mlp = getattr(block, 'attn', None), getattr(block, 'mlp', None)
+        if not isinstance(attn, nanogpt.CausalSelfAttention) or not isinstance(mlp, nanogpt.MLP):
+            raise ValueError(f'Tensor parallel is only supported for nanogpt blocks but got {type(block)}')
+        if attn.n_head % size != 0:
+            raise ValueError(f'n_head {attn.n_head} must be divisible by tensor_parallel_size {size}')
+
+        attn.c_attn = ColumnParallelLinear(attn.c_attn, group, parts=3) # type: ignore
+        attn.c_proj = RowParallelLinear(attn.c_proj, group) # type: ignore
+        # attention only sees its own heads
+        attn.n_head //= size
+        attn.n_embd //= size
+        mlp.c_fc = ColumnParallelLinear(mlp.c_fc, group) # type: ignore
+        mlp.c_proj = RowParallelLinear(mlp.c_proj, group) # type: ignore
+
+    return compiled_model
+
+def _gather(t:torch.Tensor, p:torch.nn.Parameter)->torch.Tensor:
+    shards = [torch.empty_like(t) for _ in range(dist.get_world_size(p.tp_group))] # type: ignore
+    dist.all_gather(shards, t.contiguous(), group=p.tp_group) # type: ignore
+    return unshard_tensor(shards, p.tp_spec) # type: ignore
+
+def _shard(t:torch.Tensor, p:torch.nn.Parameter)->torch.Tensor:
+    return shard_tensor(t, p.tp_spec, dist.get_rank(p.tp_group), dist.get_world_size(p.tp_group)).clone() # type: ignore
+
+def _index_params(optimizer)->Dict[int, torch.nn.Parameter]:
+    # optimizer.state_dict() keys params by index in param_groups order
+    return dict(enumerate(p for group in optimizer.param_groups for p in group['params']))
+
+def _map_optim_state(optimizer, optim_state:Mapping[str, Any], fn)->Dict[str, Any]:
+    params = _index_params(optimizer)
+    state = {}
+    for index, param_state in optim_state['state'].items():
+        p = params[index]
+        if hasattr(p, 'tp_spec'):
+            # step counters etc are scalars and same on all ranks
+            param_state = {k: fn(v, p) if isinstance(v, torch.Tensor) and v.dim() == p.dim() else v
+                           for k, v in param_state.items()}
+        state[index] = param_state
+    return {**optim_state, 'state': state}
+
+def full_state_dicts(model:torch.nn.Module, optimizer)->Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Gathers full model and optimizer state dicts, must be called on all ranks."""
+    sharded = {n: p for n, p in model.named_parameters() if hasattr(p, 'tp_spec')}
+    model_state = {k: _gather(v, sharded[k]) if k in sharded else v
+                   for k, v in model.state_dict().items()}
+    return model_state, _map_optim_state(optimizer, optimizer.state_dict(), _gather)
+
+def load_full_state_dicts(model:torch.nn.Module, optimizer,
+                          model_state:Mapping[str, Any], optim_state:Mapping[str, Any])->None:
+    """Loads full state dicts (as saved by DDP or full_state_dicts()) into TP sharded model and optimizer."""
+    unwanted_prefix = '_orig_mod.'
+    sharded = {(n[len(unwanted_prefix):] if n.startswith(unwanted_prefix) else n): p \
+               for n, p in model.named_parameters() if hasattr(p, 'tp_spec')}
+    model_state = {(k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k):v \
+                   for k, v in model_state.items()}
+    model_state = {k: _shard(v, sharded[k]) if k in sharded else v for k, v in model_state.items()}
+    getattr(model, '_orig_mod', model).load_state_dict(model_state)
+    optimizer.load_state_dict(_map_optim_state(optimizer, optim_state, _shard))
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import os
+import functools
 from contextlib import AbstractContextManager
 from typing import Iterator, Mapping, Tuple, Optional, Callable, Mapping, List
 
@@ -127,7 +128,7 @@ def measure_global_batch(config:Mapping,
 
     # setup data
     get_data = utils.import_fn(data_config['module'])
-    get_loss = utils.import_fn(loss_config['module'])
+    get_loss = functools.partial(utils.import_fn(loss_config['module']), **loss_config.get('module_kwargs', {}))
     train_loader, val_loader, test_loader = get_data(**data_config['module_kwargs'])
 
     # create tokenizer
@@ -139,12 +140,12 @@ def measure_global_batch(config:Mapping,
     # create optimizer
     get_optim = utils.import_fn(optimizer_config['module'])
     optimizer = get_optim(model,
-                        enable_fused=torch_info.is_cuda,
+                        enable_fused=utils.fused_adamw_supported(torch_info.device_type),
                         **optimizer_config['module_kwargs'])
 
     # initialize a GradScaler. If enabled=False scaler is a no-op
     # we need loss scaling only for fp16 due to reduced precision, not bf16 or fp32
-    scaler = torch.amp.GradScaler("cuda", enabled=(torch_info.pt_dtype == torch.float16))
+    scaler = torch.amp.GradScaler(torch_info.device_type, enabled=(torch_info.pt_dtype == torch.float16))
 
     batch_iter = iter(infinite_batches(train_loader))
 
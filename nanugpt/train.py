@@ -1,5 +1,6 @@
 from typing import Mapping, Tuple, Optional, Callable, Mapping
 import os
+import functools
 import timeit
 import math
 
@@ -9,7 +10,6 @@ import math
 if os.environ.get("TORCHINDUCTOR_COORDINATE_DESCENT_TUNING", None) is None:
     os.environ["TORCHINDUCTOR_COORDINATE_DESCENT_TUNING"] = "1"
 import torch
-torch.empty(1, device="cuda", requires_grad=True).backward() # prevents a bug on some systems
 
 from torch.nn.parallel import DistributedDataParallel
 from torch import distributed as dist
@@ -18,32 +18,66 @@ from nanugpt import utils
 from nanugpt import common
 from nanugpt import glogging as logging
 from nanugpt import lin_predictor
+from nanugpt import checkpointing
+from nanugpt import sharded_checkpoint
+from nanugpt import delta_checkpoint
+from nanugpt import tensor_parallel
+from nanugpt import comm_hooks
+from nanugpt import local_sgd as local_sgd_module
+from nanugpt import watchdog
+from nanugpt import preemption
+from nanugpt import straggler
+from nanugpt import phase_timer
+from nanugpt import profiling
+from nanugpt import flops_report
+from nanugpt import optimizer_in_backward as optimizer_in_backward_module
 from nanugpt.scalers.scaler_base import ScalerBase
+from nanugpt.scalers.amp_grad_scaler import AmpGradScaler
+
+# these pull in most of torch.distributed and dynamo so load them only if used
+fsdp = utils.LazyModule('nanugpt.fsdp')
+pipeline_parallel = utils.LazyModule('nanugpt.pipeline_parallel')
 
 def estimate_loss(model:torch.nn.Module, get_loss:Callable,
                   data_loader, eval_iters:Optional[int],
-                  amp_ctx, torch_info:utils.TorchInfo, device)->Tuple[float, float, int, int]:
+                  amp_ctx, torch_info:utils.TorchInfo, device,
+                  tp_size:int=1, pipeline:Optional['pipeline_parallel.Pipeline']=None,
+                  wd:Optional[watchdog.Watchdog]=None)->Tuple[float, float, int, int]:
     model.eval()
+    # ranks in same tensor or pipeline parallel group share batches
+    mp_size = tp_size * (pipeline.n_stages if pipeline is not None else 1)
     eval_iters = eval_iters if eval_iters is not None else len(data_loader)
     with torch.no_grad():
         loss_sum, correct_sum, preds_count, sample_count = 0., 0, 0, 0
         for i, (x, y) in enumerate(data_loader):
-            if i >= eval_iters / torch_info.world_size:
+            if i >= eval_iters / (torch_info.world_size // mp_size):
                 break
+            # full test set can take longer than watchdog timeout
+            if wd is not None:
+                wd.beat(f'eval batch {i}')
             x, y = x.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else x.to(device), \
                 y.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else y.to(device)
             #with amp_ctx:
-            loss, correct, n_preds = get_loss(model(x), y)
-            n_samples = len(y)
-            loss_sum += loss.item() * n_samples # loss is average so we need to multiply by n_samples to get total loss over batch
-            correct_sum += correct.item()
+            if pipeline is not None:
+                # metrics are only on last stage, others add 0
+                batch_loss_sum, correct, n_preds = pipeline.eval(x, y)
+                n_samples = len(y) if pipeline.is_last else 0
+                loss_sum += batch_loss_sum
+                correct_sum += correct
+            else:
+                loss, correct, n_preds = get_loss(model(x), y)
+                n_samples = len(y)
+                loss_sum += loss.item() * n_samples # loss is average so we need to multiply by n_samples to get total loss over batch
+                correct_sum += correct.item()
             preds_count += n_preds
             sample_count += n_samples
     iter_count = i+1
-    # gather matrics from all ranks
+    # gather matrics from all ranks, all ranks need same val loss as it decides which checkpoints they keep
     if torch_info.is_distributed:
         fp32_dist = torch.tensor([loss_sum, correct_sum, preds_count, sample_count, iter_count], dtype=torch.float32, device=device)
-        dist.reduce(fp32_dist, dst=0, op=dist.ReduceOp.SUM)
+        dist.all_reduce(fp32_dist, op=dist.ReduceOp.SUM)
+        # ranks in same tensor parallel group evaluate same samples
+        fp32_dist /= tp_size
         loss_sum, correct_sum, preds_count, sample_count, iter_count = tuple(fp32_dist.tolist())
         # convert back to int
         correct_sum, preds_count, sample_count, iter_count = int(correct_sum), int(preds_count), int(sample_count), int(iter_count)
@@ -59,15 +93,70 @@ class Batches:
     def __init__(self, loader) -> None:
         self.loader = loader
         self.iter = iter(loader)
+        self.epoch, self.epoch_batch = 0, 0 # position in data, used for resume
+        self.wait_time, self.fetch_count = 0.0, 0 # time blocked in next() and its calls since last pop_stats()
 
     def next(self):
+        start_time = timeit.default_timer()
         try:
-            return next(self.iter)
+            batch = next(self.iter)
         except StopIteration:
             self.iter = iter(self.loader)
-            return next(self.iter)
+            self.epoch, self.epoch_batch = self.epoch + 1, 0
+            batch = next(self.iter)
+        self.epoch_batch += 1
+        self.wait_time += timeit.default_timer() - start_time
+        self.fetch_count += 1
+        return batch
+
+    def pop_stats(self)->Tuple[float, int]:
+        """Returns time blocked in next() and number of batches fetched since last call."""
+        stats = self.wait_time, self.fetch_count
+        self.wait_time, self.fetch_count = 0.0, 0
+        return stats
+
+    def queue_depth(self)->Optional[int]:
+        """Batches ready in prefetch queue of torch DataLoader workers, None if loader doesn't prefetch
+        or depth isn't available. Best effort: DataLoader doesn't expose its queue so this reads
+        private _data_queue of its iterator, which may change between torch versions."""
+        data_queue = getattr(self.iter, '_data_queue', None)
+        try:
+            return int(data_queue.qsize()) if data_queue is not None else None
+        except Exception: # NotImplementedError on macOS, anything else if torch internals changed
+            return None
+
+    def state_dict(self)->dict:
+        state = {'epoch': self.epoch, 'epoch_batch': self.epoch_batch}
+        if utils.has_method(self.loader, 'state_dict'):
+            state['loader'] = self.loader.state_dict()
+        return state
+
+    def load_state_dict(self, state:Mapping):
+        if 'loader' in state and utils.has_method(self.loader, 'load_state_dict'):
+            # loader can restore its position directly
+            self.loader.load_state_dict(state['loader'])
+            self.iter = iter(self.loader)
+            self.epoch, self.epoch_batch = state['epoch'], state['epoch_batch']
+        else:
+            # fast forward: loader must be freshly created and deterministically seeded
+            # so replaying same number of batches puts us at the same position
+            # (we don't re-create iterator as that draws from loader's generator)
+            assert self.epoch == 0 and self.epoch_batch == 0, "Fast forward requires Batches that hasn't been used yet"
+            while self.epoch < state['epoch'] or self.epoch_batch < state['epoch_batch']:
+                self.next()
 
-def train(config:Mapping, logger:Optional[logging.Logger]=None):
+    def seek(self, tokens_read:int)->bool:
+        """Moves to position after tokens_read tokens of this rank's data, returns False if loader can't seek."""
+        if not utils.has_method(self.loader, 'seek'):
+            return False
+        self.epoch = self.loader.seek(tokens_read)
+        self.epoch_batch = self.loader.batch_index
+        self.iter = iter(self.loader)
+        return True
+
+def train(config:Mapping, logger:Optional[logging.Logger]=None)->bool:
+    """Runs training, returns True if it stopped early on preemption after saving checkpoint
+    so the caller should requeue the job (see preemption.REQUEUE_EXIT_CODE)."""
     start_time = timeit.default_timer()
     global_batch_size = config['training']['global_batch_size']
     project_name = config['logging']['project_name']
@@ -75,16 +164,46 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
     device_batch_size = config['training']['device_batch_size']
     max_steps = config['training']['max_steps']
     grad_clip = config['training']['grad_clip']
+    optimizer_in_backward = config['training'].get('optimizer_in_backward', False)
     enable_train_log = config['training']['enable_train_log']
     train_log_every = config['training']['log_every']
+    enable_flops_report = config['training'].get('flops_report', False)
+    peak_flops = config['training'].get('peak_flops', 0.0)
+    profile_config = config['training'].get('profile', {})
     eval_every = config['eval']['eval_every']
     eval_iters = config['eval']['eval_iters']
     save_checkpoint = config['eval']['save_checkpoint']
     checkpoint_every_hr = config['eval']['checkpoint_every_hr']
     checkpoint_keep_best = config['eval']['checkpoint_keep_best']
+    checkpoint_async = config['eval'].get('checkpoint_async', True)
+    checkpoint_keep_last = config['eval'].get('checkpoint_keep_last', 0)
+    checkpoint_format = config['eval'].get('checkpoint_format', 'full')
+    checkpoint_full_every = config['eval'].get('checkpoint_full_every', 10)
 
     checkoint_after = config['eval']['checkoint_after']
     out_dir = config['general']['out_dir']
+    resume_from = config['general'].get('resume_from', None)
+    parallelism = config['general'].get('parallelism', 'ddp')
+    fsdp_param_dtype = config['general'].get('fsdp_param_dtype', '')
+    fsdp_reduce_dtype = config['general'].get('fsdp_reduce_dtype', 'float32')
+    fsdp_reshard_after_forward = config['general'].get('fsdp_reshard_after_forward', True)
+    fsdp_cpu_offload = config['general'].get('fsdp_cpu_offload', False)
+    tensor_parallel_size = config['general'].get('tensor_parallel_size', 1)
+    pipeline_parallel_size = config['general'].get('pipeline_parallel_size', 1)
+    ddp_comm_hook = config['general'].get('ddp_comm_hook', '')
+    powersgd_rank = config['general'].get('powersgd_rank', 2)
+    powersgd_start_iter = config['general'].get('powersgd_start_iter', 10)
+    ddp_comm_stats = config['general'].get('ddp_comm_stats', False)
+    local_sgd_every = config['general'].get('local_sgd_every', 0)
+    local_sgd_group_size = config['general'].get('local_sgd_group_size', 1)
+    local_sgd_outer_lr = config['general'].get('local_sgd_outer_lr', 1.0)
+    local_sgd_outer_momentum = config['general'].get('local_sgd_outer_momentum', 0.0)
+    watchdog_timeout_s = config['general'].get('watchdog_timeout_s', 0)
+    preempt_signals = config['general'].get('preempt_signals', '')
+    walltime_hr = config['general'].get('walltime_hr', 0.0)
+    walltime_margin_s = config['general'].get('walltime_margin_s', 300)
+    straggler_report_every = config['general'].get('straggler_report_every', 0)
+    straggler_factor = config['general'].get('straggler_factor', 1.1)
     data_config = config['data']
     context_length = config['model']['module_kwargs']['context_length'] #TODO: refactor so trainer is independent of context length?
     optimizer_config = config['optimizer']
@@ -95,7 +214,7 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
     get_data = utils.import_fn(data_config['module'])
     get_optim = utils.import_fn(optimizer_config['module'])
     get_scheduler = utils.import_fn(scheduler_config['module'])
-    get_loss = utils.import_fn(loss_config['module'])
+    get_loss = functools.partial(utils.import_fn(loss_config['module']), **loss_config.get('module_kwargs', {}))
     get_scaler = utils.import_fn(scaler_config['module'])
 
     # setup system, device, logger, torch
@@ -105,10 +224,41 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
     device, amp_ctx, torch_info = common.setup_device(config, logger)
     assert torch_info.is_master == utils.is_master_process(), "torch_info.is_master != utils.is_master_process()"
 
+    # on signal or near walltime we checkpoint and exit so job can be requeued
+    preempt = preemption.create_preemption(preempt_signals, walltime_hr, walltime_margin_s)
+    preempted = False
+    # torchrun treats requeue exit as failure and restarts workers, past the deadline we
+    # must exit again right away instead of training another step and checkpointing
+    if preempt is not None:
+        flags = torch.tensor([int(preempt.requested())], dtype=torch.int32, device=device)
+        if torch_info.is_distributed:
+            dist.all_reduce(flags, op=dist.ReduceOp.MAX)
+        if flags.item():
+            logger.warn({'run/preempted_step': None,
+                         'run/preempt_reason': preempt.reason or 'other rank'})
+            preempt.close()
+            if torch_info.is_distributed:
+                dist.destroy_process_group()
+            if own_logger:
+                logger.shutdown()
+            return True
+
+    if tensor_parallel_size < 1 or torch_info.world_size % tensor_parallel_size != 0:
+        raise ValueError(f"tensor_parallel_size {tensor_parallel_size} must divide world size {torch_info.world_size}")
+    if pipeline_parallel_size < 1 or torch_info.world_size % pipeline_parallel_size != 0:
+        raise ValueError(f"pipeline_parallel_size {pipeline_parallel_size} must divide world size {torch_info.world_size}")
+    is_tp, is_pp = tensor_parallel_size > 1, pipeline_parallel_size > 1
+    if is_tp and is_pp:
+        raise ValueError("tensor_parallel_size and pipeline_parallel_size can't both be more than 1")
+    # ranks in same tensor or pipeline parallel group work on same batch, data loaders shard by data parallel rank
+    os.environ['TENSOR_PARALLEL_SIZE'] = str(tensor_parallel_size)
+    os.environ['PIPELINE_PARALLEL_SIZE'] = str(pipeline_parallel_size)
+    dp_world_size = torch_info.world_size // (tensor_parallel_size * pipeline_parallel_size)
+
     # compute needed accumulation steps
-    grad_acc_steps = utils.calc_grad_acc(global_batch_size, device_batch_size, torch_info.world_size)
+    grad_acc_steps = utils.calc_grad_acc(global_batch_size, device_batch_size, dp_world_size)
     # readjust global batch size
-    global_batch_size = grad_acc_steps * device_batch_size * torch_info.world_size
+    global_batch_size = grad_acc_steps * device_batch_size * dp_world_size
     local_batch_size = grad_acc_steps * device_batch_size
 
     logger.summary({
@@ -161,17 +311,130 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
                     'model/device_step_flops': device_step_flops,
                    })
 
+    peak_flops = peak_flops or flops_report.get_peak_flops(device, torch_info.pt_dtype)
+    logger.summary({'run/peak_flops': peak_flops})
+    if enable_flops_report:
+        # on local model before it gets wrapped or sharded so no collectives are involved
+        with torch.random.fork_rng(devices=[device] if torch_info.is_cuda else []):
+            x = torch.randint(0, len(tokenizer), (device_batch_size, context_length), device=device)
+            flops_metrics, flops_table = flops_report.module_report(model, get_loss, x, x, amp_ctx, peak_flops)
+        logger.info('Per-module FLOPs report:\n' + flops_table)
+        logger.summary(flops_metrics)
+
+    if parallelism not in ('ddp', 'fsdp'):
+        raise ValueError(f"Unknown parallelism: {parallelism}")
+    is_fsdp = parallelism == 'fsdp' and torch_info.is_distributed
+    if is_fsdp:
+        if optimizer_config['module_kwargs'].get('zero_stage', 0):
+            raise ValueError("FSDP already shards optimizer state, set optimizer.module_kwargs.zero_stage to 0")
+        if checkpoint_format == 'sharded':
+            raise ValueError("checkpoint_format 'sharded' is not supported with FSDP, use 'full' or 'delta'")
+        # shards params, grads and optimizer state across ranks, params become DTensors
+        # so this must happen before optimizer is created
+        model = fsdp.apply_fsdp(model, torch_info,
+                                param_dtype=fsdp_param_dtype or torch_info.dtype,
+                                reduce_dtype=fsdp_reduce_dtype,
+                                reshard_after_forward=fsdp_reshard_after_forward,
+                                cpu_offload=fsdp_cpu_offload)
+        logger.summary({'run/parallelism': 'fsdp'})
+
+    dp_group = None # DDP over all ranks
+    if is_tp:
+        if is_fsdp:
+            raise ValueError("Tensor parallel is only supported with parallelism 'ddp'")
+        if optimizer_config['module_kwargs'].get('zero_stage', 0):
+            raise ValueError("Tensor parallel is not supported with ZeRO, set optimizer.module_kwargs.zero_stage to 0")
+        if checkpoint_format == 'sharded':
+            raise ValueError("checkpoint_format 'sharded' is not supported with tensor parallel, use 'full' or 'delta'")
+        # shards heads and MLP of each block across TP ranks, replaces linear layers
+        # so this must happen before optimizer is created
+        mesh = tensor_parallel.init_mesh(torch_info, tensor_parallel_size)
+        model = tensor_parallel.apply_tensor_parallel(model, mesh['tp'])
+        # DDP syncs grads only between ranks holding the same shards
+        dp_group = mesh['dp'].get_group()
+        logger.summary({'run/tensor_parallel_size': tensor_parallel_size,
+                        'run/data_parallel_size': dp_world_size})
+
+    if is_pp:
+        if is_fsdp:
+            raise ValueError("Pipeline parallel is only supported with parallelism 'ddp'")
+        if optimizer_config['module_kwargs'].get('zero_stage', 0):
+            raise ValueError("Pipeline parallel is not supported with ZeRO, set optimizer.module_kwargs.zero_stage to 0")
+        if checkpoint_format == 'sharded':
+            raise ValueError("checkpoint_format 'sharded' is not supported with pipeline parallel, use 'full' or 'delta'")
+        if torch_info.pt_dtype == torch.float16:
+            # loss is computed inside pipeline schedule so it can't be scaled
+            raise ValueError("Pipeline parallel doesn't support float16 loss scaling, use bfloat16 or float32")
+        # each rank keeps only blocks of its stage so this must happen before optimizer is created
+        mesh = pipeline_parallel.init_mesh(torch_info, pipeline_parallel_size)
+        model = pipeline_parallel.split_model(model, mesh['pp'])
+        logger.summary({'run/pipeline_parallel_size': pipeline_parallel_size,
+                        'run/data_parallel_size': dp_world_size})
+
+    is_local_sgd = local_sgd_every > 0 and torch_info.is_distributed
+    if is_local_sgd:
+        if is_fsdp or is_tp or is_pp:
+            raise ValueError("local_sgd_every is only supported with parallelism 'ddp' without tensor or pipeline parallel")
+        if optimizer_config['module_kwargs'].get('zero_stage', 0):
+            raise ValueError("local_sgd_every is not supported with ZeRO, set optimizer.module_kwargs.zero_stage to 0")
+        if checkpoint_format == 'sharded':
+            raise ValueError("checkpoint_format 'sharded' is not supported with local_sgd_every, use 'full' or 'delta'")
+        local_sgd_mesh = local_sgd_module.init_mesh(torch_info, local_sgd_group_size)
+        # DDP syncs grads only within group, across groups params are averaged every local_sgd_every steps
+        dp_group = local_sgd_mesh['inner'].get_group()
+        logger.summary({'run/local_sgd_every': local_sgd_every,
+                        'run/local_sgd_group_size': local_sgd_group_size})
+
+    if optimizer_in_backward:
+        if is_fsdp or is_tp or is_pp or is_local_sgd:
+            raise ValueError("optimizer_in_backward is only supported with parallelism 'ddp' without tensor or pipeline parallel or local SGD")
+        if optimizer_config['module_kwargs'].get('zero_stage', 0):
+            raise ValueError("optimizer_in_backward is not supported with ZeRO, set optimizer.module_kwargs.zero_stage to 0")
+        if torch_info.pt_dtype == torch.float16:
+            # grads are consumed before scaler could check them for inf
+            raise ValueError("optimizer_in_backward doesn't support float16 loss scaling, use bfloat16 or float32")
+
     # optimizer
     optimizer = get_optim(model,
-                          enable_fused=torch_info.is_cuda,
+                          enable_fused=utils.fused_adamw_supported(torch_info.device_type),
                           **optimizer_config['module_kwargs'])
 
     # note that model should be initialized before call to DDP
     # as DDP broadcasts initial weight from rank 0 to all other ranks
-    if torch_info.is_distributed:
+    # pipeline syncs grads of data parallel replicas itself, local SGD with group size 1 never syncs grads
+    if torch_info.is_distributed and not is_fsdp and not is_pp and \
+            not (is_local_sgd and local_sgd_group_size == 1):
         model = DistributedDataParallel(model,
-                                        device_ids=[torch_info.device_id],
+                                        # CPU modules must not pass device_ids
+                                        device_ids=[torch_info.device_id] if torch_info.is_cuda else None,
+                                        process_group=dp_group,
                                         gradient_as_bucket_view=True,) # grads are kept in reducer buckets avoiding 2x memory usage
+    elif ddp_comm_hook and torch_info.is_distributed:
+        raise ValueError("ddp_comm_hook is only supported with parallelism 'ddp' without pipeline parallel or local SGD across all ranks")
+    # with ddp_comm_stats hook also collects bytes and time of grad all-reduce
+    comm_stats:Optional[comm_hooks.CommStats] = None
+    # model without DDP wrapper for state dicts
+    raw_model = model.module if isinstance(model, DistributedDataParallel) else model
+
+    # updates params in backward of last micro-step instead of in optimizer.step()
+    opt_in_bwd:Optional[optimizer_in_backward_module.OptimizerInBackward] = None
+    if optimizer_in_backward:
+        opt_in_bwd = optimizer_in_backward_module.OptimizerInBackward(raw_model, optimizer, grad_clip,
+                                                                      use_ddp=isinstance(model, DistributedDataParallel))
+    logger.summary({'run/optimizer_in_backward': optimizer_in_backward})
+
+    if isinstance(model, DistributedDataParallel):
+        comm_stats = comm_hooks.register_comm_hook(model, ddp_comm_hook, dp_group,
+                                                   powersgd_rank=powersgd_rank,
+                                                   powersgd_start_iter=powersgd_start_iter,
+                                                   on_bucket_reduced=opt_in_bwd.on_bucket_reduced if opt_in_bwd is not None else None,
+                                                   collect_stats=ddp_comm_stats)
+        logger.summary({'run/ddp_comm_hook': ddp_comm_hook or 'none'})
+
+    local_sgd:Optional[local_sgd_module.LocalSGD] = None
+    if is_local_sgd:
+        local_sgd = local_sgd_module.LocalSGD(raw_model, local_sgd_mesh['outer'], local_sgd_every,
+                                              outer_lr=local_sgd_outer_lr, outer_momentum=local_sgd_outer_momentum)
 
     # scheduler provides warmup and then constant lr
     scheduler = get_scheduler(optimizer, **scheduler_config['module_kwargs'])
@@ -179,16 +442,41 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
     # initialize a GradScaler. If enabled=False scaler is a no-op
     # we need loss scaling only for fp16 due to reduced precision, not bf16 or fp32
     scaler:ScalerBase = get_scaler(torch_info)
+    if optimizer_in_backward and not isinstance(scaler, AmpGradScaler):
+        raise ValueError("optimizer_in_backward clips by global norm itself, use scaler nanugpt.scalers.amp_grad_scaler.get_scaler")
 
+    pipeline:Optional[pipeline_parallel.Pipeline] = None
+    if is_pp:
+        # grad accumulation micro-batches are the pipeline micro-batches
+        pipeline = pipeline_parallel.Pipeline(model, mesh, device, grad_acc_steps, get_loss)
+        logger.summary({'run/pp_theoretical_bubble': pipeline.theoretical_bubble()})
+
+    if checkpoint_format not in ('full', 'sharded', 'delta'):
+        raise ValueError(f"Unknown checkpoint_format: {checkpoint_format}")
+    is_sharded = checkpoint_format == 'sharded'
+
+    checkpointer:Optional[checkpointing.AsyncCheckpointer] = None
+    # all ranks need expanded path for profiler traces, trigger file and resume lookup
+    out_dir = utils.full_path(out_dir, create=torch_info.is_master)
     if torch_info.is_master:
-        out_dir = utils.full_path(out_dir, create=True)
         logger.summary({'run/out_dir': out_dir})
+    # for sharded checkpoints every rank writes its own shard
+    if save_checkpoint and (torch_info.is_master or is_sharded):
+        checkpointer = checkpointing.AsyncCheckpointer(out_dir,
+            keep_last=checkpoint_keep_last, keep_best=True,
+            enable_async=checkpoint_async,
+            writer=delta_checkpoint.DeltaCheckpointWriter(full_every=checkpoint_full_every) \
+                if checkpoint_format == 'delta' else None,
+            on_saved=(lambda name, filepath, write_time_s: \
+                logger.log_artifact(name=name, type='file', file_or_dir=filepath)) \
+                if torch_info.is_master else None)
 
     if torch_info.is_cuda:
         torch.cuda.synchronize()
     step, eval_count, total_samples, total_tokens = 0, 0, 0, 0
     best_train_loss, best_val_loss = float('inf'), float('inf')
     best_train_loss_step, best_val_loss_step = -1, -1
+    val_loss = float('inf')
     last_checkpoint_time = timeit.default_timer()
     prev_train_losses, loss_inversions, loss_improvement_steps = [], 0,0
     max_previous_losses, pred_loss = 300, float('inf')
@@ -197,26 +485,139 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
     batches = Batches(train_loader)
     train_time_hr = 0.0
 
+    # after torchrun restarts failed worker group or slurm requeues the job we continue from latest checkpoint
+    restart_count = utils.get_restart_count()
+    if restart_count > 0:
+        logger.summary({'run/restart_count': restart_count})
+        resume_from = resume_from or 'auto'
+
+    # if we are resuming, restore everything needed to continue as if we never stopped
+    resume_filepath = checkpointing.find_resume_checkpoint(resume_from, out_dir)
+    if resume_filepath:
+        logger.info(f"Resuming from checkpoint {resume_filepath}...")
+        if sharded_checkpoint.is_sharded_checkpoint(resume_filepath):
+            # each rank picks up its params from shards, world size may differ from save time
+            checkpoint, rank_state = sharded_checkpoint.load_sharded(resume_filepath,
+                raw_model, optimizer,
+                torch_info.global_rank, torch_info.world_size)
+        else:
+            # all ranks load the same file, optimizer state is mapped to param device on load
+            checkpoint = checkpointing.load_checkpoint(resume_filepath)
+            if is_fsdp:
+                fsdp.load_full_state_dicts(model, optimizer, checkpoint['model'], checkpoint['optimizer'])
+            elif is_tp:
+                tensor_parallel.load_full_state_dicts(raw_model, optimizer, checkpoint['model'], checkpoint['optimizer'])
+            elif is_pp:
+                pipeline_parallel.load_full_state_dicts(raw_model, optimizer, checkpoint['model'], checkpoint['optimizer'], mesh)
+            else:
+                checkpointing.load_model_state(raw_model, checkpoint['model'])
+                optimizer.load_state_dict(checkpoint['optimizer'])
+            if local_sgd is not None:
+                # all replicas start from saved global params
+                local_sgd.load_state_dict(checkpoint.get('local_sgd') or {})
+            rank_states = checkpoint.get('ranks', [])
+            rank_state = rank_states[torch_info.global_rank] \
+                if len(rank_states) == torch_info.world_size else None
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        if 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+
+        trainer_state = checkpoint.get('trainer', {})
+        step = checkpoint['train/step'] + 1 # checkpoint is taken at the end of the step
+        best_val_loss = checkpoint['val/best_loss']
+        eval_count = trainer_state.get('eval_count', eval_count)
+        total_samples = trainer_state.get('total_samples', total_samples)
+        total_tokens = trainer_state.get('total_tokens', total_tokens)
+        best_train_loss = trainer_state.get('best_train_loss', best_train_loss)
+        best_train_loss_step = trainer_state.get('best_train_loss_step', best_train_loss_step)
+        best_val_loss_step = trainer_state.get('best_val_loss_step', best_val_loss_step)
+        val_loss = trainer_state.get('val_loss', val_loss)
+        prev_train_losses = list(trainer_state.get('prev_train_losses', prev_train_losses))
+        loss_inversions = trainer_state.get('loss_inversions', loss_inversions)
+        loss_improvement_steps = trainer_state.get('loss_improvement_steps', loss_improvement_steps)
+        train_time_hr = trainer_state.get('train_time_hr', train_time_hr)
+
+        # RNG and data position are per rank, only restorable if world size didn't change
+        if rank_state is not None:
+            checkpointing.set_rng_state(rank_state['rng'])
+            batches.load_state_dict(rank_state['data'])
+        else:
+            # new ranks split the data read so far by old ranks, so each continues from
+            # the same fraction of its shard as old ranks were at. This is approximate: shard
+            # boundaries move so some tokens of current epoch are read again and as many are
+            # skipped, from next epoch on each token is read once per epoch again.
+            old_dp_world_size = trainer_state.get('dp_world_size', 0)
+            old_tokens_read = trainer_state.get('data_tokens_read', 0)
+            resharded = old_dp_world_size > 0 and \
+                batches.seek(old_tokens_read * old_dp_world_size // dp_world_size)
+            reread = train_loader.reread_after_reshard(old_dp_world_size, old_tokens_read) \
+                if resharded and utils.has_method(train_loader, 'reread_after_reshard') else None
+            logger.warn(f"Checkpoint was saved with different world size than {torch_info.world_size}, RNG is not restored" + \
+                        (" and data position is not restored." if not resharded else \
+                         ", data position is re-sharded approximately" + \
+                         (f", this rank re-reads {reread} tokens of current epoch." if reread is not None else ".")))
+
+        checkpoint_log_filepath = os.path.join(utils.full_path(out_dir), "checkpoint_log.yaml")
+        if torch_info.is_master and os.path.isfile(checkpoint_log_filepath):
+            checkpoint_log = utils.load_yaml(checkpoint_log_filepath) or []
+        del checkpoint
+
+        logger.summary({'run/resume_filepath': resume_filepath, 'run/resume_step': step})
+        # metrics of previous run after checkpoint will be logged again
+        logger.resume_metrics(step)
+
+    # exits if we get stuck so torchrun can restart workers
+    wd = watchdog.create_watchdog(watchdog_timeout_s)
+    # only for testing restarts, None unless NANUGPT_INJECT_FAULT is set
+    inject_fault = watchdog.create_fault_injector()
+
+    # per-rank timings to find slow ranks, gathered at log steps
+    rank_times = straggler.RankTimes(['train/step_interval', 'train/data_wait', 'train/fwd_bwd_interval', 'train/fwd_interval'],
+                                     'train/fwd_interval', torch_info, device,
+                                     straggler_report_every, straggler_factor) \
+        if torch_info.is_distributed else None
+
+    # breakdown of where step time goes, reported at log steps
+    timer = phase_timer.PhaseTimer(use_cuda_events=torch_info.is_cuda)
+
+    # torch.profiler traces from start or on signal/trigger file
+    prof = profiling.Profiler(profile_config, out_dir, torch_info.global_rank, torch_info.is_cuda)
+
     # run steps
     while step < max_steps:
+        if wd is not None:
+            wd.beat(f'step {step}')
+        if inject_fault is not None:
+            inject_fault(step)
+        timer.start('step')
         step_start_time = timeit.default_timer()
         step_sample_count, step_token_count = 0, 0
         loss_sum, correct_sum, step_preds_count = 0., 0, 0
+        fwd_interval, h2d_interval = 0., 0.
         metrics = {} # add metrics here if any
 
         model.train()
 
-        x, y = batches.next()
+        with timer.scope('data'):
+            x, y = batches.next()
 
         # grad accumulations
-        for micro_step in range(grad_acc_steps):
-            x, y = x.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else x.to(device), \
-                y.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else y.to(device)
+        for micro_step in range(grad_acc_steps if pipeline is None else 0):
+            # with non_blocking this is host side time of pinning and launching the copy
+            h2d_start_time = timeit.default_timer()
+            with timer.scope('h2d'):
+                x, y = x.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else x.to(device), \
+                    y.pin_memory().to(device, non_blocking=True) if torch_info.is_cuda else y.to(device)
+            h2d_interval += timeit.default_timer() - h2d_start_time
 
-            if torch_info.is_distributed:
+            if isinstance(model, DistributedDataParallel):
                 # Instead of model.no_sync(), we do Karpathy's hack
                 # On last step, flag model to require backward grad sync
                 model.require_backward_grad_sync = (micro_step == grad_acc_steps - 1) # type: ignore
+            if opt_in_bwd is not None:
+                opt_in_bwd.last_micro_step = (micro_step == grad_acc_steps - 1)
+            # for FSDP we reduce-scatter on every micro step so grads stay sharded,
+            # skipping sync would keep full unsharded grads around
 
             # note that we don't take context length into account here
             # if we have N tokens in dataset, we move window N times and do
@@ -226,6 +627,8 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
             step_sample_count += n_samples
             step_token_count += x.numel()
 
+            timer.start('forward')
+            fwd_start_time = timeit.default_timer()
             with amp_ctx:
                 # logits = model(x)
                 loss, correct, n_preds = get_loss(model(x), y)
@@ -239,37 +642,92 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
                 # When we divide the loss by the number of micro steps we average out the gradients
                 # so that the net value of grads is same as if we had a larger batch size
                 loss = loss / grad_acc_steps # scale the loss to account for gradient accumulation
+            # .item() waits for forward so this is forward time, with DDP it has no collectives
+            fwd_interval += timeit.default_timer() - fwd_start_time
+            timer.stop()
 
             # below runs async while backward pass is running because dataloader is configures with workers
-            x, y = batches.next()
+            with timer.scope('data'):
+                x, y = batches.next()
 
             # backward pass, with gradient scaling if training in fp16
-            scaler.backward(loss) # type: ignore
+            with timer.scope('backward'):
+                scaler.backward(loss) # type: ignore
         # --- end of gradient accumulation loop ---
 
+        if pipeline is not None:
+            # whole local batch goes through pipeline at once and is split back into micro-batches
+            xs, ys = [x], [y]
+            for micro_step in range(grad_acc_steps):
+                # same number of batches are consumed as in the loop above
+                with timer.scope('data'):
+                    x, y = batches.next()
+                if micro_step < grad_acc_steps - 1:
+                    xs.append(x)
+                    ys.append(y)
+            h2d_start_time = timeit.default_timer()
+            with timer.scope('h2d'):
+                x, y = torch.cat(xs).to(device), torch.cat(ys).to(device)
+            fwd_start_time = timeit.default_timer()
+            h2d_interval = fwd_start_time - h2d_start_time
+            with amp_ctx, timer.scope('pipeline'):
+                loss_sum, correct_sum, step_preds_count = pipeline.step(x, y)
+            # forward and backward are interleaved in pipeline schedule
+            fwd_interval = timeit.default_timer() - fwd_start_time
+            # metrics are only on last stage, others add 0
+            if pipeline.is_last:
+                step_sample_count, step_token_count = len(x), x.numel()
+            metrics['train/pp_bubble'] = pipeline.bubble
+
         # clip the gradients
-        pre_clip_norm = scaler.clip(model, optimizer, grad_clip)
-        # step the optimizer (if grad were unscaled then scaler remembers and doesn't unscale again)
-        scaler.step(optimizer)
-        # update the scale for next iteration
-        scaler.update()
+        with timer.scope('clip'):
+            # with optimizer in backward params are already updated, grads were clipped by previous step's norm
+            pre_clip_norm = scaler.clip(model, optimizer, grad_clip) if opt_in_bwd is None else opt_in_bwd.finish()
+        timer.start('optim')
+        if opt_in_bwd is None:
+            # step the optimizer (if grad were unscaled then scaler remembers and doesn't unscale again)
+            scaler.step(optimizer)
+            # update the scale for next iteration
+            scaler.update()
         scheduler.step()
         # flush the gradients as soon as we can, no need for this memory anymore
         optimizer.zero_grad(set_to_none=True)
+        timer.stop()
+
+        if local_sgd is not None:
+            with timer.scope('local_sgd'):
+                synced = local_sgd.step(step)
+            if synced:
+                metrics['train/local_sgd_sync_s'] = local_sgd.sync_time
+                metrics['train/local_sgd_sync_mb'] = local_sgd.sync_bytes / 2**20
 
         if torch_info.is_cuda:
             torch.cuda.synchronize()
         fwd_bwd_interval = timeit.default_timer() - step_start_time
+        local_fwd_bwd_interval = fwd_bwd_interval # becomes sum over ranks below
+        data_wait, fetch_count = batches.pop_stats()
+        data_wait_mean, h2d_interval_mean = data_wait, h2d_interval
+        pre_clip_norm = float(pre_clip_norm) # scaler keeps it on device so clip doesn't sync
+
+        if comm_stats is not None:
+            comm_bytes, comm_time = comm_stats.pop()
+            metrics['train/comm_mb'] = comm_bytes / 2**20
+            metrics['train/comm_time_s'] = comm_time
 
         # gather matrics from all ranks
         if torch_info.is_distributed:
             # dist.barrier() # not needed as reduce will sync all processes
             # reduce tensors to global_rank 0 to get numbers from all ranks
             fp32_dist = torch.tensor([loss_sum, fwd_bwd_interval, pre_clip_norm,
-                                      correct_sum, step_preds_count, step_sample_count, step_token_count], dtype=torch.float32, device=device)
-            dist.reduce(fp32_dist, dst=0, op=dist.ReduceOp.SUM)
+                                      correct_sum, step_preds_count, step_sample_count, step_token_count,
+                                      data_wait, h2d_interval], dtype=torch.float32, device=device)
+            dist.all_reduce(fp32_dist, op=dist.ReduceOp.SUM)
+            # ranks in same tensor parallel group process same samples
+            fp32_dist[[0, 3, 4, 5, 6]] /= tensor_parallel_size
+            fp32_dist[[7, 8]] /= torch_info.world_size
             loss_sum,fwd_bwd_interval_sum, pre_clip_norm_sum, \
-            correct_sum, step_preds_count, step_sample_count, step_token_count = tuple(fp32_dist.tolist())
+            correct_sum, step_preds_count, step_sample_count, step_token_count, \
+            data_wait_mean, h2d_interval_mean = tuple(fp32_dist.tolist())
             # use sum of all worker values so we have more accurate idea of outliers
             fwd_bwd_interval, pre_clip_norm = fwd_bwd_interval_sum, pre_clip_norm_sum
             # convert back to int
@@ -297,6 +755,15 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
         pred_loss = float(lin_predictor.predict(loss_pred_model, [max_steps-1])[0])
         step_interval = timeit.default_timer() - step_start_time
         train_time_hr += step_interval / 3600.0
+        is_log_step = enable_train_log and (step % train_log_every == 0 or step+1 >= max_steps)
+        if is_log_step:
+            # covers steps completed since last log step
+            metrics.update(phase_timer.reduce_report(*timer.pop_report(), torch_info.is_distributed))
+        if rank_times is not None and is_log_step:
+            metrics.update(rank_times.gather([step_interval, data_wait, local_fwd_bwd_interval, fwd_interval]))
+            slow_ranks = rank_times.report()
+            if slow_ranks and torch_info.is_master:
+                logger.warn('Slow ranks: ' + '; '.join(slow_ranks))
         run_flops = utils.transformer_flops(batch_size=total_samples,
             params_nonembedding_trainable=n_non_embedding_trainable,
             context_length=context_length,
@@ -313,6 +780,12 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
             "train/step_interval": step_interval,
             "train/train_time_hr": train_time_hr,
             "train/fwd_bwd_interval": fwd_bwd_interval,
+            # input pipeline, averaged over ranks
+            "train/data_wait": data_wait_mean,
+            "train/data_wait_frac": data_wait_mean / step_interval,
+            "train/h2d_interval": h2d_interval_mean,
+            "train/compute_interval": fwd_bwd_interval / torch_info.world_size - data_wait_mean - h2d_interval_mean,
+            "train/data_batches_per_sec": fetch_count / step_interval,
             "train/samples": total_samples,
             "train/step_samples": step_sample_count,
             "train/tokens": total_tokens,
@@ -327,10 +800,24 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
             "run/eta_hr": elapsed_hr * (max_steps-step-1) / (step+1),
             "run/checkpoint_since_hr": (timeit.default_timer() - last_checkpoint_time)/3600.0,
         })
+        if peak_flops:
+            # analytic FLOPs of global batch over peak of all devices
+            step_flops = utils.transformer_flops(batch_size=step_sample_count,
+                params_nonembedding_trainable=n_non_embedding_trainable,
+                context_length=context_length,
+                n_embd=model_kwargs['n_embd'], n_layer=model_kwargs['n_layer']
+            )
+            metrics["run/mfu"] = step_flops / step_interval / (peak_flops * torch_info.world_size)
+        queue_depth = batches.queue_depth()
+        if queue_depth is not None:
+            metrics["train/data_queue_depth"] = queue_depth
 
         # is it time to evaluate? We evaluate after 1st step to get initial loss.
         eval_performed = False
         if ((step+1) % eval_every == 0 or step+1 >= max_steps):
+            if wd is not None:
+                wd.beat(f'eval {step}')
+            timer.start('eval')
             eval_start_time = timeit.default_timer()
             max_memory_allocated = torch.cuda.max_memory_allocated() if torch_info.is_cuda else 0
 
@@ -339,7 +826,7 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
             eval_interval = timeit.default_timer() - last_eval_time
 
             val_loss, val_acc, sample_count, iter_count = estimate_loss(model, get_loss, val_loader, eval_iters,
-                                            amp_ctx, torch_info, device)
+                                            amp_ctx, torch_info, device, tensor_parallel_size, pipeline, wd)
             if val_loss < best_val_loss:
                 best_val_loss = val_loss
                 best_val_loss_step = step
@@ -361,7 +848,7 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
 
             if step+1 >= max_steps and test_loader:
                 test_loss, test_acc, sample_count, iter_count = estimate_loss(model, get_loss, test_loader, None,
-                                            amp_ctx, torch_info, device)
+                                            amp_ctx, torch_info, device, tensor_parallel_size, pipeline, wd)
                 # only master has aggregated metrics
                 metrics.update({
                     "test/loss": test_loss,
@@ -371,6 +858,7 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
                     "test/iter_count": iter_count,
                 })
             last_eval_time = timeit.default_timer()
+            timer.stop()
 
         # if this is last step or enough time has passed, save checkpoint
         can_checkpoint = save_checkpoint and \
@@ -378,53 +866,152 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
                     (step > checkoint_after and \
                         (timeit.default_timer() - last_checkpoint_time) / 3600.0 > checkpoint_every_hr)
                 )
+        preempted = preempt is not None and preempt.requested()
+        if (save_checkpoint or preempt is not None) and torch_info.is_distributed:
+            # timers differ across ranks so use master's decision for checkpoint and any rank's
+            # for preemption so all ranks stop at same step, all ranks must participate below
+            flags = torch.tensor([int(can_checkpoint and torch_info.is_master), int(preempted)],
+                                 dtype=torch.int32, device=device)
+            dist.all_reduce(flags, op=dist.ReduceOp.MAX)
+            can_checkpoint, preempted = bool(flags[0].item()), bool(flags[1].item())
+        if preempted:
+            # save what we have before we get killed
+            can_checkpoint = save_checkpoint
+            logger.warn({'run/preempted_step': step,
+                         'run/preempt_reason': (preempt and preempt.reason) or 'other rank'})
 
+        if can_checkpoint:
+            timer.start('checkpoint')
         checkpoint_start_time = timeit.default_timer()
-        # consolidate optim state
+        checkpoint_filename = "checkpoint_" + \
+            f"{step}" if not checkpoint_keep_best else "best"
+        checkpoint_filepath = None
         if can_checkpoint:
-            # distributed optimizer like ZeroOptimizer needs to be consolidated before saving
-            # if optimizer has method called `consolidate_state_dict` then call it
+            if wd is not None:
+                wd.beat(f'checkpoint {step}')
             # this needs to be run on all ranks
-            if hasattr(optimizer, 'consolidate_state_dict'):
-                optimizer.consolidate_state_dict()
+            trainer_state = {
+                'eval_count': eval_count,
+                'total_samples': total_samples,
+                'total_tokens': total_tokens,
+                'best_train_loss': best_train_loss,
+                'best_train_loss_step': best_train_loss_step,
+                'best_val_loss_step': best_val_loss_step,
+                'val_loss': val_loss,
+                'prev_train_losses': prev_train_losses[-max_previous_losses:],
+                'loss_inversions': loss_inversions,
+                'loss_improvement_steps': loss_improvement_steps,
+                'train_time_hr': train_time_hr,
+                # to re-shard data if world size changes on resume
+                'dp_world_size': dp_world_size,
+                'data_tokens_read': getattr(train_loader, 'tokens_read', 0),
+            }
+            rank_state = {'rng': checkpointing.rng_state(), 'data': batches.state_dict()}
+            if is_sharded:
+                assert checkpointer is not None
+                # each rank writes its own params and optimizer partition, no gather on rank 0
+                checkpoint_filepath = sharded_checkpoint.save_sharded(checkpointer, checkpoint_filename,
+                    raw_model, optimizer,
+                    torch_info.global_rank, torch_info.world_size,
+                    common={'scheduler': scheduler.state_dict(),
+                            'scaler': scaler.state_dict(),
+                            'trainer': trainer_state,
+                            'train/step': step,
+                            'val/best_loss': best_val_loss},
+                    rank_state=rank_state, val_loss=val_loss)
+            else:
+                # distributed optimizer like ZeroOptimizer needs to be consolidated before saving
+                # if optimizer has method called `consolidate_state_dict` then call it
+                if hasattr(optimizer, 'consolidate_state_dict'):
+                    optimizer.consolidate_state_dict()
+                # FSDP state is sharded so gather full state on rank 0
+                model_state, optimizer_state = fsdp.full_state_dicts(model, optimizer) \
+                    if is_fsdp else (None, None)
+                # TP shards are gathered on all ranks
+                if is_tp:
+                    model_state, optimizer_state = tensor_parallel.full_state_dicts(raw_model, optimizer)
+                # pipeline stages are gathered on rank 0
+                if is_pp:
+                    model_state, optimizer_state = pipeline_parallel.full_state_dicts(raw_model, optimizer, mesh)
+                # replicas differ between syncs so we save global params
+                if local_sgd is not None:
+                    model_state = local_sgd.model_state_dict(raw_model)
+                # collect RNG and data position from all ranks
+                if torch_info.is_distributed:
+                    rank_states = [None] * torch_info.world_size
+                    dist.all_gather_object(rank_states, rank_state)
+                else:
+                    rank_states = [rank_state]
+
+                # save checkpoint only on master
+                if torch_info.is_master:
+                    assert checkpointer is not None
+                    # state is snapshotted to host memory here and written to disk in background
+                    checkpoint_filepath = checkpointer.save(checkpoint_filename,
+                                            utils.checkpoint_state(raw_model,
+                                                optimizer, scheduler, step, best_val_loss,
+                                                model_state=model_state, optimizer_state=optimizer_state,
+                                                scaler=scaler.state_dict(),
+                                                trainer=trainer_state,
+                                                ranks=rank_states,
+                                                local_sgd=local_sgd.state_dict() if local_sgd is not None else None),
+                                            val_loss=val_loss)
 
-        # save checkpoint only on master
         if torch_info.is_master and can_checkpoint:
+            assert checkpointer is not None
             # TODO: below is only for debugging, remove later
             logger.info({"step": step, "max_steps": max_steps,
                          "run/checkpoint_since_hr": (timeit.default_timer() - last_checkpoint_time)/3600.0,
                         "checkpoint_every_hr": checkpoint_every_hr})
-            last_checkpoint_time = timeit.default_timer()
-            checkpoint_filename = "checkpoint_" + \
-                f"{step}" if not checkpoint_keep_best else "best"
-            checkpoint_filepath = utils.save_checkpoint(out_dir, checkpoint_filename,
-                                    model.module if torch_info.is_distributed else model,
-                                    optimizer, scheduler, step, best_val_loss)
 
             metrics.update({"checkpoint_filepath": checkpoint_filepath,
-                            "run/checkpoint_time_s": timeit.default_timer() - checkpoint_start_time})
+                            "run/checkpoint_time_s": timeit.default_timer() - checkpoint_start_time,
+                            "run/checkpoint_wait_s": checkpointer.last_wait_time,
+                            "run/checkpoint_snapshot_s": checkpointer.last_snapshot_time,
+                            "run/checkpoint_prev_write_s": checkpointer.last_write_time,
+                            "run/checkpoint_prev_write_mb": checkpointer.last_write_bytes / 2**20})
 
             checkpoint_log.append(metrics)
-            logger.log_artifact(name=checkpoint_filename, type='file', file_or_dir=checkpoint_filepath)
+            # keep log current so we can auto-resume even if the process gets killed
+            utils.save_yaml(checkpoint_log, os.path.join(out_dir, "checkpoint_log.yaml"))
+
+        if can_checkpoint:
+            last_checkpoint_time = timeit.default_timer()
+            timer.stop()
 
 
         # Decide if we should log
         can_log = len(metrics) > 0 and torch_info.is_master and (
-                        (enable_train_log and (
-                            step % train_log_every == 0 or step+1 >= max_steps)
-                        ) or eval_performed)
+                        is_log_step or eval_performed or preempted)
         if can_log:
-            logger.info(metrics)
+            with timer.scope('log'):
+                logger.info(metrics)
 
         # Ensure all CUDA operations are complete
         # not needed as reduce will cause sync
         # torch.cuda.synchronize()
 
+        prof.step(step)
+        timer.stop() # step
         step += 1
-        if step >= max_steps:
+        if step >= max_steps or preempted:
             break
 
 
+    if wd is not None:
+        wd.stop()
+    if preempt is not None:
+        preempt.close()
+    prof.close()
+
+    if checkpointer is not None:
+        # make sure last checkpoint is on disk before we declare it in the log
+        checkpointer.shutdown()
+
+    if checkpointer is not None and is_sharded and torch_info.is_distributed:
+        # all shards must be on disk before the checkpoint is usable
+        dist.barrier()
+
     if torch_info.is_master:
         checkpoint_log_filepath = os.path.join(out_dir, "checkpoint_log.yaml")
         utils.save_yaml(checkpoint_log, checkpoint_log_filepath)
@@ -441,3 +1028,6 @@ def train(config:Mapping, logger:Optional[logging.Logger]=None):
 
     if own_logger:
         logger.shutdown()
+
+    # checkpoint is on disk, caller tells launcher to requeue the job
+    return preempted
@@ -1,6 +1,6 @@
 from typing import Callable, Mapping, MutableMapping, Optional, Tuple, Dict, List, Sequence, Any, Type, Union, Iterable
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import pathlib
 import platform
@@ -8,7 +8,6 @@ import subprocess
 from itertools import groupby, chain
 from collections import OrderedDict, defaultdict
 import os
-import requests
 import sys
 import numpy as np
 from collections import defaultdict
@@ -33,6 +32,7 @@ import yaml
 
 import torch
 import torch.nn as nn
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 # We setup env variable if debugging mode is detected for vs_code_debugging.
@@ -236,13 +236,26 @@ class TorchInfo:
     seed_offset: int
     pt_dtype: torch.dtype
 
+def init_process_group(backend:str, timeout_s:float=0, device_id:Optional[torch.device]=None)->None:
+    """init_process_group with env:// where store keys are prefixed by restart count.
+
+    torchrun's agent serves same store across restarts of worker group, without the prefix
+    restarted ranks may read peer addresses left by previous attempt and fail to connect.
+    """
+    timeout = timedelta(seconds=timeout_s) if timeout_s > 0 else None
+    store, rank, world_size = next(torch.distributed.rendezvous('env://', **({'timeout': timeout} if timeout else {})))
+    torch.distributed.init_process_group(backend=backend, store=torch.distributed.PrefixStore(f'attempt_{get_restart_count()}', store),
+                                         rank=rank, world_size=world_size, device_id=device_id, timeout=timeout)
+
 def setup_torch(seed:int,
     device_type:str,
     dtype:str,
     enable_distributed:bool,
     distributed_backend:str, # ex 'nccl
     distributed_init_method:str, # ex 'env://'
-    print_precision:int=10)->TorchInfo:
+    print_precision:int=10,
+    distributed_timeout_s:int=0, # 0 uses torch default
+    )->TorchInfo:
 
     # below is currently disabled because of this bug: https://github.com/pytorch/pytorch/issues/110331
     # show Tensor shape first for tensor's rpresentation
@@ -300,10 +313,9 @@ def setup_torch(seed:int,
             else:
                 raise ValueError('No GPU found. Set device_type=cpu.')
 
-        torch.distributed.init_process_group(backend=distributed_backend,
-                                             init_method=distributed_init_method,
-                                             device_id=torch.device(device_name) if is_cuda else None,
-                                             )  # type: ignore
+        # collectives that don't finish in timeout raise error instead of hanging
+        init_process_group(distributed_backend, distributed_timeout_s,
+                           device_id=torch.device(device_name) if is_cuda else None)
         torch.distributed.barrier()
 
     else: # not distributed
@@ -316,6 +328,8 @@ def setup_torch(seed:int,
         device_id = 0 # first GPU visible
 
     if is_cuda:
+        # prevents a bug on some systems, done here instead of at import so importing doesn't init CUDA
+        torch.empty(1, device=device_name, requires_grad=True).backward()
         torch.cuda.manual_seed(seed+seed_offset)
     torch.manual_seed(seed+seed_offset)
 
@@ -327,17 +341,28 @@ def setup_torch(seed:int,
                      is_master=is_master, seed_offset=seed_offset,
                      pt_dtype=pt_dtype, device_id=device_id)
 
+def checkpoint_state(model, optimizer, scheduler,
+                     step:int, best_val_loss:float,
+                     model_state:Optional[Mapping]=None, optimizer_state:Optional[Mapping]=None,
+                     **kwargs)->Dict[str, Any]:
+    # kwargs are extra entries such as scaler and trainer state needed for resume
+    # model_state and optimizer_state can be passed if already gathered, e.g., for FSDP
+    return {'model': model_state if model_state is not None else model.state_dict(),
+            'optimizer': optimizer_state if optimizer_state is not None else optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'train/step': step,
+            'val/best_loss': best_val_loss,
+            **kwargs}
+
 def save_checkpoint(out_dir:str, name:str, model, optimizer, scheduler,
                     step:int, best_val_loss:float)->str:
-    checkpoint = {'model': model.state_dict(),
-                  'optimizer': optimizer.state_dict(),
-                  'scheduler': scheduler.state_dict(),
-                  'train/step': step,
-                  'val/best_loss': best_val_loss}
+    checkpoint = checkpoint_state(model, optimizer, scheduler, step, best_val_loss)
 
     out_dir = full_path(out_dir, create=True)
     checkpoint_filepath = os.path.join(out_dir, f'{name}.pt')
-    torch.save(checkpoint, checkpoint_filepath)
+    # write to temp file and rename so we never leave partially written checkpoint
+    torch.save(checkpoint, checkpoint_filepath + '.tmp')
+    os.replace(checkpoint_filepath + '.tmp', checkpoint_filepath)
     return checkpoint_filepath
 
 def import_fn(spec:str)->Callable:
@@ -347,6 +372,19 @@ def import_fn(spec:str)->Callable:
     fn = getattr(module, fn_name)
     return fn
 
+class LazyModule:
+    """Module that gets imported on first attribute access. Use for modules that take long to
+    import and are needed only with some configs. Unlike importlib.util.LazyLoader this isn't
+    put in sys.modules, where code scanning modules would trigger import at random times."""
+    def __init__(self, module_name:str):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, name:str):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, name)
+
 def get_stats(nums):
     if isinstance(nums, torch.Tensor):
         nums = nums.detach().cpu().numpy()
@@ -416,6 +454,62 @@ def work_cpu_count()->int:
     else:
         return count
 
+def parse_cpu_list(cpu_list:str)->List[int]:
+    """Parses list like '0-7,16,18-19' used by taskset and numactl"""
+    cpus = []
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end)+1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def setup_cpu_threads(num_threads:int, interop_threads:int, affinity:str,
+                      local_rank:int, local_world_size:int)->Dict[str, Any]:
+    """Sets torch intra-op and inter-op threads and CPU affinity of this process.
+
+    affinity is '' to leave as is, a cpu list like '0-15' or 'auto' to give each local rank
+    its own contiguous slice of CPUs this process can run on. num_threads=0 uses number of
+    CPUs in affinity if set, else CPUs split between local ranks so ranks don't oversubscribe.
+    interop_threads=0 leaves torch default.
+    """
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(cpu_count()))
+    local_world_size = max(local_world_size, 1)
+
+    cpus = None
+    if affinity == 'auto':
+        per_rank = max(len(available) // local_world_size, 1)
+        start = (local_rank * per_rank) % len(available)
+        cpus = available[start:start+per_rank]
+    elif affinity:
+        cpus = parse_cpu_list(affinity)
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    if num_threads <= 0:
+        num_threads = len(cpus) if cpus is not None else \
+            (max(len(available) // local_world_size, 1) if local_world_size > 1 else torch.get_num_threads())
+    torch.set_num_threads(num_threads)
+
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # can only be set once before any inter-op parallel work starts
+            pass
+
+    return {'cpu/num_threads': torch.get_num_threads(),
+            'cpu/interop_threads': torch.get_num_interop_threads(),
+            'cpu/affinity': ','.join(str(c) for c in cpus) if cpus is not None else ''}
+
+def fused_adamw_supported(device_type:str)->bool:
+    # fused AdamW kernels exist for cuda since torch 2.0 and for cpu since torch 2.4
+    if device_type == 'cuda':
+        return True
+    return device_type == 'cpu' and version.parse(torch.__version__).release >= (2, 4)
+
 def module_params(module:torch.nn.Module, non_embedding=True):
     filter_params = set()
     if non_embedding:
@@ -446,8 +540,74 @@ def module_params_count(module:torch.nn.Module)->Tuple[int, int, int, int]:
             n_non_embedding_trainable += n
     return n_all, n_trainable, n_embedding, n_non_embedding_trainable
 
+def _split_tensors(params:Iterable[torch.Tensor], use_grad:bool)->Tuple[List[torch.Tensor], Dict[Any, List[torch.Tensor]]]:
+    """Returns replicated tensors and tensors spread over ranks keyed by process group (None is all ranks)."""
+    replicated, split = [], {}
+    for p in params:
+        t = p.grad if use_grad else p
+        if t is None:
+            continue
+        if hasattr(p, 'to_local'): # FSDP DTensor, sharded over all ranks
+            split.setdefault(None, []).append(t.to_local()) # type: ignore
+        elif hasattr(p, 'tp_group'): # tensor parallel shard
+            split.setdefault(p.tp_group, []).append(t) # type: ignore
+        elif hasattr(p, 'pp_group'): # param of pipeline stage
+            # tied lm_head copy on last stage is same as wte on first stage
+            if not getattr(p, 'pp_tied_copy', False):
+                split.setdefault(p.pp_group, []).append(t) # type: ignore
+        else:
+            replicated.append(t)
+    return replicated, split
+
+def is_model_parallel(params:Iterable[torch.Tensor])->bool:
+    """True if params are split across ranks by tensor or pipeline parallel."""
+    return any(hasattr(p, 'tp_group') or hasattr(p, 'pp_group') for p in params)
+
+def _sq_sum(tensors:List[torch.Tensor])->torch.Tensor:
+    # multi-tensor kernel instead of one norm kernel per tensor, accumulated in fp32
+    return torch.stack(torch._foreach_norm(tensors, 2, dtype=torch.float32)).pow(2).sum()
+
+def distributed_norm(params:Iterable[torch.Tensor], use_grad:bool=False)->torch.Tensor:
+    """L2 norm of params (or their grads) of the whole model even if they are spread over ranks.
+
+    Params split over ranks are FSDP DTensors, tensor parallel shards and pipeline stages.
+    Must be called on all ranks if there are any such params.
+    """
+    replicated, split = _split_tensors(params, use_grad)
+    tensors = replicated + [t for ts in split.values() for t in ts]
+    device = tensors[0].device if tensors else None
+    sq_sum = _sq_sum(replicated) if replicated else torch.zeros((), device=device)
+    for group, ts in split.items():
+        group_sq_sum = _sq_sum(ts)
+        torch.distributed.all_reduce(group_sq_sum, group=group) # type: ignore
+        sq_sum = sq_sum + group_sq_sum
+    return sq_sum.sqrt()
+
+def clip_grad_norm_(params:Iterable[torch.Tensor], max_norm:float)->torch.Tensor:
+    """Like torch.nn.utils.clip_grad_norm_ but norm is over grads of whole model even if params are spread over ranks."""
+    params = list(params)
+    total_norm = distributed_norm(params, use_grad=True)
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    torch._foreach_mul_([p.grad for p in params if p.grad is not None], clip_coef) # type: ignore
+    return total_norm
+
+def all_reduce_mean_(tensors:List[torch.Tensor], group=None)->None:
+    """Averages tensors in-place over ranks in group, flattened so it's one collective per dtype."""
+    size = torch.distributed.get_world_size(group)
+    for dtype in set(t.dtype for t in tensors):
+        dtype_tensors = [t for t in tensors if t.dtype == dtype]
+        flat = _flatten_dense_tensors(dtype_tensors)
+        torch.distributed.all_reduce(flat, group=group)
+        flat /= size
+        for t, synced in zip(dtype_tensors, _unflatten_dense_tensors(flat, dtype_tensors)):
+            t.copy_(synced)
+
 def weight_norm(module:torch.nn.Module, non_embedding=True)->float:
-    return torch.linalg.norm(torch.cat([p.view(-1) for p in module_params(module, non_embedding)])).item()
+    params = list(module_params(module, non_embedding))
+    if any(hasattr(p, 'to_local') for p in params) or is_model_parallel(params):
+        # must be called on all ranks
+        return distributed_norm(params).item()
+    return torch.linalg.norm(torch.cat([p.view(-1) for p in params])).item()
 
 def save_yaml(obj, filepath:str):
     with open(filepath, 'w', encoding='utf-8') as f:
@@ -683,6 +843,7 @@ def download_file(url, filename):
     """
 
     # Make a GET request to fetch the raw HTML content
+    import requests # imported on first use to keep startup fast
     response = requests.get(url, stream=True)
     response.raise_for_status()
 
@@ -735,6 +896,23 @@ def get_global_rank()->int:
 def get_world_size()->int:
     return int(os.environ.get('WORLD_SIZE', '1'))
 
+def get_tensor_parallel_size()->int:
+    return int(os.environ.get('TENSOR_PARALLEL_SIZE', '1'))
+
+def get_restart_count()->int:
+    # number of times torchrun restarted the worker group after failures or slurm requeued the job
+    return int(os.environ.get('TORCHELASTIC_RESTART_COUNT', '0')) + int(os.environ.get('SLURM_RESTART_COUNT', '0'))
+
+def get_pipeline_parallel_size()->int:
+    return int(os.environ.get('PIPELINE_PARALLEL_SIZE', '1'))
+
+def get_data_parallel_rank()->int:
+    # ranks in same tensor or pipeline parallel group are contiguous and see the same data
+    return get_global_rank() // (get_tensor_parallel_size() * get_pipeline_parallel_size())
+
+def get_data_parallel_world_size()->int:
+    return get_world_size() // (get_tensor_parallel_size() * get_pipeline_parallel_size())
+
 def get_local_world_size()->int:
     return int(os.environ.get('LOCAL_WORLD_SIZE', '1'))
 
@@ -0,0 +1,87 @@
+from typing import Callable, Optional
+import os
+import sys
+import threading
+import faulthandler
+import timeit
+
+from nanugpt import utils
+from nanugpt import glogging as logging
+
+"""
+Watchdog that kills the process when training stops making progress, e.g., a rank died
+or a collective is stuck. Without this, other ranks wait in the collective until the
+job hits its walltime. The training loop calls beat() as it goes and a background thread
+exits the process if no beat came for timeout_s. torchrun then sees a failed worker,
+stops the rest of the worker group and restarts it (up to --max-restarts) and training
+resumes from the latest checkpoint.
+
+Faults can be injected for testing restarts with NANUGPT_INJECT_FAULT env var set to
+'<kill|hang>:<global_rank>:<step>'. Faults are only injected in the first attempt so
+the restarted group can finish.
+"""
+
+WATCHDOG_EXIT_CODE = 124 # same as timeout command
+
+def _log(log_fn:Callable, d:dict)->None:
+    # we must exit even if logger isn't setup or is broken
+    try:
+        log_fn(d)
+    except Exception:
+        print(d, file=sys.stderr, flush=True)
+
+class Watchdog:
+    def __init__(self, timeout_s:float, exit_code:int=WATCHDOG_EXIT_CODE):
+        self.timeout_s = timeout_s
+        self.exit_code = exit_code
+        self.last_beat = timeit.default_timer()
+        self.last_label = 'start'
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='watchdog', daemon=True)
+        self._thread.start()
+
+    def beat(self, label:str)->None:
+        """Marks progress, label is logged if the watchdog fires."""
+        self.last_beat = timeit.default_timer()
+        self.last_label = label
+
+    def stop(self)->None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(min(self.timeout_s / 10, 10.0)):
+            since_beat = timeit.default_timer() - self.last_beat
+            if since_beat > self.timeout_s:
+                _log(logging.error, {'watchdog/timeout_s': self.timeout_s,
+                                     'watchdog/since_beat_s': since_beat,
+                                     'watchdog/last_beat': self.last_label,
+                                     'watchdog/global_rank': utils.get_global_rank()})
+                # stacks of all threads show which collective we were stuck in
+                faulthandler.dump_traceback(file=sys.stderr, all_threads=True)
+                sys.stderr.flush()
+                # exit without cleanup as that could block on the stuck collective
+                os._exit(self.exit_code)
+
+def create_watchdog(timeout_s:float)->Optional[Watchdog]:
+    return Watchdog(timeout_s) if timeout_s > 0 else None
+
+def create_fault_injector()->Optional[Callable[[int], None]]:
+    """Returns fn(step) that injects fault set by NANUGPT_INJECT_FAULT on this rank, None if there is none."""
+    fault = os.environ.get('NANUGPT_INJECT_FAULT', '')
+    if not fault or utils.get_restart_count() > 0:
+        return None
+    kind, rank, fault_step = fault.split(':')
+    if kind not in ('kill', 'hang'):
+        raise ValueError(f"Unknown fault kind in NANUGPT_INJECT_FAULT: '{kind}', use 'kill' or 'hang'")
+    if int(rank) != utils.get_global_rank():
+        return None
+
+    def inject_fault(step:int)->None:
+        if step != int(fault_step):
+            return
+        _log(logging.warn, {'watchdog/injected_fault': kind, 'watchdog/step': step})
+        if kind == 'kill':
+            os._exit(1)
+        threading.Event().wait() # hang
+    return inject_fault
@@ -0,0 +1,102 @@
+# Measures memory saved and recompute overhead of activation checkpointing policies.
+# Run it with:
+# python scripts/estimates/activation_checkpointing_bench.py --model nanugpt.models.nanogpt.get_model --batch_size 12
+#
+# On CUDA memory is peak allocated memory for fwd+bwd, on CPU it's the size of
+# tensors saved for backward (which is what activation checkpointing reduces).
+
+import argparse
+import timeit
+import statistics
+
+import torch
+
+from nanugpt import utils
+
+POLICIES = [('none', 1), ('block', 1), ('block', 2), ('attn', 1), ('mlp', 1)]
+
+class SavedTensorsCounter:
+    def __init__(self):
+        self.nbytes = 0
+    def pack(self, t):
+        self.nbytes += t.numel() * t.element_size()
+        return t
+    def unpack(self, t):
+        return t
+
+def fwd_bwd(model, idx, device_type:str, dtype):
+    with torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype!=torch.float32):
+        logits = model(idx)
+        loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)), idx.view(-1))
+    loss.backward()
+
+def measure(get_model, model_kwargs, policy, every, batch_size, context_length, vocab_size,
+            device, dtype, iters):
+    model = get_model(vocab_size=vocab_size, context_length=context_length,
+                      activation_checkpointing=policy, activation_checkpointing_every=every,
+                      **model_kwargs).to(device)
+    idx = torch.randint(0, vocab_size, (batch_size, context_length), device=device)
+
+    # warmup
+    fwd_bwd(model, idx, device.type, dtype)
+    model.zero_grad(set_to_none=True)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_mem = torch.cuda.memory_allocated()
+        fwd_bwd(model, idx, device.type, dtype)
+        torch.cuda.synchronize()
+        mem = torch.cuda.max_memory_allocated() - base_mem
+    else:
+        # checkpointed regions keep their own saved tensors hooks so we only see what's kept alive
+        counter = SavedTensorsCounter()
+        with torch.autograd.graph.saved_tensors_hooks(counter.pack, counter.unpack):
+            fwd_bwd(model, idx, device.type, dtype)
+        mem = counter.nbytes
+    model.zero_grad(set_to_none=True)
+
+    times = []
+    for _ in range(iters):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = timeit.default_timer()
+        fwd_bwd(model, idx, device.type, dtype)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(timeit.default_timer() - start_time)
+        model.zero_grad(set_to_none=True)
+
+    return mem, statistics.median(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='nanugpt.models.nanogpt.get_model')
+    parser.add_argument('--n_layer', type=int, default=12)
+    parser.add_argument('--n_embd', type=int, default=768)
+    parser.add_argument('--n_head', type=int, default=12)
+    parser.add_argument('--vocab_size', type=int, default=50304)
+    parser.add_argument('--context_length', type=int, default=1024)
+    parser.add_argument('--batch_size', type=int, default=12)
+    parser.add_argument('--dtype', default='bfloat16')
+    parser.add_argument('--iters', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = getattr(torch, args.dtype)
+    get_model = utils.import_fn(args.model)
+    model_kwargs = dict(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head)
+
+    results = []
+    for policy, every in POLICIES:
+        mem, step_time = measure(get_model, model_kwargs, policy, every, args.batch_size,
+                                 args.context_length, args.vocab_size, device, dtype, args.iters)
+        results.append((policy, every, mem, step_time))
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    base_mem, base_time = results[0][2], results[0][3]
+    print(f'{"policy":>8} {"every":>6} {"mem MB":>10} {"saved":>8} {"fwd+bwd s":>10} {"overhead":>9}')
+    for policy, every, mem, step_time in results:
+        print(f'{policy:>8} {every:>6} {mem/2**20:>10.1f} {1-mem/base_mem:>8.1%} '
+              f'{step_time:>10.4f} {step_time/base_time-1:>9.1%}')
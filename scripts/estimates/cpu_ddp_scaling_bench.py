@@ -0,0 +1,80 @@
+# Measures how the training loop scales with number of CPU DDP ranks (gloo) on one node by
+# running train.py under torchrun for each rank count and reading its metrics store:
+# python scripts/estimates/cpu_ddp_scaling_bench.py --ranks 1,2,4,8 --threads_per_rank 1
+#
+# Extra args are passed to train.py, e.g. --model.module_kwargs.n_layer 2. Batch per rank is
+# fixed so global batch grows with ranks (weak scaling). With --threads_per_rank N each rank
+# gets its own N cores and ideal speedup is number of ranks. With --threads_per_rank 0 cores
+# of the node are split between ranks so ideal speedup is 1, which shows whether more ranks
+# with fewer threads beats fewer ranks with more threads.
+#
+# allreduce% is time from first gradient bucket all-reduce launch to last completion over
+# step time. DDP overlaps this with backward so it is an upper bound on exposed communication.
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from nanugpt import metrics_store
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+def run(n_ranks:int, args, extra_args, out_dir:str)->dict:
+    cmd = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={n_ranks}',
+           os.path.join(REPO_ROOT, 'train.py'), args.config,
+           '--general.device_type', 'cpu',
+           '--general.distributed_backend', 'gloo',
+           '--general.ddp_comm_stats', 'true',
+           '--general.dtype', args.dtype,
+           '--general.torch_compile', 'false',
+           '--general.cpu_threads', str(args.threads_per_rank),
+           '--general.cpu_affinity', 'auto',
+           '--general.out_dir', out_dir,
+           '--training.max_steps', str(args.max_steps),
+           '--training.device_batch_size', str(args.device_batch_size),
+           '--training.global_batch_size', str(args.device_batch_size * n_ranks),
+           '--training.log_every', '1',
+           '--eval.eval_every', str(args.max_steps * 10),
+           *extra_args]
+    subprocess.run(cmd, check=True, cwd=REPO_ROOT,
+                   stdout=None if args.verbose else subprocess.DEVNULL)
+
+    df = metrics_store.load_run(os.path.join(out_dir, 'metrics'),
+                                columns=['train/step', 'train/tokens', 'train/step_interval', 'train/comm_time_s'])
+    df = df[df['train/step_interval'].notna()].sort_values('train/step')
+    df = df.assign(step_tokens=df['train/tokens'].diff())
+    df = df[df['train/step'] >= args.warmup_steps]
+    return {'step_time': float(np.median(df['train/step_interval'])),
+            'tokens_per_sec': float(np.median(df['step_tokens'] / df['train/step_interval'])),
+            'comm_share': float(np.median(df['train/comm_time_s'].fillna(0.0) / df['train/step_interval']))}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/train_gpt2/tinyshakespeare.yaml')
+    parser.add_argument('--ranks', default='1,2,4,8')
+    parser.add_argument('--threads_per_rank', type=int, default=1, help='0 splits cores of node between ranks')
+    parser.add_argument('--device_batch_size', type=int, default=8)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--max_steps', type=int, default=200, help='must be more than warmup_iters of scheduler')
+    parser.add_argument('--warmup_steps', type=int, default=10)
+    parser.add_argument('--out_dir', default='', help='blank uses temp dir')
+    parser.add_argument('--verbose', action='store_true')
+    args, extra_args = parser.parse_known_args()
+
+    out_root = args.out_dir or tempfile.mkdtemp(prefix='cpu_ddp_scaling_')
+    results = []
+    for n_ranks in [int(r) for r in args.ranks.split(',')]:
+        results.append((n_ranks, run(n_ranks, args, extra_args, os.path.join(out_root, f'ranks{n_ranks}'))))
+
+    base_tps = results[0][1]['tokens_per_sec'] / results[0][0]
+    print(f'{"ranks":>6} {"step s":>9} {"tokens/s":>10} {"speedup":>8} {"efficiency":>10} {"allreduce%":>10}')
+    for n_ranks, r in results:
+        speedup = r['tokens_per_sec'] / (base_tps * results[0][0])
+        ideal = n_ranks / results[0][0] if args.threads_per_rank > 0 else 1.0
+        print(f'{n_ranks:>6} {r["step_time"]:>9.4f} {r["tokens_per_sec"]:>10.0f} {speedup:>7.2f}x '
+              f'{speedup/ideal:>10.1%} {r["comm_share"]:>10.1%}')
+    print(f'runs in {out_root}')
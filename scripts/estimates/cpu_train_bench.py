@@ -0,0 +1,90 @@
+# Measures CPU training step time (fwd+bwd+optimizer) for the settings of the CPU path:
+# float32 vs bfloat16 autocast, for-loop vs foreach vs fused AdamW and torch.compile.
+# Defaults are the model of configs/train_gpt2/tinyshakespeare.yaml. Run it with:
+# python scripts/estimates/cpu_train_bench.py --batch_size 16 --threads 8
+#
+# 'old' is what CPU runs did before: float32 without autocast and for-loop AdamW.
+
+import argparse
+import timeit
+import statistics
+from contextlib import nullcontext
+
+import torch
+
+from nanugpt import utils
+
+# name, dtype, AdamW kwargs, compile
+VARIANTS = [
+    ('old', torch.float32, dict(foreach=False), False),
+    ('foreach', torch.float32, dict(foreach=True), False),
+    ('fused', torch.float32, dict(fused=True), False),
+    ('bf16+fused', torch.bfloat16, dict(fused=True), False),
+    ('bf16+fused+compile', torch.bfloat16, dict(fused=True), True),
+]
+
+def measure(get_model, model_kwargs, dtype, optim_kwargs, compile, batch_size, context_length,
+            vocab_size, iters, warmup):
+    torch.manual_seed(42)
+    model = get_model(vocab_size=vocab_size, context_length=context_length, **model_kwargs)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, **optim_kwargs)
+    if compile:
+        model = torch.compile(model)
+    amp_ctx = nullcontext() if dtype == torch.float32 else torch.autocast('cpu', dtype=dtype)
+    idx = torch.randint(0, vocab_size, (batch_size, context_length))
+
+    def train_step():
+        with amp_ctx:
+            logits = model(idx)
+            loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)).float(), idx.view(-1))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    for _ in range(warmup): # compile happens here
+        train_step()
+    times = []
+    for _ in range(iters):
+        start_time = timeit.default_timer()
+        train_step()
+        times.append(timeit.default_timer() - start_time)
+    return statistics.median(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='nanugpt.models.nanogpt.get_model')
+    parser.add_argument('--n_layer', type=int, default=6)
+    parser.add_argument('--n_embd', type=int, default=384)
+    parser.add_argument('--n_head', type=int, default=6)
+    parser.add_argument('--vocab_size', type=int, default=256)
+    parser.add_argument('--context_length', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=0, help='0 uses torch default')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--variants', default='', help='comma separated names, blank runs all')
+    args = parser.parse_args()
+
+    cpu_info = utils.setup_cpu_threads(args.threads, 0, '', 0, 1)
+    print(f'threads: {cpu_info["cpu/num_threads"]}, cpu: {torch.backends.cpu.get_cpu_capability()}, '
+          f'bf16 kernels: {torch.ops.mkldnn._is_mkldnn_bf16_supported()}')
+
+    get_model = utils.import_fn(args.model)
+    model_kwargs = dict(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head)
+    names = set(args.variants.split(',')) if args.variants else None
+    if not utils.fused_adamw_supported('cpu'):
+        names = (names or set(v[0] for v in VARIANTS)) - {v[0] for v in VARIANTS if 'fused' in v[2]}
+
+    results = []
+    for name, dtype, optim_kwargs, compile in VARIANTS:
+        if names is not None and name not in names:
+            continue
+        step_time = measure(get_model, model_kwargs, dtype, optim_kwargs, compile, args.batch_size,
+                            args.context_length, args.vocab_size, args.iters, args.warmup)
+        results.append((name, step_time))
+
+    base_time = results[0][1]
+    tokens = args.batch_size * args.context_length
+    print(f'{"variant":>20} {"step s":>9} {"tokens/s":>10} {"speedup":>8}')
+    for name, step_time in results:
+        print(f'{name:>20} {step_time:>9.4f} {tokens/step_time:>10.0f} {base_time/step_time:>8.2f}x')
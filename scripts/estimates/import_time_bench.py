@@ -0,0 +1,57 @@
+# Measures how long importing nanugpt modules takes in a fresh process and which imports
+# dominate, so startup regressions are visible. Run it with:
+# python scripts/estimates/import_time_bench.py --module nanugpt.train --runs 5
+#
+# tests/test_import_time.py checks that heavy optional packages are not imported at all.
+
+import argparse
+import statistics
+import subprocess
+import sys
+import timeit
+
+def import_once(module:str)->str:
+    # -X importtime writes per-module timings to stderr
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          check=True, capture_output=True, text=True).stderr
+
+def parse_importtime(stderr:str):
+    """Returns list of (self_us, cumulative_us, module)"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='nanugpt.train')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top_k', type=int, default=15)
+    args = parser.parse_args()
+
+    import_once(args.module) # warm OS file cache
+
+    wall_times, rows = [], []
+    for _ in range(args.runs):
+        start_time = timeit.default_timer()
+        rows = parse_importtime(import_once(args.module))
+        wall_times.append(timeit.default_timer() - start_time)
+
+    total = next(c for s, c, name in rows if name == args.module)
+    print(f'{args.module}: import {total/1e6:.3f}s, process wall time median {statistics.median(wall_times):.3f}s '
+          f'(min {min(wall_times):.3f}s) over {args.runs} runs')
+
+    top_level = {}
+    for self_us, cumulative_us, name in rows:
+        if '.' not in name:
+            top_level[name] = top_level.get(name, 0) + cumulative_us
+    print(f'\n{"package":<32} {"cumulative s":>12}')
+    for name, cumulative_us in sorted(top_level.items(), key=lambda kv: -kv[1])[:args.top_k]:
+        print(f'{name:<32} {cumulative_us/1e6:>12.3f}')
+
+    print(f'\n{"module":<48} {"self s":>8}')
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: -r[0])[:args.top_k]:
+        print(f'{name:<48} {self_us/1e6:>8.3f}')
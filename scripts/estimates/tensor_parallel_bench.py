@@ -0,0 +1,93 @@
+# Measures training throughput of nanogpt for each tensor parallel size that divides world size,
+# remaining ranks are used for data parallel. Runs on CPU with gloo if no GPUs:
+# torchrun --standalone --nproc_per_node=4 scripts/estimates/tensor_parallel_bench.py --n_layer 4 --n_embd 256 --n_head 8 --context_length 256
+#
+# Global batch is kept same for all layouts so tokens/sec are comparable. With TP each rank
+# holds 1/tp of block params but does 2 all-reduces of activations per block in forward and
+# 2 in backward, so TP pays off when model doesn't fit or when interconnect is fast.
+
+import argparse
+import os
+import timeit
+import statistics
+
+import torch
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from nanugpt import utils
+from nanugpt import tensor_parallel
+from nanugpt.models import nanogpt
+
+def measure(torch_info:utils.TorchInfo, tp_size:int, args, device)->float:
+    model = nanogpt.get_model(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head,
+                              vocab_size=args.vocab_size, context_length=args.context_length).to(device)
+    mesh = tensor_parallel.init_mesh(torch_info, tp_size)
+    if tp_size > 1:
+        model = tensor_parallel.apply_tensor_parallel(model, mesh['tp'])
+    model = DistributedDataParallel(model, process_group=mesh['dp'].get_group())
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    dp_size = torch_info.world_size // tp_size
+    batch_size = args.global_batch_size // dp_size
+    # ranks in same TP group use same batch
+    g = torch.Generator().manual_seed(mesh['dp'].get_local_rank())
+    idx = torch.randint(0, args.vocab_size, (batch_size, args.context_length), generator=g).to(device)
+
+    def step():
+        logits = model(idx)
+        loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)), idx.view(-1))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step() # warmup
+    times = []
+    for _ in range(args.iters):
+        dist.barrier()
+        start_time = timeit.default_timer()
+        step()
+        times.append(timeit.default_timer() - start_time)
+    # slowest rank determines step time
+    step_time = torch.tensor([statistics.median(times)], device=device)
+    dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+    return step_time.item()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_layer', type=int, default=4)
+    parser.add_argument('--n_embd', type=int, default=256)
+    parser.add_argument('--n_head', type=int, default=8)
+    parser.add_argument('--vocab_size', type=int, default=8192)
+    parser.add_argument('--context_length', type=int, default=256)
+    parser.add_argument('--global_batch_size', type=int, default=8)
+    parser.add_argument('--iters', type=int, default=10)
+    args = parser.parse_args()
+
+    is_cuda = torch.cuda.is_available()
+    local_rank, global_rank, world_size = int(os.environ.get('LOCAL_RANK', '0')), \
+        utils.get_global_rank(), utils.get_world_size()
+    dist.init_process_group('nccl' if is_cuda else 'gloo')
+    if is_cuda:
+        torch.cuda.set_device(local_rank)
+    device = torch.device(f'cuda:{local_rank}' if is_cuda else 'cpu')
+    torch_info = utils.TorchInfo(is_cuda=is_cuda, is_distributed=True, device_type=device.type,
+                                 dtype='float32', device_name=str(device),
+                                 global_rank=global_rank, local_rank=local_rank, world_size=world_size,
+                                 is_master=global_rank==0, seed_offset=global_rank,
+                                 pt_dtype=torch.float32, device_id=local_rank if is_cuda else -1)
+
+    results = []
+    for tp_size in [t for t in range(1, world_size+1) if world_size % t == 0 and args.n_head % t == 0]:
+        results.append((tp_size, measure(torch_info, tp_size, args, device)))
+
+    if global_rank == 0:
+        tokens = args.global_batch_size * args.context_length
+        base_time = results[0][1]
+        print(f'{"tp":>4} {"dp":>4} {"step s":>10} {"tokens/s":>10} {"speedup":>8}')
+        for tp_size, step_time in results:
+            print(f'{tp_size:>4} {world_size // tp_size:>4} {step_time:>10.4f} '
+                  f'{tokens/step_time:>10.0f} {base_time/step_time:>8.2f}')
+    dist.destroy_process_group()
@@ -0,0 +1,32 @@
+#!/bin/bash
+# Tests elastic restarts on CPU with gloo: kills and then hangs rank 1 at step 15 and checks
+# that torchrun restarts workers, training resumes from latest checkpoint and finishes.
+# Then resumes same run with 1 process to check data re-sharding for new world size.
+# usage: bash scripts/oneoff_tests/elastic_kill_test.sh
+set -e
+set -o xtrace
+
+OUT_DIR=${OUT_DIR:-/tmp/elastic_kill_test}
+ARGS="configs/train_gpt2/tinyshakespeare.yaml --general.device_type cpu --general.distributed_backend gloo \
+    --general.torch_compile false --general.dtype float32 --general.distributed_timeout_s 60 \
+    --training.max_steps 30 --training.device_batch_size 8 --training.global_batch_size 16 \
+    --model.module_kwargs.n_layer 2 --model.module_kwargs.n_embd 64 --model.module_kwargs.n_head 2 \
+    --model.module_kwargs.context_length 64 --scheduler.module_kwargs.warmup_iters 5 \
+    --eval.checkpoint_every_hr 0 --eval.checkoint_after 0 --eval.checkpoint_keep_best false"
+rm -rf "${OUT_DIR}"
+
+for FAULT in kill hang; do
+    NANUGPT_INJECT_FAULT=${FAULT}:1:15 torchrun --standalone --nproc_per_node=2 --max-restarts=3 \
+        train.py ${ARGS} --general.watchdog_timeout_s 20 \
+        --general.run_name ${FAULT} --general.out_dir "${OUT_DIR}/${FAULT}"
+    grep -q "run/restart_count=" "${OUT_DIR}/${FAULT}/log.txt"
+    grep -q "run/end_time=" "${OUT_DIR}/${FAULT}/log.txt"
+done
+
+# continue kill run with different world size
+python train.py ${ARGS} --training.max_steps 36 --general.resume_from auto \
+    --general.run_name kill --general.out_dir "${OUT_DIR}/kill"
+grep -q "re-sharded" "${OUT_DIR}/kill/log.txt"
+
+set +o xtrace
+echo "Elastic kill test passed, logs in ${OUT_DIR}"
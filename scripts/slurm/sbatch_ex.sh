@@ -28,7 +28,8 @@ export ENV_SETUP_SCRIPT=${ENV_SETUP_SCRIPT:-} # script to setup environment for
 
 export INSTALL_PACKAGE=${INSTALL_PACKAGE:-1} # pip install in source directory
 export UPDATE_PYTHONPATH=${UPDATE_PYTHONPATH:-0} # add source dir to PYTHONPATH (ignored if INSTALL_PACKAGE=1)
-RESTARTABLE=${RESTARTABLE:-1}   # is job restartable if preempted?
+export RESTARTABLE=${RESTARTABLE:-1}   # is job restartable if preempted?
+PREEMPT_SIGNAL_S=${PREEMPT_SIGNAL_S:-300} # send SIGUSR1 this many seconds before walltime so job can checkpoint
 
 SCRIPT_DIR="$(dirname "$(realpath "$0")")"
 
@@ -38,6 +39,7 @@ mkdir -p "${JOB_OUT_DIR}"
 PARTITION_ARG=""
 RESERVATION_ARG=""
 REQUEUE_ARG=""
+SIGNAL_ARG=""
 if [ ! -z "${PARTITION:-}" ]; then
     PARTITION_ARG="--partition=${PARTITION}"
 fi
@@ -51,6 +53,7 @@ else
 fi
 if [ "${RESTARTABLE}" -eq 1 ]; then
     REQUEUE_ARG="--requeue"
+    SIGNAL_ARG="--signal=USR1@${PREEMPT_SIGNAL_S}"
 fi
 
 # output core variables so user can see what is being used
@@ -95,7 +98,7 @@ cp "${SCRIPT_DIR}/"*.sh "${SLURM_SCRIPT_DIR}/"
 chmod +x "${SLURM_SCRIPT_DIR}/"*.sh
 
 sbatch \
-    ${PARTITION_ARG} ${RESERVATION_ARG} ${SHARE_NODE_ARG} ${REQUEUE_ARG} \
+    ${PARTITION_ARG} ${RESERVATION_ARG} ${SHARE_NODE_ARG} ${REQUEUE_ARG} ${SIGNAL_ARG} \
     --nodes=${NODES} \
     --gpus-per-node=${GPUS_PER_NODE} \
     --job-name=${JOB_NAME} \
@@ -111,7 +111,15 @@ fi
 if [ "${USE_TORCHRUN}" = "1" ]; then
     # build the torchrun command
     TORCH_RUN_ARGS="--nproc_per_node ${GPUS_PER_NODE} --nnodes ${SLURM_JOB_NUM_NODES} --node_rank ${SLURM_NODEID} --master_addr ${SLURM_LAUNCH_NODE_IPADDR} --master_port ${MASTER_PORT}"
-    eval "OUT_DIR=\"${JOB_OUT_DIR}\" torchrun ${TORCH_RUN_ARGS} ${START_COMMAND}"
+    # torchrun loses workers' REQUEUE_EXIT_CODE (see nanugpt/preemption.py) so workers touch this file
+    export NANUGPT_REQUEUE_FILE=$(mktemp -u)
+    EXIT_CODE=0
+    eval "OUT_DIR=\"${JOB_OUT_DIR}\" torchrun ${TORCH_RUN_ARGS} ${START_COMMAND}" || EXIT_CODE=$?
+    if [ -f "${NANUGPT_REQUEUE_FILE}" ]; then
+        rm -f "${NANUGPT_REQUEUE_FILE}"
+        exit 75
+    fi
+    exit ${EXIT_CODE}
 else
     # setup vars needed for torch.dist.init_process_group
     export CUDA_VISIBLE_DEVICES=${gpu_array[$SLURM_LOCALID]}
@@ -15,6 +15,8 @@ set -eu -o pipefail # fail if any command failes, log all commands, -o xtrace
 REQUIRED_VARS=("GPUS_PER_NODE" "CONTAINER_IMAGE_PATH" "JOB_OUT_DIR" "TARGET_SOURCE_DIR" "SLURM_SCRIPT_DIR")
 CONTAINER_MOUNTS=${CONTAINER_MOUNTS:-}  # app specific mounts to be attached to container as source:destination
 JOB_ENV_SETUP_SCRIPT=${JOB_ENV_SETUP_SCRIPT:-} # script to setup environment for specific cluster
+RESTARTABLE=${RESTARTABLE:-0}   # requeue job if workers exit with REQUEUE_EXIT_CODE
+REQUEUE_EXIT_CODE=75 # workers checkpointed before preemption or walltime, see nanugpt/preemption.py
 export USE_TORCHRUN=${USE_TORCHRUN:-0}  # use torchrun or direct slurm launch (recommanded)
 
 # Some slurm environment use pmi or pmi2 plugins for MPI in which case set this
@@ -54,6 +56,7 @@ fi
 
 NTASKS=$((SLURM_JOB_NUM_NODES * GPUS_PER_NODE))
 # start the script in the container that will launch target script
+EXIT_CODE=0
 srun --ntasks=${NTASKS} --ntasks-per-node=${GPUS_PER_NODE} ${MPI_ARG} \
     -o "${JOB_OUT_DIR}/srun_log_${RESTART_COUNT}.txt" \
     -e "${JOB_OUT_DIR}/srun_err_${RESTART_COUNT}.txt" \
@@ -61,4 +64,12 @@ srun --ntasks=${NTASKS} --ntasks-per-node=${GPUS_PER_NODE} ${MPI_ARG} \
     --container-mounts "${ALL_CONTAINER_MOUNTS}" \
     --container-writable --no-container-mount-home --no-container-remap-root \
     --wait=60 --kill-on-bad-exit=1 --label \
-    "${SLURM_SCRIPT_DIR}/slaunch_ex.sh"
+    "${SLURM_SCRIPT_DIR}/slaunch_ex.sh" || EXIT_CODE=$?
+
+# walltime doesn't requeue the job by itself so we do it, on preemption slurm may already have
+if [ "${EXIT_CODE}" -eq "${REQUEUE_EXIT_CODE}" ] && [ "${RESTARTABLE}" -eq 1 ]; then
+    echo "Workers exited for preemption, requeuing job ${SLURM_JOB_ID}"
+    scontrol requeue "${SLURM_JOB_ID}" || true
+    exit 0
+fi
+exit ${EXIT_CODE}
@@ -11,4 +11,6 @@ set -eu -o pipefail # fail if any command failes, log all commands, -o xtrace
 # DATA_ROOT="/mnt/path/to/data" \
 # JOB_NAME=<my_job_name> \
 # OUT_DIR=<my_out_dir> \
-bash sbatch_ex.sh train.py --general.project_name ${JOB_NAME} $@
\ No newline at end of file
+# run name must stay same when job is requeued so it resumes from its own checkpoints
+RUN_NAME=${RUN_NAME:-$(date +%Y%m%d-%H%M%S)}
+bash sbatch_ex.sh train.py --general.project_name ${JOB_NAME} --general.run_name ${RUN_NAME} $@
\ No newline at end of file
@@ -0,0 +1,39 @@
+from typing import Any, Callable, List
+import os
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from nanugpt import utils
+
+"""
+Runs a test function on several gloo ranks on CPU. Function must be defined at module level
+of the test file so spawned processes can import it.
+"""
+
+def cpu_torch_info(rank:int, world_size:int)->utils.TorchInfo:
+    return utils.TorchInfo(is_cuda=False, is_distributed=True, device_type='cpu', dtype='float32',
+                           device_name='cpu', global_rank=rank, local_rank=rank, world_size=world_size,
+                           is_master=rank==0, seed_offset=rank, pt_dtype=torch.float32, device_id=-1)
+
+def _worker(rank:int, world_size:int, port:int, out_dir:str, fn:Callable, args:tuple):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        result = fn(cpu_torch_info(rank, world_size), *args)
+        torch.save(result, os.path.join(out_dir, f'rank{rank}.pt'))
+    finally:
+        dist.destroy_process_group()
+
+def run_ranks(fn:Callable, world_size:int, *args)->List[Any]:
+    """Calls fn(torch_info, *args) on each rank, returns what each rank returned in rank order."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with tempfile.TemporaryDirectory() as out_dir:
+        mp.spawn(_worker, args=(world_size, port, out_dir, fn, args), nprocs=world_size)
+        return [torch.load(os.path.join(out_dir, f'rank{rank}.pt'), weights_only=False)
+                for rank in range(world_size)]
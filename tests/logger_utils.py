@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+import sys
+
+from nanugpt import glogging
+
+# module level state that glogging.Logger sets on construction
+_GLOBALS = ['_logger', '_except_handler_installed', 'summary', 'log_config',
+            'info', 'warn', 'error', 'log_sys_info', 'shutdown', 'flush']
+
+@contextmanager
+def scoped_logger(**kwargs):
+    """Creates glogging.Logger and restores glogging globals and excepthook on exit so
+    other tests can create their own."""
+    saved = {k: getattr(glogging, k) for k in _GLOBALS}
+    saved_excepthook = sys.excepthook
+    logger = None
+    try:
+        logger = glogging.Logger(**{'save_on_exit': False, 'summaries_stdout': False, **kwargs})
+        yield logger
+    finally:
+        if logger is not None:
+            logger.shutdown(write_total_time=False)
+        for k, v in saved.items():
+            setattr(glogging, k, v)
+        sys.excepthook = saved_excepthook
@@ -0,0 +1,31 @@
+import unittest
+
+import torch
+
+from nanugpt.models import nanogpt, nanogpt_keller
+from nanugpt.losses import autoregressive_loss
+
+def _loss_and_grads(get_model, policy:str, every:int):
+    torch.manual_seed(0)
+    model = get_model(n_layer=4, n_embd=32, n_head=2, vocab_size=64, context_length=16,
+                      activation_checkpointing=policy, activation_checkpointing_every=every)
+    x = torch.randint(0, 64, (2, 17), generator=torch.Generator().manual_seed(1))
+    loss, _, _ = autoregressive_loss.get_loss(model(x[:, :-1].contiguous()), x[:, 1:].contiguous())
+    loss.backward()
+    return loss.detach(), {n: p.grad for n, p in model.named_parameters()}
+
+class TestActivationCheckpointing(unittest.TestCase):
+    def test_policies_match_no_checkpointing(self):
+        for get_model in [nanogpt.get_model, nanogpt_keller.get_model]:
+            expected_loss, expected_grads = _loss_and_grads(get_model, 'none', 1)
+            for policy in ['block', 'attn', 'mlp']:
+                for every in [1, 2]:
+                    with self.subTest(model=get_model.__module__, policy=policy, every=every):
+                        loss, grads = _loss_and_grads(get_model, policy, every)
+                        torch.testing.assert_close(loss, expected_loss)
+                        self.assertEqual(grads.keys(), expected_grads.keys())
+                        for name, grad in grads.items():
+                            torch.testing.assert_close(grad, expected_grads[name], msg=lambda m: f'{name}: {m}')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import unittest
+
+from nanugpt.glogging import AsyncWriter
+from logger_utils import scoped_logger
+
+class TestAsyncWriter(unittest.TestCase):
+    def test_order_and_thread(self):
+        records, threads = [], set()
+        def write(i):
+            records.append(i)
+            threads.add(threading.current_thread().name)
+        writer = AsyncWriter(queue_size=4)
+        for i in range(100):
+            self.assertTrue(writer.enqueue(write, i))
+        self.assertTrue(writer.flush())
+        self.assertEqual(records, list(range(100)))
+        self.assertEqual(threads, {'glogging_writer'})
+        writer.stop()
+        # after stop calls run on caller thread
+        self.assertFalse(writer.enqueue(write, 100))
+
+    def test_drop(self):
+        release = threading.Event()
+        records, dropped = [], []
+        writer = AsyncWriter(queue_size=2, full_policy='drop', on_dropped=dropped.append)
+        writer.enqueue(release.wait) # blocks writer
+        for i in range(10):
+            writer.enqueue(records.append, i, droppable=True)
+        release.set()
+        writer.enqueue(records.append, 'kept') # not droppable, waits for space
+        writer.stop()
+        self.assertEqual(records[-1], 'kept')
+        self.assertEqual(len(records) - 1 + writer.dropped, 10)
+        self.assertGreater(writer.dropped, 0)
+        self.assertEqual(dropped[-1], writer.dropped)
+
+    def test_bad_record(self):
+        records = []
+        writer = AsyncWriter(queue_size=4)
+        writer.enqueue(lambda: 1/0)
+        writer.enqueue(records.append, 1)
+        writer.stop()
+        self.assertEqual(records, [1])
+
+    def test_bad_on_dropped(self):
+        release = threading.Event()
+        records = []
+        def on_dropped(n):
+            raise RuntimeError('bad handler')
+        writer = AsyncWriter(queue_size=1, full_policy='drop', on_dropped=on_dropped)
+        writer.enqueue(release.wait) # blocks writer
+        for i in range(5):
+            writer.enqueue(records.append, i, droppable=True)
+        release.set()
+        self.assertTrue(writer.flush(timeout=10))
+        self.assertTrue(writer.thread.is_alive())
+        # queue still drains so blocking producers don't deadlock
+        for i in range(5, 10):
+            writer.enqueue(records.append, i)
+        writer.stop()
+        self.assertEqual(records[-5:], list(range(5, 10)))
+
+    def test_logger_drops_without_py_logger(self):
+        with scoped_logger(async_queue_size=1, async_full_policy='drop') as logger:
+            logger._py_logger = None
+            assert logger._writer is not None
+            release = threading.Event()
+            logger._writer.enqueue(release.wait) # blocks writer
+            for i in range(5):
+                logger.info({'train/step': i})
+            release.set()
+            self.assertTrue(logger._writer.flush(timeout=10))
+            self.assertGreater(logger._writer.reported_dropped, 0)
+            self.assertTrue(logger._writer.thread.is_alive())
+
+    def test_logger_never_drops_messages(self):
+        with scoped_logger(async_queue_size=1, async_full_policy='drop') as logger:
+            assert logger._writer is not None
+            messages = []
+            logger._py_logger.info = messages.append # type: ignore
+            release = threading.Event()
+            logger._writer.enqueue(release.wait) # blocks writer
+            for i in range(2): # fill queue, at least one is dropped
+                logger.info({'train/step': i})
+            # producer waits for space so release writer from another thread
+            threading.Timer(0.2, release.set).start()
+            for i in range(3):
+                logger.info(f'message {i}')
+            self.assertTrue(logger._writer.flush(timeout=10))
+            self.assertGreater(logger._writer.dropped, 0)
+            self.assertEqual([m for m in messages if m.startswith('message')],
+                             ['message 0', 'message 1', 'message 2'])
+
+if __name__ == '__main__':
+    unittest.main()
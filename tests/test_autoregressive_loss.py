@@ -0,0 +1,41 @@
+import unittest
+
+import torch
+
+from nanugpt.losses import autoregressive_loss
+from nanugpt.models import nanogpt
+
+def _model(fused:bool)->torch.nn.Module:
+    return nanogpt.get_model(n_layer=2, n_embd=16, n_head=2, vocab_size=37, context_length=8,
+                             fused_lm_head_loss=fused)
+
+class TestAutoregressiveLoss(unittest.TestCase):
+    def test_fused_lm_head_loss_matches_logits_loss(self):
+        torch.manual_seed(0)
+        x, y = torch.randint(0, 37, (3, 8)), torch.randint(0, 37, (3, 8))
+        y[0, 0] = -1 # ignored
+
+        results = []
+        for fused in [False, True]:
+            model = _model(fused)
+            # chunk size not dividing batch*seq_len tests last partial chunk
+            loss, correct, n_preds = autoregressive_loss.get_loss(model(x), y, chunk_size=5)
+            loss.backward()
+            results.append((loss.detach(), correct, n_preds, {n: p.grad for n, p in model.named_parameters()}))
+
+        (loss, correct, n_preds, grads), (f_loss, f_correct, f_n_preds, f_grads) = results
+        torch.testing.assert_close(f_loss, loss)
+        self.assertEqual((f_correct.item(), f_n_preds), (correct.item(), n_preds))
+        for name in grads:
+            torch.testing.assert_close(f_grads[name], grads[name])
+
+    def test_no_grads_and_no_accuracy(self):
+        model = _model(True)
+        x = torch.randint(0, 37, (2, 8))
+        with torch.no_grad():
+            loss, correct, _ = autoregressive_loss.get_loss(model(x), x, compute_accuracy=False)
+        self.assertFalse(loss.requires_grad)
+        self.assertEqual(correct.item(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
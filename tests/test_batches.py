@@ -0,0 +1,52 @@
+import time
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from nanugpt.train import Batches
+
+class _SlowDataset(Dataset):
+    def __init__(self, n:int, delay_s:float):
+        self.n, self.delay_s = n, delay_s
+    def __len__(self):
+        return self.n
+    def __getitem__(self, i):
+        time.sleep(self.delay_s)
+        return torch.tensor([i])
+
+class TestBatches(unittest.TestCase):
+    def test_pop_stats(self):
+        batches = Batches(DataLoader(_SlowDataset(4, 0.05), batch_size=2))
+        self.assertEqual(batches.pop_stats(), (0.0, 0))
+        for _ in range(3): # wraps to next epoch
+            batches.next()
+        wait_time, fetch_count = batches.pop_stats()
+        self.assertEqual(fetch_count, 3)
+        self.assertGreaterEqual(wait_time, 3 * 2 * 0.05)
+        self.assertEqual((batches.epoch, batches.epoch_batch), (1, 1))
+        self.assertEqual(batches.pop_stats(), (0.0, 0)) # reset after pop
+
+    def test_queue_depth(self):
+        self.assertIsNone(Batches([torch.zeros(1)]).queue_depth()) # no prefetch
+        self.assertIsNone(Batches(DataLoader(_SlowDataset(4, 0.0), batch_size=1)).queue_depth())
+
+        loader = DataLoader(_SlowDataset(16, 0.0), batch_size=1, num_workers=1, prefetch_factor=2)
+        batches = Batches(loader)
+        batches.next()
+        # workers fill the queue up to num_workers * prefetch_factor batches in flight
+        deadline = time.time() + 10
+        while (batches.queue_depth() or 0) == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        depth = batches.queue_depth()
+        self.assertIsNotNone(depth)
+        self.assertGreater(depth, 0)
+        self.assertLessEqual(depth, 1 * 2)
+
+    def test_queue_depth_tolerates_unexpected_internals(self):
+        batches = Batches([torch.zeros(1)])
+        batches.iter = type('FakeIter', (), {'_data_queue': object()})() # no qsize
+        self.assertIsNone(batches.queue_depth())
+
+if __name__ == '__main__':
+    unittest.main()
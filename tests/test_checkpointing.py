@@ -0,0 +1,162 @@
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from nanugpt import utils
+from nanugpt.checkpointing import AsyncCheckpointer, find_resume_checkpoint, rng_state, set_rng_state, load_checkpoint
+from nanugpt.delta_checkpoint import DeltaCheckpointWriter
+from nanugpt import sharded_checkpoint
+from nanugpt.train import estimate_loss
+from dist_utils import run_ranks
+
+def _sharded_retention(torch_info, out_dir:str, local_val_losses):
+    rank = torch_info.global_rank
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 4)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    checkpointer = AsyncCheckpointer(out_dir, keep_last=1, keep_best=True)
+    for step, val_losses in enumerate(local_val_losses):
+        # each rank sees only its part of val data, identity model makes its loss the input
+        loader = [(torch.tensor([[val_losses[rank]]]), torch.zeros(1))]
+        val_loss, _, _, _ = estimate_loss(torch.nn.Identity(), lambda out, y: (out.mean(), torch.tensor(0), 1),
+                                          loader, None, None, torch_info, 'cpu')
+        sharded_checkpoint.save_sharded(checkpointer, f'checkpoint_{step}', model, optimizer, rank, 2,
+                                        common={'train/step': step}, rank_state={}, val_loss=val_loss)
+    checkpointer.shutdown()
+    dist.barrier()
+
+class TestAsyncCheckpointer(unittest.TestCase):
+    def test_snapshot_is_isolated_from_training(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            checkpointer = AsyncCheckpointer(out_dir)
+            w = torch.zeros(4)
+            filepath = checkpointer.save('checkpoint_0', {'model': {'w': w}, 'train/step': 0})
+            # training continues to modify tensors while write may be in progress
+            w.add_(1.0)
+            checkpointer.wait()
+            checkpoint = torch.load(filepath)
+            self.assertTrue(torch.equal(checkpoint['model']['w'], torch.zeros(4)))
+            self.assertFalse(os.path.exists(filepath + '.tmp'))
+            checkpointer.shutdown()
+
+    def test_retention_keeps_last_and_best(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            checkpointer = AsyncCheckpointer(out_dir, keep_last=2, keep_best=True)
+            val_losses = [3.0, 1.0, 2.0, 2.5, 2.6]
+            for step, val_loss in enumerate(val_losses):
+                checkpointer.save(f'checkpoint_{step}', {'train/step': step}, val_loss=val_loss)
+            checkpointer.shutdown()
+            self.assertEqual(sorted(os.listdir(out_dir)),
+                             ['checkpoint_1.pt', 'checkpoint_3.pt', 'checkpoint_4.pt'])
+
+    def test_delta_checkpoints_reconstruct(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            writer = DeltaCheckpointWriter(full_every=3, chunk_size=64)
+            checkpointer = AsyncCheckpointer(out_dir, keep_last=2, keep_best=False, writer=writer)
+            w, frozen = torch.randn(100), torch.randn(50).to(torch.bfloat16)
+            expected = {}
+            for step in range(7):
+                w.add_(torch.randn(100) * 1e-3)
+                filepath = checkpointer.save(f'checkpoint_{step}',
+                    {'model': {'w': w, 'frozen': frozen}, 'train/step': step})
+                checkpointer.wait()
+                self.assertEqual(writer.last_is_full, step % 3 == 0)
+                expected[filepath] = w.clone()
+            checkpointer.shutdown()
+
+            self.assertEqual(sorted(f for f in os.listdir(out_dir) if f.endswith('.pt')),
+                             ['checkpoint_5.pt', 'checkpoint_6.pt'])
+            for filepath in [os.path.join(out_dir, f'checkpoint_{step}.pt') for step in [5, 6]]:
+                checkpoint = load_checkpoint(filepath)
+                self.assertTrue(torch.equal(checkpoint['model']['w'], expected[filepath]))
+                self.assertTrue(torch.equal(checkpoint['model']['frozen'], frozen))
+
+            # delta checkpoints 5 and 6 still need chunks of full snapshot 3 which was deleted
+            writer.collect_garbage(out_dir)
+            self.assertTrue(torch.equal(load_checkpoint(filepath)['model']['w'], w))
+
+class TestResume(unittest.TestCase):
+    def test_rng_state_roundtrip(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            filepath = os.path.join(out_dir, 'rng.pt')
+            torch.save(rng_state(), filepath)
+            expected = (random.random(), np.random.rand(), torch.rand(1).item())
+            set_rng_state(torch.load(filepath, weights_only=True))
+            self.assertEqual((random.random(), np.random.rand(), torch.rand(1).item()), expected)
+
+    def test_auto_skips_missing_checkpoint(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            self.assertIsNone(find_resume_checkpoint('auto', out_dir))
+            existing = os.path.join(out_dir, 'checkpoint_1.pt')
+            utils.zero_file(existing)
+            utils.save_yaml([{'checkpoint_filepath': existing},
+                             {'checkpoint_filepath': os.path.join(out_dir, 'checkpoint_2.pt')}],
+                            os.path.join(out_dir, 'checkpoint_log.yaml'))
+            self.assertEqual(find_resume_checkpoint('auto', out_dir), existing)
+            self.assertIsNone(find_resume_checkpoint('', out_dir))
+
+class TestShardedCheckpoint(unittest.TestCase):
+    def _model_optim(self, seed:int):
+        torch.manual_seed(seed)
+        model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+        return model, optimizer
+
+    def test_reshard_to_different_world_size(self):
+        model, optimizer = self._model_optim(0)
+        model(torch.randn(2, 8)).sum().backward()
+        optimizer.step()
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            checkpointer = AsyncCheckpointer(out_dir)
+            # simulate 2 ranks writing their shards
+            for rank in range(2):
+                checkpoint_dir = sharded_checkpoint.save_sharded(checkpointer, 'checkpoint_0',
+                    model, optimizer, rank, 2, common={'train/step': 0},
+                    rank_state={'rank': rank})
+                checkpointer.wait()
+                self.assertEqual(sharded_checkpoint.is_complete(checkpoint_dir), rank == 1)
+            checkpointer.shutdown()
+            self.assertEqual(find_resume_checkpoint('auto', out_dir), None) # no log
+            self.assertEqual(find_resume_checkpoint(checkpoint_dir, out_dir), checkpoint_dir)
+
+            for world_size in [1, 2, 3]:
+                loaded_model, loaded_optimizer = self._model_optim(1)
+                common, rank_state = sharded_checkpoint.load_sharded(checkpoint_dir,
+                    loaded_model, loaded_optimizer, 0, world_size)
+                self.assertEqual(common['train/step'], 0)
+                self.assertEqual(rank_state, {'rank': 0} if world_size == 2 else None)
+                for p, q in zip(model.parameters(), loaded_model.parameters()):
+                    self.assertTrue(torch.equal(p, q))
+                    for k, v in optimizer.state[p].items():
+                        self.assertTrue(torch.equal(v, loaded_optimizer.state[q][k]))
+
+    def test_rewritten_dir_with_mixed_steps_is_incomplete(self):
+        model, optimizer = self._model_optim(0)
+        with tempfile.TemporaryDirectory() as out_dir:
+            checkpointer = AsyncCheckpointer(out_dir, enable_async=False)
+            for step in [0, 1]:
+                # crash after rank 0 rewrote 'best' at step 1 but before rank 1 did
+                for rank in range(2 if step == 0 else 1):
+                    checkpoint_dir = sharded_checkpoint.save_sharded(checkpointer, 'best',
+                        model, optimizer, rank, 2, common={'train/step': step}, rank_state={})
+                self.assertEqual(sharded_checkpoint.is_complete(checkpoint_dir), step == 0)
+            with self.assertRaises(ValueError):
+                sharded_checkpoint.load_sharded(checkpoint_dir, *self._model_optim(1), 0, 2)
+
+    def test_ranks_agree_on_retention(self):
+        # (rank 0, rank 1) val losses, local bests are at different steps but global best is step 1
+        local_val_losses = [(3.0, 3.0), (2.0, 1.5), (1.0, 4.0), (5.0, 5.0)]
+        with tempfile.TemporaryDirectory() as out_dir:
+            run_ranks(_sharded_retention, 2, out_dir, local_val_losses)
+            self.assertEqual(sorted(os.listdir(out_dir)), ['checkpoint_1', 'checkpoint_3'])
+            for name in ['checkpoint_1', 'checkpoint_3']:
+                self.assertTrue(sharded_checkpoint.is_complete(os.path.join(out_dir, name)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from nanugpt import comm_hooks
+from dist_utils import run_ranks
+
+WORLD_SIZE = 2
+STEPS = 3
+POWERSGD_START_ITER = 2
+
+def _model()->torch.nn.Module:
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(64, 64, bias=False), torch.nn.Tanh(), torch.nn.Linear(64, 64, bias=False))
+
+def _grads(rank:int, hook:str, collect_stats:bool):
+    model = DistributedDataParallel(_model())
+    stats = comm_hooks.register_comm_hook(model, hook, powersgd_rank=2,
+                                          powersgd_start_iter=POWERSGD_START_ITER, collect_stats=collect_stats)
+    g = torch.Generator().manual_seed(rank) # different data on each rank
+    grads, comm_bytes = [], []
+    for _ in range(STEPS):
+        model(torch.randn(8, 64, generator=g)).pow(2).mean().backward()
+        grads.append(torch.cat([p.grad.view(-1) for p in model.parameters()]))
+        comm_bytes.append(stats.pop()[0] if stats is not None else None)
+        model.zero_grad(set_to_none=True)
+    return grads, comm_bytes
+
+def _check_hooks(torch_info):
+    rank = torch_info.global_rank
+    n_params = sum(p.numel() for p in _model().parameters())
+
+    # no compression or stats leaves DDP's builtin all-reduce
+    assert comm_hooks.register_comm_hook(DistributedDataParallel(_model()), '') is None
+    expected, _ = _grads(rank, '', collect_stats=False)
+
+    grads, comm_bytes = _grads(rank, '', collect_stats=True)
+    assert all(torch.equal(g, e) for g, e in zip(grads, expected))
+    assert comm_bytes == [n_params * 4] * STEPS
+
+    for hook in ['bf16', 'fp16']:
+        grads, comm_bytes = _grads(rank, hook, collect_stats=True)
+        for g, e in zip(grads, expected):
+            torch.testing.assert_close(g, e, rtol=1e-2, atol=1e-3)
+        assert comm_bytes == [n_params * 2] * STEPS
+
+    grads, comm_bytes = _grads(rank, 'powersgd', collect_stats=True)
+    # plain all-reduce until start iter, then only low rank factors are sent
+    assert all(torch.equal(g, e) for g, e in zip(grads[:POWERSGD_START_ITER], expected))
+    assert comm_bytes[:POWERSGD_START_ITER] == [n_params * 4] * POWERSGD_START_ITER
+    assert comm_bytes[-1] == 2 * (64 + 64) * 2 * 4 # 2 matrices, P and Q of rank 2
+    # replicas stay in sync
+    all_grads = [torch.empty_like(grads[-1]) for _ in range(WORLD_SIZE)]
+    dist.all_gather(all_grads, grads[-1])
+    assert torch.equal(all_grads[0], all_grads[1])
+
+class TestCommHooks(unittest.TestCase):
+    def test_hooks_match_allreduce(self):
+        # checks are done on each rank, failure on any fails spawn
+        run_ranks(_check_hooks, WORLD_SIZE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import unittest
+
+import torch
+
+from nanugpt import utils
+
+class TestCpuThreads(unittest.TestCase):
+    def test_parse_cpu_list(self):
+        self.assertEqual(utils.parse_cpu_list('0-3,8, 10-11'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(utils.parse_cpu_list(''), [])
+
+    def test_setup_cpu_threads_splits_between_local_ranks(self):
+        prev_threads = torch.get_num_threads()
+        prev_affinity = os.sched_getaffinity(0)
+        try:
+            available = sorted(prev_affinity)
+            info = utils.setup_cpu_threads(0, 0, 'auto', local_rank=1, local_world_size=2)
+            per_rank = max(len(available) // 2, 1)
+            self.assertEqual(info['cpu/num_threads'], per_rank)
+            self.assertEqual(torch.get_num_threads(), per_rank)
+            self.assertEqual(sorted(os.sched_getaffinity(0)), available[per_rank % len(available):][:per_rank])
+
+            info = utils.setup_cpu_threads(1, 0, '', local_rank=0, local_world_size=1)
+            self.assertEqual((info['cpu/num_threads'], info['cpu/affinity']), (1, ''))
+        finally:
+            os.sched_setaffinity(0, prev_affinity)
+            torch.set_num_threads(prev_threads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import contextlib
+import unittest
+
+import torch
+
+from nanugpt import flops_report
+from nanugpt.models.nanogpt import get_model
+from nanugpt.losses.autoregressive_loss import get_loss
+
+class TestFlopsReport(unittest.TestCase):
+    def setUp(self):
+        self.model = get_model(n_layer=2, n_embd=32, n_head=2, context_length=16, vocab_size=100)
+        self.x = torch.randint(0, 100, (2, 16))
+
+    def test_units(self):
+        names = [name for name, _ in flops_report.report_units(self.model)]
+        self.assertIn('transformer.h.*.attn', names)
+        self.assertIn('transformer.h.*.mlp', names)
+        self.assertIn('lm_head', names)
+        self.assertEqual(names.count('transformer.h.*.attn'), 2) # one per layer
+
+    def test_report(self):
+        metrics, table = flops_report.module_report(self.model, get_loss, self.x, self.x,
+                                                    contextlib.nullcontext(), peak_flops=1e12, iters=1)
+        self.assertGreater(metrics['flops/step_flops'], 0)
+        # all FLOPs are attributed to units, none to loss or other
+        self.assertAlmostEqual(metrics['flops/transformer.h.*.attn/flops_frac'] +
+                               metrics['flops/transformer.h.*.mlp/flops_frac'] +
+                               metrics['flops/lm_head/flops_frac'], 1.0)
+        self.assertEqual(metrics['flops/other/flops_frac'], 0.0)
+        self.assertGreater(metrics['flops/mfu'], 0.0)
+        self.assertIn('lm_head', table)
+        self.assertTrue(all(p.grad is None for p in self.model.parameters()))
+
+    def test_fused_lm_head_loss(self):
+        model = get_model(n_layer=2, n_embd=32, n_head=2, context_length=16, vocab_size=100,
+                          fused_lm_head_loss=True)
+        metrics, _ = flops_report.module_report(model, get_loss, self.x, self.x,
+                                                contextlib.nullcontext(), peak_flops=1e12, iters=1)
+        # lm_head matmuls for logits, grad of hidden and grad of weight all run in loss
+        self.assertAlmostEqual(metrics['flops/loss/flops_frac'] * metrics['flops/step_flops'], 3 * 2 * 2*16 * 32 * 100)
+        self.assertEqual(metrics['flops/other/flops_frac'], 0.0)
+        self.assertGreater(metrics['flops/loss/efficiency'], 0.0)
+
+    def test_cpu_peak(self):
+        self.assertGreater(flops_report.get_peak_flops(torch.device('cpu'), torch.float32), 0)
+
+if __name__ == '__main__':
+    unittest.main()
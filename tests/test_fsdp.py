@@ -0,0 +1,61 @@
+import unittest
+
+import torch
+
+from nanugpt import fsdp
+from nanugpt.models import nanogpt
+from dist_utils import run_ranks
+
+WORLD_SIZE = 2
+STEPS = 3
+
+def _get_model():
+    return nanogpt.get_model(n_layer=2, n_embd=32, n_head=2, vocab_size=64, context_length=16)
+
+def _data():
+    g = torch.Generator().manual_seed(0)
+    return [torch.randint(0, 64, (4, 16), generator=g) for _ in range(STEPS)]
+
+def _loss(model, x):
+    logits = model(x)
+    return torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)), x.view(-1))
+
+def _train_fsdp(torch_info):
+    rank = torch_info.global_rank
+    torch.manual_seed(rank) # different init on each rank, apply_fsdp must use rank 0's
+    model = fsdp.apply_fsdp(_get_model(), torch_info, param_dtype='', reduce_dtype='',
+                            reshard_after_forward=True, cpu_offload=False)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    for x in _data():
+        # each rank gets its half of the batch
+        _loss(model, x.chunk(WORLD_SIZE)[rank]).backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    model_state, optimizer_state = fsdp.full_state_dicts(model, optimizer)
+    return {'model': model_state, 'optimizer': optimizer_state}
+
+class TestFSDP(unittest.TestCase):
+    def test_matches_single_process(self):
+        fsdp_state = run_ranks(_train_fsdp, WORLD_SIZE)[0] # full state is on rank 0
+
+        torch.manual_seed(0)
+        model = _get_model()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+        for x in _data():
+            _loss(model, x).backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.allclose(v, fsdp_state['model'][k], atol=1e-5), k)
+        # checkpoint uses same index keyed format as regular optimizer
+        optimizer_state = optimizer.state_dict()
+        self.assertEqual(optimizer_state['param_groups'][0]['params'],
+                         fsdp_state['optimizer']['param_groups'][0]['params'])
+        for i, state in optimizer_state['state'].items():
+            self.assertTrue(torch.allclose(state['exp_avg'], fsdp_state['optimizer']['state'][i]['exp_avg'], atol=1e-5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import unittest
+from unittest import mock
+
+import torch
+
+from nanugpt.data import grokking_data
+
+def _first_batch(rank:int):
+    with mock.patch.dict(os.environ, {'RANK': str(rank), 'WORLD_SIZE': '4', 'TENSOR_PARALLEL_SIZE': '2'}):
+        torch.manual_seed(rank) # global RNG differs between ranks
+        train_loader, val_loader, _ = grokking_data.get_data('x/y', 23, 0.5, None, 16, 64, 8, 5)
+        return next(iter(train_loader))[0], val_loader.dataset.indices
+
+class TestGrokkingData(unittest.TestCase):
+    def test_tensor_parallel_ranks_get_same_batches(self):
+        x0, val0 = _first_batch(0)
+        x1, val1 = _first_batch(1) # same tensor parallel group
+        x2, val2 = _first_batch(2) # next data parallel rank
+        self.assertTrue(torch.equal(x0, x1))
+        self.assertFalse(torch.equal(x0, x2))
+        self.assertEqual(val0, val1)
+        self.assertEqual(val0, val2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+import unittest
+
+# packages that take long to import and are needed only with some configs
+HEAVY_MODULES = ['wandb', 'sklearn', 'scipy', 'pandas', 'matplotlib', 'requests', 'rich',
+                 'torch.distributed.fsdp', 'torch.distributed.pipelining', 'torch.utils.flop_counter']
+
+class TestImportTime(unittest.TestCase):
+    def test_train_import_is_light(self):
+        # fresh process so modules imported by other tests don't count
+        code = ('import sys, torch, nanugpt.train, nanugpt.glogging\n'
+                f'print([m for m in {HEAVY_MODULES!r} if m in sys.modules])\n'
+                'print(torch.cuda.is_initialized())\n')
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True).stdout.splitlines()
+        self.assertEqual(out[-2], '[]')
+        self.assertEqual(out[-1], 'False') # importing must not init CUDA
+
+    def test_lazy_modules_load(self):
+        from nanugpt import train
+        self.assertTrue(callable(train.fsdp.apply_fsdp))
+        self.assertTrue(callable(train.pipeline_parallel.split_model))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import torch
+import torch.distributed as dist
+
+from nanugpt import local_sgd
+from nanugpt.losses import autoregressive_loss
+from nanugpt.models import nanogpt
+from dist_utils import run_ranks
+
+WORLD_SIZE = 2
+STEPS = 4
+
+def _get_model():
+    return nanogpt.get_model(n_layer=2, n_embd=32, n_head=2, vocab_size=64, context_length=16)
+
+def _data():
+    g = torch.Generator().manual_seed(0)
+    batches = [torch.randint(0, 64, (8, 17), generator=g) for _ in range(STEPS)]
+    return [(b[:, :-1].contiguous(), b[:, 1:].contiguous()) for b in batches]
+
+def _train(torch_info, sync_every:int, outer_momentum:float):
+    rank = torch_info.global_rank
+    torch.manual_seed(rank) # different init on each rank, LocalSGD must use rank 0's
+    model = _get_model()
+    mesh = local_sgd.init_mesh(torch_info, 1)
+    syncer = local_sgd.LocalSGD(model, mesh['outer'], sync_every, outer_momentum=outer_momentum)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    for step, (x, y) in enumerate(_data()):
+        loss, _, _ = autoregressive_loss.get_loss(model(x.chunk(WORLD_SIZE)[rank]), y.chunk(WORLD_SIZE)[rank])
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        syncer.step(step)
+    # all replicas are same after sync
+    params = torch.cat([p.detach().view(-1) for p in model.parameters()])
+    all_params = [torch.empty_like(params) for _ in range(WORLD_SIZE)]
+    dist.all_gather(all_params, params)
+    assert all(torch.equal(all_params[0], p) for p in all_params)
+    return syncer.model_state_dict(model)
+
+def _spawn(sync_every:int, outer_momentum:float):
+    return run_ranks(_train, WORLD_SIZE, sync_every, outer_momentum)[0]
+
+class TestLocalSGD(unittest.TestCase):
+    def test_sync_every_step_matches_single_process(self):
+        # averaging params after SGD step is same as averaging grads
+        state = _spawn(sync_every=1, outer_momentum=0.0)
+
+        torch.manual_seed(0)
+        model = _get_model()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        for x, y in _data():
+            loss, _, _ = autoregressive_loss.get_loss(model(x), y)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.allclose(v, state[k], atol=1e-5), k)
+
+    def test_nesterov_outer_step(self):
+        # replicas are checked to be same after sync in _train
+        state = _spawn(sync_every=2, outer_momentum=0.9)
+        self.assertTrue(all(torch.isfinite(v).all() for v in state.values()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import unittest
 from unittest.mock import MagicMock
 import numpy as np
 import torch
-from nanugpt.data.tokenized_data import MemmapDataset, MemmapDataloader
+from nanugpt.data.tokenized_data import MemmapDataset, MemmapDataloader, shard_offset
 
 class TestMemmapDataloader(unittest.TestCase):
     def setUp(self):
@@ -93,3 +93,45 @@ class TestMemmapDataloader(unittest.TestCase):
                                                         [5, 6, 7]]))
 
 
+
+    def test_seek(self):
+        self.mock_dataset.token_count.return_value = len(self.mock_data)
+        dataloader = MemmapDataloader(self.mock_dataset, batch_size=2, seed=42, shuffle=False)
+        next(dataloader)
+        expected = next(dataloader)
+
+        # seeking to tokens read by first batch gives the second batch
+        dataloader = MemmapDataloader(self.mock_dataset, batch_size=2, seed=42, shuffle=False)
+        self.assertEqual(dataloader.seek(6), 0)
+        self.assertTrue(np.array_equal(next(dataloader)[0], expected[0]))
+        self.assertEqual(dataloader.tokens_read, 12)
+
+    def test_shards(self):
+        self.mock_dataset.token_count.return_value = len(self.mock_data)
+        # each of 2 ranks starts in its own half and an epoch is one shard
+        offsets = [shard_offset(self.mock_dataset, rank, 2) for rank in range(2)]
+        self.assertEqual(offsets, [0, 5])
+        loaders = [MemmapDataloader(self.mock_dataset, batch_size=1, seed=42, shuffle=False,
+                                    start_seq_index=offset, num_shards=2) for offset in offsets]
+        self.assertEqual([len(loader) for loader in loaders], [2, 2])
+        self.assertTrue(np.array_equal(next(loaders[0])[0], [[0, 1, 2]]))
+        self.assertTrue(np.array_equal(next(loaders[1])[0], [[5, 6, 7]]))
+
+    def test_reread_after_reshard(self):
+        self.mock_dataset.token_count.return_value = len(self.mock_data)
+        # 2 old ranks read [0, 3) and [5, 8), 1 new rank continues at 6 so it reads 6, 7 again
+        loader = MemmapDataloader(self.mock_dataset, batch_size=1, seed=42, shuffle=False, num_shards=1)
+        loader.seek(3 * 2 // 1)
+        self.assertEqual(loader.reread_after_reshard(2, 3), 2)
+        # 1 old rank read [0, 4), new ranks continue at 2 and 7
+        rereads = []
+        for rank in range(2):
+            loader = MemmapDataloader(self.mock_dataset, batch_size=1, seed=42, shuffle=False,
+                                      start_seq_index=shard_offset(self.mock_dataset, rank, 2), num_shards=2)
+            loader.seek(4 * 1 // 2)
+            rereads.append(loader.reread_after_reshard(1, 4))
+        self.assertEqual(rereads, [2, 0])
+        # same world size, nothing is read again
+        loader = MemmapDataloader(self.mock_dataset, batch_size=1, seed=42, shuffle=False, num_shards=1)
+        loader.seek(4)
+        self.assertEqual(loader.reread_after_reshard(1, 4), 0)
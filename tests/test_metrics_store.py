@@ -0,0 +1,107 @@
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from nanugpt import metrics_store
+from nanugpt.metrics_store import MetricsStore
+from logger_utils import scoped_logger
+
+class TestMetricsStore(unittest.TestCase):
+    def test_append_and_load(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = MetricsStore(store_dir, flush_every=2)
+            store.append({'train/step': 0, 'train/loss': torch.tensor(2.0), 'path': 'skipped'})
+            store.append({'train/step': 1, 'train/loss': np.float32(1.5), 'val/loss': 1.75})
+            store.append({'train/step': 2, 'train/loss': 1.25})
+            # first 2 rows are on disk before close, like after a crash
+            self.assertEqual(len(metrics_store.load_run(store_dir)), 2)
+            store.close()
+
+            df = metrics_store.load_run(store_dir)
+            self.assertEqual(df['train/step'].tolist(), [0, 1, 2])
+            self.assertEqual(df['train/loss'].tolist(), [2.0, 1.5, 1.25])
+            self.assertTrue(math.isnan(df['val/loss'][2]))
+            self.assertNotIn('path', df.columns)
+            self.assertIn(metrics_store.TIME_COLUMN, df.columns)
+
+    def test_restart(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = MetricsStore(store_dir)
+            for step in range(3):
+                store.append({'train/step': step, 'train/loss': 1.0})
+            store.close()
+            # resume from checkpoint at step 1 repeats step 2
+            store = MetricsStore(store_dir)
+            store.resume(2)
+            for step in range(2, 4):
+                store.append({'train/step': step, 'train/loss': 2.0, 'new': 1})
+            store.close()
+
+            df = metrics_store.load_run(store_dir, columns=['train/step', 'train/loss', 'new'])
+            self.assertEqual(df['train/step'].tolist(), [0, 1, 2, 3])
+            self.assertEqual(df['train/loss'].tolist(), [1.0, 1.0, 2.0, 2.0])
+            # rows of previous run from resume step on are removed, not just hidden by dedupe
+            self.assertEqual(len(metrics_store.load_run(store_dir, dedupe_column=None)), 4)
+
+    def test_resume_truncates_across_chunks(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = MetricsStore(store_dir, flush_every=2)
+            for step in range(6):
+                store.append({'train/step': step, 'train/loss': 1.0})
+            store.close()
+            store = MetricsStore(store_dir, flush_every=2)
+            store.resume(3)
+            for step in range(3, 5):
+                store.append({'train/step': step, 'train/loss': 2.0})
+            store.close()
+            self.assertEqual(len(metrics_store._chunk_paths(store_dir)), 3)
+            df = metrics_store.load_run(store_dir, dedupe_column=None)
+            self.assertEqual(df['train/step'].tolist(), [0, 1, 2, 3, 4])
+            self.assertEqual(df['train/loss'].tolist(), [1.0, 1.0, 1.0, 2.0, 2.0])
+
+    def test_new_run_replaces_store(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = MetricsStore(store_dir)
+            for step in range(5):
+                store.append({'train/step': step, 'old': 1.0})
+            store.close()
+            # not resumed, e.g., new run with fewer steps in same log dir
+            store = MetricsStore(store_dir)
+            store.close()
+            self.assertEqual(len(metrics_store.load_run(store_dir)), 5) # untouched until something is written
+            store = MetricsStore(store_dir)
+            for step in range(2):
+                store.append({'train/step': step, 'train/loss': 2.0})
+            store.close()
+            df = metrics_store.load_run(store_dir)
+            self.assertEqual(df['train/step'].tolist(), [0, 1])
+            self.assertNotIn('old', df.columns)
+
+    def test_logger_stores_only_step_metrics(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            with scoped_logger(log_dir=log_dir, metrics_dirname='metrics') as logger:
+                logger.info({'step': 10, 'run/checkpoint_since_hr': 1.0})
+                logger.info('not a metric')
+                logger.resume_metrics(1)
+                logger.info({'train/step': 1, 'train/loss': 1.0})
+            df = metrics_store.load_run(os.path.join(log_dir, 'metrics'))
+            self.assertEqual(df['train/step'].tolist(), [1])
+            self.assertNotIn('run/checkpoint_since_hr', df.columns)
+
+    def test_load_runs(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            store_dirs = []
+            for run in ['run_a', 'run_b']:
+                store_dirs.append(os.path.join(out_dir, run, 'metrics'))
+                store = MetricsStore(store_dirs[-1])
+                store.append({'train/step': 0, 'train/loss': 1.0})
+                store.close()
+            df = metrics_store.load_runs(store_dirs, columns=['train/loss'])
+            self.assertEqual(df['run'].tolist(), ['run_a', 'run_b'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import copy
+import unittest
+
+import torch
+
+from nanugpt.optimizer_in_backward import OptimizerInBackward
+
+def _model()->torch.nn.Module:
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.GELU(), torch.nn.Linear(16, 4))
+
+def _optimizer(model:torch.nn.Module)->torch.optim.Optimizer:
+    decay = [p for p in model.parameters() if p.dim() >= 2]
+    no_decay = [p for p in model.parameters() if p.dim() < 2]
+    return torch.optim.AdamW([{'params': decay, 'weight_decay': 0.1},
+                              {'params': no_decay, 'weight_decay': 0.0}], lr=1e-2)
+
+class TestOptimizerInBackward(unittest.TestCase):
+    def test_matches_optimizer_step_with_grad_acc(self):
+        model = _model()
+        model_ref = copy.deepcopy(model)
+        optimizer, optimizer_ref = _optimizer(model), _optimizer(model_ref)
+        opt_in_bwd = OptimizerInBackward(model, optimizer, grad_clip=0.0, use_ddp=False)
+
+        for step in range(3):
+            for g in optimizer.param_groups + optimizer_ref.param_groups:
+                g['lr'] = 1e-2 / (step + 1) # as scheduler would
+            for micro_step in range(2):
+                x = torch.randn(5, 8)
+                opt_in_bwd.last_micro_step = micro_step == 1
+                model(x).pow(2).sum().backward()
+                model_ref(x).pow(2).sum().backward()
+            pre_clip_norm = opt_in_bwd.finish()
+            expected_norm = torch.linalg.vector_norm(torch.cat([p.grad.view(-1) for p in model_ref.parameters()]))
+            torch.testing.assert_close(pre_clip_norm, expected_norm)
+            optimizer_ref.step()
+            optimizer_ref.zero_grad(set_to_none=True)
+
+            # grads are freed as soon as param is updated
+            self.assertTrue(all(p.grad is None for p in model.parameters()))
+            for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+                torch.testing.assert_close(p, p_ref)
+
+        # state of regular optimizer is updated so checkpoints work as usual
+        torch.testing.assert_close(optimizer.state_dict()['state'][0]['exp_avg'],
+                                   optimizer_ref.state_dict()['state'][0]['exp_avg'])
+
+    def test_clip_uses_previous_step_norm(self):
+        model = _model()
+        optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+        opt_in_bwd = OptimizerInBackward(model, optimizer, grad_clip=0.5, use_ddp=False)
+        x = torch.randn(5, 8)
+
+        # first step isn't clipped
+        before = [p.detach().clone() for p in model.parameters()]
+        model(x).pow(2).sum().backward()
+        first_norm = opt_in_bwd.finish()
+        update_norm = torch.linalg.vector_norm(torch.cat([(b - p).view(-1) for b, p in zip(before, model.parameters())]))
+        torch.testing.assert_close(update_norm, first_norm)
+
+        # second step is scaled by 0.5/first_norm
+        before = [p.detach().clone() for p in model.parameters()]
+        model(x).pow(2).sum().backward()
+        second_norm = opt_in_bwd.finish()
+        update_norm = torch.linalg.vector_norm(torch.cat([(b - p).view(-1) for b, p in zip(before, model.parameters())]))
+        torch.testing.assert_close(update_norm, second_norm * 0.5 / (first_norm + 1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
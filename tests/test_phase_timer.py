@@ -0,0 +1,38 @@
+import time
+import unittest
+
+from nanugpt.phase_timer import PhaseTimer, reduce_report
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_nested_scopes(self):
+        timer = PhaseTimer()
+        for _ in range(2):
+            timer.start('step')
+            with timer.scope('forward'):
+                time.sleep(0.01)
+            with timer.scope('forward'):
+                pass
+            timer.stop()
+        # open step isn't reported
+        timer.start('step')
+        with timer.scope('forward'):
+            pass
+
+        totals, count = timer.pop_report()
+        self.assertEqual(count, 2)
+        self.assertEqual(set(totals.keys()), {'step', 'step/forward'})
+        self.assertGreaterEqual(totals['step/forward'], 0.02)
+        self.assertGreaterEqual(totals['step'], totals['step/forward'])
+
+        # rest of open step is reported next time
+        timer.stop()
+        totals, count = timer.pop_report()
+        self.assertEqual(count, 1)
+        self.assertLess(totals['step/forward'], 0.01)
+
+    def test_reduce_report(self):
+        report = reduce_report({'step': 1.0, 'step/data': 0.5}, 2, is_distributed=False)
+        self.assertEqual(report, {'phase/step': 0.5, 'phase/step/data': 0.25})
+
+if __name__ == '__main__':
+    unittest.main()
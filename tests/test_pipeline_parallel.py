@@ -0,0 +1,100 @@
+import unittest
+
+import torch
+import torch.distributed as dist
+
+from nanugpt import utils
+from nanugpt import pipeline_parallel
+from nanugpt.losses import autoregressive_loss
+from nanugpt.models import nanogpt
+from dist_utils import run_ranks
+
+WORLD_SIZE = 4
+PP_SIZE = 2
+MICRO_BATCHES = 2
+STEPS = 3
+
+def _get_model():
+    return nanogpt.get_model(n_layer=3, n_embd=32, n_head=2, vocab_size=64, context_length=16)
+
+def _data():
+    g = torch.Generator().manual_seed(0)
+    batches = [torch.randint(0, 64, (8, 17), generator=g) for _ in range(STEPS)]
+    return [(b[:, :-1].contiguous(), b[:, 1:].contiguous()) for b in batches]
+
+def _train_pp(torch_info):
+    rank = torch_info.global_rank
+    torch.manual_seed(rank) # different init on each rank, split_model must use rank 0's
+    mesh = pipeline_parallel.init_mesh(torch_info, PP_SIZE)
+    model = pipeline_parallel.split_model(_get_model(), mesh['pp'])
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    pipeline = pipeline_parallel.Pipeline(model, mesh, torch.device('cpu'), MICRO_BATCHES,
+                                          autoregressive_loss.get_loss)
+    dp_rank = mesh['dp'].get_local_rank()
+    train_losses = []
+    for x, y in _data():
+        # each pipeline gets its half of the batch
+        x, y = x.chunk(WORLD_SIZE // PP_SIZE)[dp_rank], y.chunk(WORLD_SIZE // PP_SIZE)[dp_rank]
+        train_losses.append(pipeline.step(x, y))
+        utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    model_state, optimizer_state = pipeline_parallel.full_state_dicts(model, optimizer, mesh)
+    w_norm = utils.weight_norm(model) # collective
+    eval_loss = pipeline.eval(x, y)
+    result = {'model': model_state, 'optimizer': optimizer_state, 'w_norm': w_norm,
+              'eval': eval_loss, 'train': train_losses}
+
+    # loading full state back gives same stage params
+    full_state = [model_state, optimizer_state]
+    dist.broadcast_object_list(full_state, src=0)
+    params = [p.detach().clone() for p in model.parameters()]
+    pipeline_parallel.load_full_state_dicts(model, optimizer, full_state[0], full_state[1], mesh)
+    assert all(torch.equal(s, p) for s, p in zip(params, model.parameters()))
+    return result
+
+class TestPipelineParallel(unittest.TestCase):
+    def test_stage_layers(self):
+        layers = [pipeline_parallel.stage_layers(7, 3, i) for i in range(3)]
+        self.assertEqual([list(l) for l in layers], [[0, 1, 2], [3, 4], [5, 6]])
+
+    def test_matches_single_process(self):
+        results = run_ranks(_train_pp, WORLD_SIZE)
+        # full state is gathered on rank 0, last stage of first pipeline has the loss
+        pp_state, pp_losses = results[0], results[PP_SIZE - 1]
+
+        torch.manual_seed(0)
+        model = _get_model()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+        for (x, y), pp_train_loss in zip(_data(), pp_losses['train']):
+            with torch.no_grad():
+                # train loss of first pipeline
+                x0, y0 = x.chunk(WORLD_SIZE // PP_SIZE)[0], y.chunk(WORLD_SIZE // PP_SIZE)[0]
+                loss, correct, n_preds = autoregressive_loss.get_loss(model(x0), y0)
+            self.assertAlmostEqual(loss.item() * len(x0), pp_train_loss[0], places=4)
+            self.assertEqual((correct.item(), n_preds), pp_train_loss[1:])
+            loss, _, _ = autoregressive_loss.get_loss(model(x), y)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for k, v in model.state_dict().items():
+            # micro-batches change summation order so allow a bit more than float error
+            self.assertTrue(torch.allclose(v, pp_state['model'][k], atol=1e-4), k)
+        # checkpoint uses same index keyed format as regular optimizer
+        optimizer_state = optimizer.state_dict()
+        self.assertEqual(optimizer_state['param_groups'], pp_state['optimizer']['param_groups'])
+        for i, state in optimizer_state['state'].items():
+            self.assertTrue(torch.allclose(state['exp_avg'], pp_state['optimizer']['state'][i]['exp_avg'], atol=1e-4))
+        self.assertAlmostEqual(utils.weight_norm(model), pp_state['w_norm'], places=4)
+
+        with torch.no_grad():
+            # eval batch of first pipeline
+            x, y = (t.chunk(WORLD_SIZE // PP_SIZE)[0] for t in _data()[-1])
+            loss, correct, n_preds = autoregressive_loss.get_loss(model(x), y)
+        self.assertAlmostEqual(loss.item() * len(x), pp_losses['eval'][0], places=4)
+        self.assertEqual((correct.item(), n_preds), pp_losses['eval'][1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import signal
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import psutil
+
+from nanugpt import preemption
+
+class TestPreemption(unittest.TestCase):
+    def test_signal(self):
+        prev_handler = signal.getsignal(signal.SIGUSR1)
+        preempt = preemption.create_preemption('SIGTERM, SIGUSR1', 0.0, 300)
+        self.assertIsNotNone(preempt)
+        self.assertFalse(preempt.requested())
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(preempt.requested())
+        self.assertEqual(preempt.reason, 'SIGUSR1')
+        preempt.close()
+        self.assertIs(signal.getsignal(signal.SIGUSR1), prev_handler)
+
+    def test_walltime(self):
+        preempt = preemption.create_preemption('', 1.0, 300)
+        self.assertFalse(preempt.requested())
+        preempt.deadline = time.time() + 100 # within margin
+        self.assertTrue(preempt.requested())
+        self.assertEqual(preempt.reason, 'walltime')
+
+    def test_slurm_deadline(self):
+        with mock.patch.dict(os.environ, {'SLURM_JOB_END_TIME': '1000'}):
+            self.assertEqual(preemption.get_deadline(1.0), 1000.0)
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(preemption.get_deadline(0.0))
+            self.assertIsNone(preemption.create_preemption('', 0.0, 300))
+
+    def test_walltime_from_torchrun_start(self):
+        # restarted workers must not get a fresh walltime
+        with mock.patch.dict(os.environ, {'TORCHELASTIC_RESTART_COUNT': '1'}):
+            os.environ.pop('SLURM_JOB_END_TIME', None)
+            self.assertEqual(preemption.get_deadline(1.0), psutil.Process(os.getppid()).create_time() + 3600)
+
+    def test_mark_requeue(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            requeue_filepath = os.path.join(tmp_dir, 'requeue')
+            with mock.patch.dict(os.environ, {'NANUGPT_REQUEUE_FILE': requeue_filepath}):
+                preemption.mark_requeue()
+            self.assertTrue(os.path.exists(requeue_filepath))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+from nanugpt import profiling
+
+# global logger is not initialized in tests
+@mock.patch.object(profiling.logging, 'info', lambda *args, **kwargs: None)
+class TestProfiling(unittest.TestCase):
+    def _run(self, prof:profiling.Profiler, steps:int, start_step:int=0):
+        x = torch.randn(16, 16)
+        for step in range(start_step, start_step + steps):
+            x = torch.tanh(x @ x)
+            prof.step(step)
+
+    def test_schedule(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            config = {'enabled': True, 'wait': 1, 'warmup': 1, 'active': 2, 'repeat': 2,
+                      'activities': 'cpu,cuda', 'top_k': 5, 'trigger_signal': ''}
+            prof = profiling.Profiler(config, out_dir, 0, is_cuda=False)
+            self._run(prof, 10)
+            self.assertIsNone(prof.prof) # stopped after 2 windows
+            files = sorted(os.listdir(os.path.join(out_dir, 'profile')))
+            self.assertEqual([f for f in files if f.endswith('.txt')],
+                             ['rank0_step3_top5.txt', 'rank0_step7_top5.txt'])
+            self.assertEqual(len([f for f in files if f.endswith('.pt.trace.json')]), 2)
+            prof.close()
+
+    def test_triggers(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            prev_handler = signal.getsignal(signal.SIGUSR2)
+            config = {'warmup': 1, 'active': 1, 'activities': 'cpu',
+                      'trigger_file': 'profile_now', 'trigger_signal': 'SIGUSR2'}
+            prof = profiling.Profiler(config, out_dir, 1, is_cuda=False)
+            self._run(prof, 3)
+            self.assertFalse(os.path.exists(os.path.join(out_dir, 'profile')))
+
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self._run(prof, 4, start_step=3)
+            open(os.path.join(out_dir, 'profile_now'), 'w').close()
+            self._run(prof, 4, start_step=7)
+            prof.close()
+            self.assertIs(signal.getsignal(signal.SIGUSR2), prev_handler)
+
+            files = sorted(f for f in os.listdir(os.path.join(out_dir, 'profile')) if f.endswith('.txt'))
+            self.assertEqual(files, ['rank1_step5_top30.txt', 'rank1_step9_top30.txt'])
+
+    def test_out_dir_is_expanded(self):
+        with tempfile.TemporaryDirectory() as home:
+            config = {'warmup': 1, 'active': 1, 'activities': 'cpu', 'trigger_file': 'profile_now'}
+            with mock.patch.dict(os.environ, {'HOME': home, 'RUN_NAME': 'run1'}):
+                prof = profiling.Profiler(config, '~/out/$RUN_NAME', 1, is_cuda=False)
+            out_dir = os.path.join(os.path.realpath(home), 'out', 'run1')
+            self.assertEqual(prof.out_dir, os.path.join(out_dir, 'profile'))
+            self.assertEqual(prof.trigger_filepath, os.path.join(out_dir, 'profile_now'))
+            os.makedirs(out_dir)
+            open(os.path.join(out_dir, 'profile_now'), 'w').close()
+            self._run(prof, 3)
+            prof.close()
+            self.assertEqual([f for f in os.listdir(prof.out_dir) if f.endswith('.txt')], ['rank1_step2_top30.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
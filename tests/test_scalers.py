@@ -0,0 +1,38 @@
+import unittest
+
+import torch
+
+from nanugpt import utils
+from nanugpt.scalers.amp_grad_scaler import AmpGradScaler
+from nanugpt.scalers.keller_scaler import KellerScaler
+
+def _torch_info()->utils.TorchInfo:
+    return utils.TorchInfo(is_cuda=False, is_distributed=False, device_type='cpu', dtype='float32',
+                           device_id=-1, device_name='cpu', global_rank=0, local_rank=0, world_size=1,
+                           is_master=True, seed_offset=0, pt_dtype=torch.float32)
+
+def _model_with_grads()->torch.nn.Module:
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.GELU(), torch.nn.Linear(16, 4))
+    model(torch.randn(5, 8)).pow(2).sum().backward()
+    return model
+
+class TestScalers(unittest.TestCase):
+    def test_keller_scaler_normalizes_each_grad(self):
+        model = _model_with_grads()
+        expected = [1.5 * p.grad / (p.grad.norm() + 1e-6) for p in model.parameters()]
+        self.assertEqual(KellerScaler(_torch_info()).clip(model, None, 1.5), -1.0)
+        for p, e in zip(model.parameters(), expected):
+            torch.testing.assert_close(p.grad, e)
+
+    def test_amp_grad_scaler_returns_norm_tensor(self):
+        model = _model_with_grads()
+        expected_norm = torch.linalg.vector_norm(torch.cat([p.grad.view(-1) for p in model.parameters()]))
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        pre_clip_norm = AmpGradScaler(_torch_info()).clip(model, optimizer, 0.5)
+        self.assertIsInstance(pre_clip_norm, torch.Tensor)
+        torch.testing.assert_close(pre_clip_norm, expected_norm)
+        torch.testing.assert_close(utils.distributed_norm(model.parameters(), use_grad=True), torch.tensor(0.5), rtol=1e-4, atol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from nanugpt import straggler
+from dist_utils import run_ranks
+
+WORLD_SIZE = 3
+
+def _gather(torch_info):
+    rank = torch_info.global_rank
+    rank_times = straggler.RankTimes(['step', 'fwd'], 'fwd', torch_info, 'cpu', report_every=4)
+    results = []
+    for i in range(4):
+        # rank 2 is slow in 3 out of 4 steps, rank 1 in only one
+        fwd = 2.0 if (rank == 2 and i > 0) or (rank == 1 and i == 0) else 1.0
+        results.append((rank_times.gather([1.0 + rank, fwd]), rank_times.report()))
+    return results
+
+class TestStraggler(unittest.TestCase):
+    def test_rank_times(self):
+        results = run_ranks(_gather, WORLD_SIZE)[0] # rank 0 reports
+
+        metrics, report = results[0]
+        self.assertEqual((metrics['step_min'], metrics['step_max'], metrics['step_max_rank']), (1.0, 3.0, 2))
+        self.assertEqual(metrics['fwd_max_rank'], 1)
+        self.assertEqual(report, [])
+        # only consistently slow rank is reported
+        _, report = results[-1]
+        self.assertEqual(len(report), 2)
+        self.assertTrue(report[0].startswith('rank 2 on '), report[0])
+        self.assertTrue(report[1].startswith('slow hosts: '), report[1])
+
+if __name__ == '__main__':
+    unittest.main()
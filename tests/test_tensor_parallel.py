@@ -0,0 +1,78 @@
+import unittest
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from nanugpt import utils
+from nanugpt import tensor_parallel
+from nanugpt.models import nanogpt
+from dist_utils import run_ranks
+
+WORLD_SIZE = 4
+TP_SIZE = 2
+STEPS = 3
+
+def _get_model():
+    return nanogpt.get_model(n_layer=2, n_embd=32, n_head=4, vocab_size=64, context_length=16,
+                             mlp_bias=True, attn_proj_bias=True)
+
+def _data():
+    g = torch.Generator().manual_seed(0)
+    return [torch.randint(0, 64, (4, 16), generator=g) for _ in range(STEPS)]
+
+def _loss(model, x):
+    logits = model(x)
+    return torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)), x.view(-1))
+
+def _train_tp(torch_info):
+    rank = torch_info.global_rank
+    torch.manual_seed(rank) # different init on each rank, apply_tensor_parallel must use rank 0's
+    mesh = tensor_parallel.init_mesh(torch_info, TP_SIZE)
+    model = tensor_parallel.apply_tensor_parallel(_get_model(), mesh['tp'])
+    model = DistributedDataParallel(model, process_group=mesh['dp'].get_group())
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    dp_rank = mesh['dp'].get_local_rank()
+    for x in _data():
+        # each TP group gets its half of the batch
+        _loss(model, x.chunk(WORLD_SIZE // TP_SIZE)[dp_rank]).backward()
+        utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    model_state, optimizer_state = tensor_parallel.full_state_dicts(model.module, optimizer)
+    w_norm = utils.weight_norm(model) # collective
+
+    # loading full state back gives same shards
+    shards = [p.detach().clone() for p in model.parameters()]
+    tensor_parallel.load_full_state_dicts(model.module, optimizer, model_state, optimizer_state)
+    assert all(torch.equal(s, p) for s, p in zip(shards, model.parameters()))
+    return {'model': model_state, 'optimizer': optimizer_state, 'w_norm': w_norm}
+
+class TestTensorParallel(unittest.TestCase):
+    def test_shard_roundtrip(self):
+        t = torch.arange(24).view(6, 4)
+        spec = tensor_parallel.ShardSpec(dim=0, parts=3)
+        shards = [tensor_parallel.shard_tensor(t, spec, r, 2) for r in range(2)]
+        # rank 0 gets first half of each part
+        self.assertTrue(torch.equal(shards[0], t[[0, 2, 4]]))
+        self.assertTrue(torch.equal(tensor_parallel.unshard_tensor(shards, spec), t))
+
+    def test_matches_single_process(self):
+        tp_state = run_ranks(_train_tp, WORLD_SIZE)[0]
+
+        torch.manual_seed(0)
+        model = _get_model()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+        for x in _data():
+            _loss(model, x).backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.allclose(v, tp_state['model'][k], atol=1e-5), k)
+        for i, state in optimizer.state_dict()['state'].items():
+            self.assertTrue(torch.allclose(state['exp_avg'], tp_state['optimizer']['state'][i]['exp_avg'], atol=1e-5))
+        self.assertAlmostEqual(utils.weight_norm(model), tp_state['w_norm'], places=4)
+
+if __name__ == '__main__':
+    unittest.main()
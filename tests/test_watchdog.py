@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from nanugpt import watchdog
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# trains for a few steps with an all-reduce per step, rank 0 writes restart count at the end
+RANK_SCRIPT = textwrap.dedent('''
+    import sys
+    import torch
+    import torch.distributed as dist
+    from nanugpt import utils, watchdog
+
+    utils.init_process_group('gloo')
+    wd = watchdog.create_watchdog(2.0)
+    inject_fault = watchdog.create_fault_injector()
+    for step in range(4):
+        wd.beat(f'step {step}')
+        if inject_fault is not None:
+            inject_fault(step)
+        dist.all_reduce(torch.ones(1))
+    wd.stop()
+    if dist.get_rank() == 0:
+        with open(sys.argv[1], 'w') as f:
+            f.write(str(utils.get_restart_count()))
+    dist.destroy_process_group()
+''')
+
+def _run_python(code:str, **env)->subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, '-c', textwrap.dedent(code)], cwd=REPO_ROOT, timeout=60,
+                          env={**os.environ, 'PYTHONPATH': REPO_ROOT, **env}, capture_output=True, text=True)
+
+class TestWatchdog(unittest.TestCase):
+    def test_fires_without_beat(self):
+        result = _run_python('''
+            import time
+            from nanugpt import watchdog
+            wd = watchdog.Watchdog(0.5)
+            wd.beat('stuck here')
+            time.sleep(30)
+        ''')
+        self.assertEqual(result.returncode, watchdog.WATCHDOG_EXIT_CODE)
+        self.assertIn('stuck here', result.stdout + result.stderr)
+
+    def test_beat_keeps_alive(self):
+        result = _run_python('''
+            import time
+            from nanugpt import watchdog
+            wd = watchdog.Watchdog(0.5)
+            for i in range(20):
+                wd.beat(f'step {i}')
+                time.sleep(0.1)
+            wd.stop()
+        ''')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_long_eval_keeps_alive(self):
+        # eval of many batches takes longer than timeout but each batch is quick
+        result = _run_python('''
+            import time
+            import torch
+            from nanugpt import utils, watchdog
+            from nanugpt.train import estimate_loss
+            def slow_loader():
+                for _ in range(20):
+                    time.sleep(0.1)
+                    yield torch.ones(1, 1), torch.zeros(1)
+            torch_info = utils.TorchInfo(is_cuda=False, is_distributed=False, device_type='cpu', dtype='float32',
+                                         device_name='cpu', global_rank=0, local_rank=0, world_size=1,
+                                         is_master=True, seed_offset=0, pt_dtype=torch.float32, device_id=-1)
+            wd = watchdog.Watchdog(0.5)
+            estimate_loss(torch.nn.Identity(), lambda out, y: (out.mean(), torch.tensor(0), 1),
+                          slow_loader(), 20, None, torch_info, 'cpu', wd=wd)
+            wd.stop()
+        ''')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_fault_injector(self):
+        with mock.patch.dict(os.environ, {'RANK': '0', 'TORCHELASTIC_RESTART_COUNT': '0'}):
+            os.environ.pop('NANUGPT_INJECT_FAULT', None)
+            self.assertIsNone(watchdog.create_fault_injector())
+            os.environ['NANUGPT_INJECT_FAULT'] = 'kill:1:3'
+            self.assertIsNone(watchdog.create_fault_injector()) # other rank
+            os.environ['NANUGPT_INJECT_FAULT'] = 'kill:0:3'
+            os.environ['TORCHELASTIC_RESTART_COUNT'] = '1'
+            self.assertIsNone(watchdog.create_fault_injector()) # only first attempt
+            os.environ['TORCHELASTIC_RESTART_COUNT'] = '0'
+            inject_fault = watchdog.create_fault_injector()
+            self.assertIsNotNone(inject_fault)
+            inject_fault(2) # not the step
+            os.environ['NANUGPT_INJECT_FAULT'] = 'crash:0:3'
+            with self.assertRaises(ValueError):
+                watchdog.create_fault_injector()
+
+    def test_torchrun_restarts_after_fault(self):
+        for fault in ['kill', 'hang']:
+            with self.subTest(fault=fault), tempfile.TemporaryDirectory() as tmp_dir:
+                script, out_filepath = os.path.join(tmp_dir, 'rank.py'), os.path.join(tmp_dir, 'restarts.txt')
+                with open(script, 'w') as f:
+                    f.write(RANK_SCRIPT)
+                # hang of rank 1 blocks rank 0 in all-reduce, watchdogs of both must fire
+                result = subprocess.run([sys.executable, '-m', 'torch.distributed.run', '--standalone',
+                                         '--nproc_per_node=2', '--max-restarts=1', script, out_filepath],
+                                        cwd=REPO_ROOT, timeout=120, capture_output=True, text=True,
+                                        env={**os.environ, 'PYTHONPATH': REPO_ROOT,
+                                             'NANUGPT_INJECT_FAULT': f'{fault}:1:2'})
+                self.assertEqual(result.returncode, 0, result.stderr)
+                with open(out_filepath) as f:
+                    self.assertEqual(f.read(), '1')
+
+if __name__ == '__main__':
+    unittest.main()
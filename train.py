@@ -1,10 +1,16 @@
 
 
+import sys
+
 from nanugpt.train import train
 from nanugpt.config import Config
+from nanugpt import preemption
 
 
 if __name__ == "__main__":
     # specify config file to use as first argument in commandline
     config = Config()
-    train(config)
\ No newline at end of file
+    if train(config):
+        # preempted after saving checkpoint, tell launcher to requeue the job
+        preemption.mark_requeue()
+        sys.exit(preemption.REQUEUE_EXIT_CODE)
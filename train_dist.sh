@@ -3,4 +3,33 @@
 set -e
 set -o xtrace
 
-torchrun --standalone --nproc_per_node=$(python -c "import torch; print(torch.cuda.device_count())") nanugpt/train.py configs/train_gpt2/tinyshakespeare.yaml
\ No newline at end of file
+# If any worker fails or hangs, torchrun restarts all workers up to MAX_RESTARTS times and
+# training resumes from latest checkpoint in out_dir. For multi-node elastic training set
+# RDZV_ENDPOINT=<host:port> of one of the nodes and NNODES=<min>:<max> on all nodes,
+# world size can then change across restarts.
+NPROC_PER_NODE=${NPROC_PER_NODE:-$(python -c "import torch; print(torch.cuda.device_count())")}
+MAX_RESTARTS=${MAX_RESTARTS:-3}
+CONFIG=${CONFIG:-configs/train_gpt2/tinyshakespeare.yaml}
+# run name decides out_dir so it must stay same across restarts
+RUN_NAME=${RUN_NAME:-$(date +%Y%m%d-%H%M%S)}
+
+if [ -z "${RDZV_ENDPOINT:-}" ]; then
+    RDZV_ARGS="--standalone"
+else
+    RDZV_ARGS="--nnodes=${NNODES:-1} --rdzv-backend=c10d --rdzv-endpoint=${RDZV_ENDPOINT} --rdzv-id=${RDZV_ID:-${RUN_NAME}}"
+fi
+
+# Workers exit with 75 (preemption.REQUEUE_EXIT_CODE) after checkpointing on preemption
+# signal or near walltime. torchrun treats that as failure and exits with its own code so
+# workers also touch NANUGPT_REQUEUE_FILE and we pass 75 on to the job scheduler.
+REQUEUE_EXIT_CODE=75
+export NANUGPT_REQUEUE_FILE=$(mktemp -u)
+EXIT_CODE=0
+torchrun ${RDZV_ARGS} --nproc_per_node=${NPROC_PER_NODE} --max-restarts=${MAX_RESTARTS} \
+    train.py ${CONFIG} --general.run_name "${RUN_NAME}" "$@" || EXIT_CODE=$?
+
+if [ -f "${NANUGPT_REQUEUE_FILE}" ]; then
+    rm -f "${NANUGPT_REQUEUE_FILE}"
+    exit ${REQUEUE_EXIT_CODE}
+fi
+exit ${EXIT_CODE}